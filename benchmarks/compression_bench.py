@@ -0,0 +1,99 @@
+"""Benchmark compression of stored payloads in gludb.serializers.
+
+We save N documents with a DELTA_HISTORY version history (the kind of
+payload that grows the most) to an in-memory sqlite database without
+compression and with each compression method, then load them back. For each
+method we report the stored size, the compression ratio, and the CPU time
+spent compressing and decompressing (from compression_stats). Run from the
+repository root:
+
+    python benchmarks/compression_bench.py [--count N] [--versions N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gludb.config  # NOQA
+
+from gludb.simple import DBObject, Field  # NOQA
+from gludb.versioning import VersioningTypes  # NOQA
+from gludb.serializers import (  # NOQA
+    Compression,
+    compression_stats,
+    reset_compression_stats,
+)
+
+METHODS = [None, 'zlib', 'lzma']
+
+
+def make_class(method):
+    @DBObject(
+        table_name='CompressionBench',
+        versioning=VersioningTypes.DELTA_HISTORY,
+        compression=Compression(method) if method else None
+    )
+    class Note(object):
+        title = Field('')
+        body = Field('')
+        tags = Field(list)
+
+    return Note
+
+
+def stored_bytes(db):
+    cur = db.backend._conn().cursor()
+    cur.execute('select sum(length(value)) from CompressionBench')
+    return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--versions', type=int, default=10)
+    args = parser.parse_args()
+
+    for method in METHODS:
+        try:
+            cls = make_class(method)
+        except (ImportError, ValueError):
+            print('%-5s not available' % method)
+            continue
+
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.default_database(db)
+        cls.ensure_table()
+        reset_compression_stats()
+
+        notes = [
+            cls(title='Note %d' % i, tags=['draft', 'notes'])
+            for i in range(args.count)
+        ]
+        start = timeit.default_timer()
+        for version in range(args.versions):
+            for note in notes:
+                note.body += 'Paragraph %d of %s. ' % (version, note.title)
+            cls.save_many(notes)
+        save_time = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        cls.find_all()
+        load_time = timeit.default_timer() - start
+
+        size = stored_bytes(db)
+        stats = compression_stats().get(method, None) or {}
+        print('%-5s %9d bytes  ratio %5.2f  save %7.1f ms  load %6.1f ms  '
+              'compress %6.1f ms  decompress %6.1f ms' % (
+                  method, size, stats.get('ratio', None) or 1.0,
+                  save_time * 1000, load_time * 1000,
+                  stats.get('compress_seconds', 0.0) * 1000,
+                  stats.get('decompress_seconds', 0.0) * 1000))
+
+        gludb.config.clear_database_config()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Measure the memory used by loaded DBObject instances.
+
+We save a number of objects to an in-memory sqlite database, load them all
+with find_all, and report the memory allocated for the loaded objects (as
+measured by tracemalloc, so this needs Python 3.4+), both for a regular class
+and the same class declared with slots=True. Run from the repository root:
+
+    python benchmarks/memory_bench.py [--count N]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gludb.config  # NOQA
+
+from gludb.simple import DBObject, Field  # NOQA
+
+
+@DBObject(table_name='MemBench')
+class RegularPerson(object):
+    first_name = Field('')
+    last_name = Field('')
+    email = Field('')
+    age = Field(0)
+
+
+# Note that deriving from RegularPerson wouldn't save anything: every base
+# class needs slots for instances to go without a __dict__
+@DBObject(table_name='SlottedMemBench', slots=True)
+class SlottedPerson(object):
+    first_name = Field('')
+    last_name = Field('')
+    email = Field('')
+    age = Field(0)
+
+
+def loaded_size(cls, count):
+    cls.ensure_table()
+    cls.save_many([
+        cls(first_name='First%d' % num, last_name='Last%d' % num,
+            email='person%d@example.com' % num, age=num % 100)
+        for num in range(count)
+    ])
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objs = cls.find_all()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    assert len(objs) == count
+    stats = after.compare_to(before, 'filename')
+    return sum(stat.size_diff for stat in stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    gludb.config.default_database(
+        gludb.config.Database('sqlite', filename=':memory:')
+    )
+
+    regular = loaded_size(RegularPerson, args.count)
+    slotted = loaded_size(SlottedPerson, args.count)
+
+    print('objects loaded:   %d' % args.count)
+    print('regular:          %.1f MB (%d bytes per object)' % (
+        regular / 1048576.0, regular // args.count
+    ))
+    print('slots=True:       %.1f MB (%d bytes per object)' % (
+        slotted / 1048576.0, slotted // args.count
+    ))
+    print('saved:            %.0f%%' % (100.0 * (regular - slotted) / regular))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark the CPU cost of gludb.simple objects themselves.
+
+We time construction, to_data, from_data, and indexes for a DBObject class
+with a handful of fields and indexes (no database is involved) and report
+operations per second. Run from the repository root:
+
+    python benchmarks/model_bench.py [--number N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gludb.simple import DBObject, Field, Index  # NOQA
+
+
+@DBObject(table_name='ModelBench')
+class Person(object):
+    first_name = Field('')
+    last_name = Field('')
+    email = Field('')
+    age = Field(0)
+    tags = Field(list)
+    extra = Field(dict)
+
+    @Index
+    def full_name(self):
+        return self.first_name + ' ' + self.last_name
+
+    @Index
+    def email_index(self):
+        return self.email
+
+    @Index(type=int)
+    def age_index(self):
+        return self.age
+
+
+def make_person():
+    return Person(first_name='Ada', last_name='Lovelace', age=36,
+                  email='ada@example.com', tags=['math'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    person = make_person()
+    data = person.to_data()
+
+    tests = [
+        ('construct', make_person),
+        ('to_data', person.to_data),
+        ('from_data', lambda: Person.from_data(data)),
+        ('indexes', person.indexes),
+        ('index_names', Person.index_names),
+    ]
+
+    for name, func in tests:
+        # Best of repeat runs, which is the least noisy number
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        print('%-12s %10.0f ops/sec' % (name, args.number / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark the CPU cost of saving large documents.
+
+We save an object holding a large document over and over to an in-memory
+sqlite database and report the time per save and the number of json.dumps
+calls per save. Run from the repository root:
+
+    python benchmarks/save_bench.py [--saves N] [--size N] [--delta]
+
+With --delta the object uses DELTA_HISTORY versioning. Note that computing the
+version diff (json_delta) usually costs much more than serializing.
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gludb.config  # NOQA
+
+from gludb.simple import DBObject, Field  # NOQA
+from gludb.versioning import VersioningTypes  # NOQA
+
+
+@DBObject(table_name='SaveBench')
+class LargeDoc(object):
+    name = Field('')
+    counter = Field(0)
+    payload = Field(dict)
+
+
+@DBObject(table_name='DeltaSaveBench', versioning=VersioningTypes.DELTA_HISTORY)
+class LargeDeltaDoc(LargeDoc):
+    pass
+
+
+class DumpsCounter(object):
+    """Wrap json.dumps so that we can count calls."""
+
+    def __init__(self):
+        self.calls = 0
+        self.orig_dumps = json.dumps
+
+    def __call__(self, *args, **kwrds):
+        self.calls += 1
+        return self.orig_dumps(*args, **kwrds)
+
+
+def make_doc(cls, size):
+    doc = cls(name='bench')
+    # Long string values make for a large document without making the
+    # version diff (which walks the structure) dominate the timing
+    doc.payload = dict(
+        ('key-%05d' % num, 'value %d ' % num * 200)
+        for num in range(size)
+    )
+    return doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--saves', type=int, default=200)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--delta', action='store_true')
+    args = parser.parse_args()
+
+    gludb.config.default_database(
+        gludb.config.Database('sqlite', filename=':memory:')
+    )
+    cls = LargeDeltaDoc if args.delta else LargeDoc
+    cls.ensure_table()
+
+    doc = make_doc(cls, args.size)
+    doc.save()
+
+    def one_save():
+        doc.counter += 1
+        doc.save()
+        if args.delta:
+            # Keep the version history from growing over the run
+            doc._version_hist = []
+
+    counter = DumpsCounter()
+    json.dumps = counter
+    try:
+        elapsed = timeit.timeit(one_save, number=args.saves)
+    finally:
+        json.dumps = counter.orig_dumps
+
+    print('versioning:       %s' % cls.__versioning__)
+    print('document size:    %d entries (%d bytes)' % (
+        args.size, len(doc.to_data())
+    ))
+    print('saves:            %d' % args.saves)
+    print('time per save:    %.3f ms' % (1000.0 * elapsed / args.saves))
+    print('dumps per save:   %.1f' % (float(counter.calls) / args.saves))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark loading wide documents with and without lazy decoding.
+
+We save a number of objects with a large payload field to an in-memory sqlite
+database and time find_all for a regular class and the same class declared
+with lazy=True, both without touching the loaded objects and when reading a
+single field from every object. Run from the repository root:
+
+    python benchmarks/scan_bench.py [--count N] [--size N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gludb.config  # NOQA
+
+from gludb.simple import DBObject, Field  # NOQA
+
+
+@DBObject(table_name='ScanBench')
+class WideDoc(object):
+    name = Field('')
+    payload = Field(dict)
+
+
+@DBObject(table_name='LazyScanBench', lazy=True)
+class LazyWideDoc(object):
+    name = Field('')
+    payload = Field(dict)
+
+
+def fill(cls, count, size):
+    cls.ensure_table()
+    payload = dict(('key-%04d' % num, [num, 'value %d' % num])
+                   for num in range(size))
+    cls.save_many([cls(name='doc%d' % num, payload=payload)
+                   for num in range(count)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    gludb.config.default_database(
+        gludb.config.Database('sqlite', filename=':memory:')
+    )
+
+    print('documents: %d with %d payload entries' % (args.count, args.size))
+    for cls in (WideDoc, LazyWideDoc):
+        fill(cls, args.count, args.size)
+
+        def scan():
+            return cls.find_all()
+
+        def scan_one_field():
+            return [obj.name for obj in cls.find_all()]
+
+        tests = [('find_all', scan), ('+ read name', scan_one_field)]
+        for label, func in tests:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print('%-12s %-12s %8.1f ms' % (cls.__name__, label, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
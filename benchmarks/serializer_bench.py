@@ -0,0 +1,110 @@
+"""Benchmark the JSON codecs and stored formats in gludb.serializers.
+
+For every JSON codec that's installed we time to_data and from_data for a
+document with a few hundred nested values, and a save_many/find_all round
+trip of N of them through an in-memory sqlite database. For every stored
+format (msgpack needs the msgpack package) we report the size of the stored
+payload and the time to save and load N documents in that format. Run from
+the repository root:
+
+    python benchmarks/serializer_bench.py [--count N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gludb.config  # NOQA
+import gludb.serializers  # NOQA
+
+from gludb.simple import DBObject, Field  # NOQA
+from gludb.serializers import get_serializer  # NOQA
+
+
+def make_class(serializer=None):
+    # Each format gets its own table, so loads only read that format
+    table_name = 'SerializerBench' + (serializer or '').capitalize()
+
+    @DBObject(table_name=table_name, serializer=serializer)
+    class Report(object):
+        title = Field('')
+        rows = Field(list)
+        totals = Field(dict)
+
+    return Report
+
+
+Report = make_class()
+
+
+def make_report(i, cls=Report):
+    return cls(
+        title='Report %d' % i,
+        rows=[
+            {'name': 'row %d' % r, 'value': r * 1.5, 'flags': [r % 2 == 0]}
+            for r in range(100)
+        ],
+        totals=dict(('total%d' % t, t) for t in range(50)),
+    )
+
+
+def best_time(func, repeat, number=1):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    gludb.config.default_database(gludb.config.Database(
+        'sqlite',
+        filename=':memory:'
+    ))
+    Report.ensure_table()
+
+    report = make_report(0)
+    data = report.to_data()
+    reports = [make_report(i) for i in range(args.count)]
+
+    for codec in gludb.serializers.json_codecs():
+        gludb.serializers.use_json_codec(codec)
+
+        def round_trip():
+            Report.save_many(reports)
+            Report.find_all()
+
+        to_data = best_time(report.to_data, args.repeat, 200)
+        from_data = best_time(lambda: Report.from_data(data), args.repeat, 200)
+        trip = best_time(round_trip, args.repeat)
+        print('%-8s to_data %7.1f us  from_data %7.1f us  '
+              'save_many+find_all (%d) %7.1f ms' % (
+                  codec, to_data * 1e6, from_data * 1e6,
+                  args.count, trip * 1000))
+
+    gludb.serializers.use_json_codec('json')
+    values = gludb.serializers.loads(data)
+    for name in ('json', 'msgpack'):
+        try:
+            serializer = get_serializer(name)
+        except ImportError:
+            print('%-8s not installed' % name)
+            continue
+
+        cls = make_class(name)
+        cls.ensure_table()
+        docs = [make_report(i, cls) for i in range(args.count)]
+        save = best_time(lambda: cls.save_many(docs), args.repeat)
+        load = best_time(cls.find_all, args.repeat)
+        print('%-8s %d bytes stored  save_many (%d) %7.1f ms  '
+              'find_all %7.1f ms' % (
+                  name, len(serializer.dumps(values)), args.count,
+                  save * 1000, load * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""Awaitable versions of the gludb persistence methods.
+
+This module needs Python 3.5 or later (it uses async/await). On those
+versions, every class set up with gludb.data.DatabaseEnabled (including
+gludb.simple.DBObject classes) also gets these methods:
+
+* Class methods: aensure_table, afind_one, afind_all, afind_by_index,
+  afind_by_indexes, afind_where, afind_ids_by_index, afind_many, asave_many,
+  adelete_many, aiter_all, aiter_by_index, aiter_by_indexes, aiter_where,
+  acount_all, acount_by_index, aexists
+* Instance methods: asave, adelete
+
+They take the same parameters as the methods they're named after, so in an
+asyncio program you can write:
+
+    obj = await MyClass.afind_one(some_id)
+    obj.name = 'Changed'
+    await obj.asave()
+
+    async for obj in MyClass.aiter_all():
+        print(obj.name)
+
+None of our current backend drivers are async, so the database call is run on
+a thread pool that belongs to the mapped gludb.config.Database (see
+Database.set_async_workers to change how many calls can run at once). Only the
+backend call runs there: everything else (serialization for saves, sessions,
+etc) happens on the event loop's thread. A backend can supply native
+coroutines by defining methods with an async_ prefix (e.g. async_find_one).
+
+aiter_all and aiter_by_index read ITER_BATCH_SIZE objects per trip to the
+thread pool. Note that sqlite ':memory:' databases can't be used, since they
+only work on a single thread.
+"""
+
+from .config import get_mapping
+from .data import (
+    Storable,
+    PartialRecord,
+    _post_load,
+    _share_deferred,
+    _load_session,
+    _page_args,
+    _check_index_names,
+    _where_args,
+    _find_ids_by_index,
+    _session_objects,
+    _prepare_save,
+    _prepare_save_many,
+    _check_writable,
+    _deleted,
+)
+from .session import current_session
+from .serializers import strip_encoding
+
+# Objects read per executor call when iterating
+ITER_BATCH_SIZE = 100
+
+
+def _next_batch(iterator, size):
+    batch = []
+    for obj in iterator:
+        batch.append(obj)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+class _AsyncIterator(object):
+    """Async iterator over a (blocking) iterator method of a Database.
+
+    The iterator is created, and read a batch at a time, on the database's
+    executor. If the backend has a native async iterator method, we use that
+    instead.
+    """
+
+    def __init__(self, cls, method_name, args, readonly, paging,
+                 fields=None):
+        self.cls = cls
+        self.method_name = method_name
+        self.args = args
+        self.paging = paging  # (limit, after, order_by)
+        self.fields = fields
+
+        if fields is not None:
+            # Read (id, field values) pairs instead of objects
+            self.method_name = method_name.replace('iter_', 'iter_fields_')
+            self.args = args + (list(fields),)
+        self.session = _load_session(readonly)
+        self.readonly = readonly
+
+        self.db = get_mapping(cls)
+        self.native = None
+        self.iterator = None
+        self.batch = []
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    def _page(self):
+        # Note that this might need to read the after object
+        return _page_args(self.cls, *self.paging)
+
+    def _start(self):
+        page = self._page()
+        if page.get('limit', None) == 0:
+            return iter([])
+        method = getattr(self.db, self.method_name)
+        return iter(method(self.cls, *self.args, **page))
+
+    async def _next_obj(self):
+        if self.native is None and self.iterator is None:
+            native_name = 'async_' + self.method_name
+            native = getattr(self.db.backend, native_name, None)
+            if native is not None:
+                page = await self.db.run_in_executor(self._page)
+                self.native = native(self.cls, *self.args, **page)
+            else:
+                self.iterator = await self.db.run_in_executor(self._start)
+
+        if self.native is not None:
+            return await self.native.__anext__()
+
+        while not self.batch:
+            if self.done:
+                raise StopAsyncIteration
+            self.batch = await self.db.run_in_executor(
+                _next_batch,
+                self.iterator,
+                ITER_BATCH_SIZE
+            )
+            self.batch.reverse()  # So we can pop in order
+            self.done = len(self.batch) < ITER_BATCH_SIZE
+
+        return self.batch.pop()
+
+    async def __anext__(self):
+        obj = await self._next_obj()
+        if self.fields is not None:
+            return PartialRecord(self.cls, *obj)
+        return _post_load(obj, self.readonly, self.session)
+
+
+async def _aensure_table(cls):
+    return await get_mapping(cls).run_async('ensure_table', cls)
+
+
+async def _afind_one(cls, id, readonly=False):
+    session = _load_session(readonly)
+    if session is not None:
+        obj = session.get(cls, id)
+        if obj is not None:
+            return obj
+
+    obj = await get_mapping(cls).run_async('find_one', cls, id)
+    return _post_load(obj, readonly, session)
+
+
+async def _collect(async_iterator):
+    # Python 3.5 doesn't have async comprehensions
+    objs = []
+    async for obj in async_iterator:
+        objs.append(obj)
+    if async_iterator.fields is None:
+        _share_deferred(async_iterator.cls, objs)
+    return objs
+
+
+async def _afind_all(cls, readonly=False, limit=None, after=None,
+                     order_by=None, fields=None):
+    return await _collect(_aiter_all(
+        cls, readonly, limit, after, order_by, fields
+    ))
+
+
+def _aiter_all(cls, readonly=False, limit=None, after=None, order_by=None,
+               fields=None):
+    return _AsyncIterator(
+        cls, 'iter_all', (), readonly, (limit, after, order_by), fields
+    )
+
+
+async def _afind_by_index(cls, index_name, value, readonly=False, limit=None,
+                          after=None, order_by=None, fields=None):
+    return await _collect(_aiter_by_index(
+        cls, index_name, value, readonly, limit, after, order_by, fields
+    ))
+
+
+def _aiter_by_index(cls, index_name, value, readonly=False, limit=None,
+                    after=None, order_by=None, fields=None):
+    return _AsyncIterator(
+        cls, 'iter_by_index', (index_name, value), readonly,
+        (limit, after, order_by), fields
+    )
+
+
+async def _afind_by_indexes(cls, index_values, readonly=False, limit=None,
+                            after=None, order_by=None):
+    return await _collect(_aiter_by_indexes(
+        cls, index_values, readonly, limit, after, order_by
+    ))
+
+
+def _aiter_by_indexes(cls, index_values, readonly=False, limit=None,
+                      after=None, order_by=None):
+    index_values = _check_index_names(cls, index_values)
+    return _AsyncIterator(
+        cls, 'iter_by_indexes', (index_values,), readonly,
+        (limit, after, order_by)
+    )
+
+
+async def _afind_where(cls, where=None, readonly=False, limit=None,
+                       after=None, order_by=None, **field_values):
+    return await _collect(_aiter_where(
+        cls, where, readonly, limit, after, order_by, **field_values
+    ))
+
+
+def _aiter_where(cls, where=None, readonly=False, limit=None, after=None,
+                 order_by=None, **field_values):
+    return _AsyncIterator(
+        cls, 'iter_where', (_where_args(where, field_values),), readonly,
+        (limit, after, order_by)
+    )
+
+
+async def _afind_ids_by_index(cls, index_name, value, limit=None, after=None,
+                              order_by=None):
+    return await get_mapping(cls).run_in_executor(
+        _find_ids_by_index, cls, index_name, value, limit, after, order_by
+    )
+
+
+async def _afind_many(cls, ids, readonly=False):
+    ids = list(ids)
+    db = get_mapping(cls)
+    session = _load_session(readonly)
+    if session is None:
+        found = await db.run_async('find_many', cls, ids)
+        return _share_deferred(cls, [
+            _post_load(obj, readonly) for obj in found
+        ])
+
+    found, missing = _session_objects(session, cls, ids)
+    if missing:
+        loaded = await db.run_async('find_many', cls, missing)
+        for id, obj in zip(missing, loaded):
+            found[id] = _post_load(obj, readonly, session)
+
+    return _share_deferred(cls, [found[id] for id in ids])
+
+
+async def _acount_all(cls):
+    return await get_mapping(cls).run_async('count_all', cls)
+
+
+async def _acount_by_index(cls, index_name, value):
+    return await get_mapping(cls).run_async(
+        'count_by_index', cls, index_name, value
+    )
+
+
+async def _aexists(cls, id):
+    return await get_mapping(cls).run_async('exists', cls, id)
+
+
+async def _asave(self, data=None):
+    data, changes = _prepare_save(self, data)
+    if changes is not None and not changes:
+        return
+
+    session = current_session()
+    if session is not None:
+        session.add_pending(self, data)
+    elif changes:
+        await get_mapping(self.__class__).run_async(
+            'update_fields', self, data, changes
+        )
+    else:
+        await get_mapping(self.__class__).run_async('save', self, data)
+
+    setattr(self, Storable.ORIG_VER_FIELD_NAME, strip_encoding(data))
+
+
+async def _asave_many(cls, objs, data_list=None):
+    objs, data_list = _prepare_save_many(objs, data_list)
+    if not objs:
+        return
+
+    session = current_session()
+    if session is not None:
+        for obj, data in zip(objs, data_list):
+            session.add_pending(obj, data)
+    else:
+        await get_mapping(cls).run_async('save_many', objs, data_list)
+
+    for obj, data in zip(objs, data_list):
+        setattr(obj, Storable.ORIG_VER_FIELD_NAME, strip_encoding(data))
+
+
+async def _adelete(self):
+    _check_writable(self)
+    await get_mapping(self.__class__).run_async('delete', self)
+    _deleted([self])
+
+
+async def _adelete_many(cls, objs):
+    objs = list(objs)
+    for obj in objs:
+        _check_writable(obj)
+
+    await get_mapping(cls).run_async('delete_many', objs)
+    _deleted(objs)
+
+
+def add_async_methods(cls):
+    """Add the awaitable persistence methods to the class."""
+    cls.aensure_table = classmethod(_aensure_table)
+    cls.afind_one = classmethod(_afind_one)
+    cls.afind_all = classmethod(_afind_all)
+    cls.aiter_all = classmethod(_aiter_all)
+    cls.afind_by_index = classmethod(_afind_by_index)
+    cls.aiter_by_index = classmethod(_aiter_by_index)
+    cls.afind_by_indexes = classmethod(_afind_by_indexes)
+    cls.aiter_by_indexes = classmethod(_aiter_by_indexes)
+    cls.afind_where = classmethod(_afind_where)
+    cls.aiter_where = classmethod(_aiter_where)
+    cls.afind_ids_by_index = classmethod(_afind_ids_by_index)
+    cls.afind_many = classmethod(_afind_many)
+    cls.acount_all = classmethod(_acount_all)
+    cls.acount_by_index = classmethod(_acount_by_index)
+    cls.aexists = classmethod(_aexists)
+    cls.asave = _asave
+    cls.asave_many = classmethod(_asave_many)
+    cls.adelete = _adelete
+    cls.adelete_many = classmethod(_adelete_many)
+    return cls
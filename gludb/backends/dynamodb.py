@@ -1,19 +1,41 @@
 """gludb.backends.dynamodb - backend dynamodb database module."""
 
 import os
+import datetime
+
+from decimal import Decimal
 
 import boto.exception
 import boto.dynamodb2  # NOQA
 
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.table import Table
-from boto.dynamodb2.fields import HashKey, GlobalIncludeIndex
+from boto.dynamodb2.fields import HashKey, RangeKey, GlobalIncludeIndex
 from boto.dynamodb2.items import Item
+from boto.dynamodb2.results import ResultSet
+from boto.dynamodb2.types import (
+    QUERY_OPERATORS,
+    FILTER_OPERATORS,
+    NUMBER,
+    STRING,
+)
 from boto.dynamodb2.exceptions import ResourceNotFoundException, ItemNotFound
+from boto.dynamodb.types import Binary, Dynamizer
 from boto.exception import JSONResponseError
 
-from ..utils import uuid
-from ..data import DeleteNotSupported
+from ..utils import uuid, group_by_class, pick_fields
+from ..query import as_predicate, index_value
+from ..data import (
+    DeleteNotSupported,
+    from_stored,
+    composite_indexes,
+    index_types,
+    deferred_fields,
+    split_deferred,
+    index_type_error,
+    many_in_order,
+)
+from ..serializers import loads, encode_payload, payload_values
 
 
 def get_conn():
@@ -64,6 +86,27 @@ class DynamoMappings(object):
 
         return index_val
 
+    @staticmethod
+    def map_typed_val(index_val, index_type=str):
+        """Xform index_val for an index declared with index_type.
+
+        Numbers are stored as DynamoDB numbers (floats go through Decimal,
+        which is what boto wants) and timestamps as ISO 8601 strings, which
+        sort in time order. None is returned as None: the attribute isn't
+        stored, since DynamoDB won't put a string in a number key.
+        """
+        if index_type is str:
+            return DynamoMappings.map_index_val(index_val)
+
+        index_val = index_value(index_val, index_type)
+        if index_val is None:
+            return None
+        elif index_type is float:
+            return Decimal(repr(index_val))
+        elif index_type is datetime.datetime:
+            return index_val.isoformat()
+        return index_val
+
     @staticmethod
     def unmap_stored_val(stored_val):
         """Inverse of index_val_mapping.
@@ -79,6 +122,20 @@ class DynamoMappings(object):
             return stored_val
 
 
+def stored_payload(db_result):
+    """Return the stored data of an item (binary values are unwrapped)."""
+    value = db_result['value']
+    if isinstance(value, Binary):
+        return value.value
+    return value
+
+
+def _gsi_names(descrip):
+    """Return the set of GSI names in a describe_table result."""
+    gsis = descrip.get('Table', {}).get('GlobalSecondaryIndexes', None) or []
+    return set(gsi['IndexName'] for gsi in gsis)
+
+
 def delete_table(table_name):
     """Mainly for testing."""
     Table(table_name, connection=get_conn(), schema=[HashKey('id')]).delete()
@@ -89,7 +146,9 @@ class Backend(object):
 
     def __init__(self, **kwrds):
         """Entry point."""
-        pass  # No current keywords needed/used
+        # No current keywords needed/used. We remember the GSIs each table
+        # really has (table name => set of GSI names): see _table_gsis
+        self.table_gsis = {}
 
     def table_schema_call(self, target, cls):
         """Perform a table schema call.
@@ -98,11 +157,32 @@ class Backend(object):
         table defined by cls. This is how we centralize the Table.create and
         Table ctor calls.
         """
+        types = index_types(cls)
+
+        def key_args(name):
+            # Keys for int and float indexes are numbers (the default is
+            # string)
+            if types[name] in (int, float):
+                return {'data_type': NUMBER}
+            return {}
+
         index_defs = []
         for name in cls.index_names() or []:
             index_defs.append(GlobalIncludeIndex(
                 gsi_name(name),
-                parts=[HashKey(name)],
+                parts=[HashKey(name, **key_args(name))],
+                includes=['value']
+            ))
+
+        # A GSI key has at most two parts, so composite indexes use their
+        # first two indexes as the hash and range keys
+        for names in composite_indexes(cls):
+            index_defs.append(GlobalIncludeIndex(
+                gsi_name('__'.join(names[:2])),
+                parts=[
+                    HashKey(names[0], **key_args(names[0])),
+                    RangeKey(names[1], **key_args(names[1])),
+                ],
                 includes=['value']
             ))
 
@@ -131,6 +211,41 @@ class Backend(object):
         if not exists:
             table = self.table_schema_call(Table.create, cls)
             assert table is not None
+            self.table_gsis.pop(cls.get_table_name(), None)
+        else:
+            self._check_key_types(cls, descrip)
+            self.table_gsis[cls.get_table_name()] = _gsi_names(descrip)
+
+    def _check_key_types(self, cls, descrip):
+        """Raise IndexTypeError if a GSI key has the wrong attribute type.
+
+        Tables created before an index had its type have a string key, and
+        DynamoDB won't put (or query) a number in it.
+        """
+        defs = descrip.get('Table', {}).get('AttributeDefinitions', [])
+        stored_types = dict(
+            (attr['AttributeName'], attr['AttributeType']) for attr in defs
+        )
+        types = index_types(cls)
+        for name in cls.index_names() or []:
+            wanted = NUMBER if types[name] in (int, float) else STRING
+            stored = stored_types.get(name, None)
+            if stored is not None and stored != wanted:
+                raise index_type_error(cls, name, stored)
+
+    def _table_gsis(self, cls):
+        """Return the names of the GSIs the class's table has.
+
+        GSIs are only created with the table, so a table created before the
+        class had a composite index doesn't have its GSI. We describe each
+        table once.
+        """
+        table_name = cls.get_table_name()
+        gsis = self.table_gsis.get(table_name, None)
+        if gsis is None:
+            gsis = _gsi_names(get_conn().describe_table(table_name))
+            self.table_gsis[table_name] = gsis
+        return gsis
 
     def get_class_table(self, cls):
         """Return a DynamoDB table object for the given class."""
@@ -147,53 +262,419 @@ class Backend(object):
         if not db_result:
             return None
 
-        obj = cls.from_data(db_result['value'])
+        obj = from_stored(cls, stored_payload(db_result))
         return obj
 
-    def find_all(self, cls):
+    def find_all(self, cls, limit=None, after=None, order_by=None):
         """Required functionality."""
-        final_results = []
+        return list(self.iter_all(cls, limit, after, order_by))
+
+    def iter_all(self, cls, limit=None, after=None, order_by=None):
+        """Yield all items, reading scan results a page at a time.
+
+        Scans are in DynamoDB's own order, so order_by isn't supported. The
+        after tuple is used as the scan's ExclusiveStartKey.
+        """
+        for db_result in self._scan_items(cls, limit, after, order_by):
+            yield from_stored(cls, stored_payload(db_result))
+
+    def _scan_items(self, cls, limit, after, order_by, attributes=None):
+        # Raw items for iter_all (only the given attributes if not None)
+        self._check_order(order_by)
         table = self.get_class_table(cls)
-        for db_result in table.scan():
-            obj = cls.from_data(db_result['value'])
-            final_results.append(obj)
 
-        return final_results
+        call_args = {'limit': limit, 'attributes': attributes}
+        if after is not None:
+            call_args['exclusive_start_key'] = {'id': after[0]}
+
+        results = ResultSet()
+        results.to_call(table._scan, **call_args)
+        return results
 
-    def find_by_index(self, cls, index_name, value):
+    def find_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
         """Required functionality."""
-        query_args = {
-            index_name + '__eq': DynamoMappings.map_index_val(value),
-            'index': gsi_name(index_name)
-        }
+        return list(self.iter_by_index(
+            cls, index_name, value, limit, after, order_by
+        ))
 
-        final_results = []
-        for db_result in self.get_class_table(cls).query_2(**query_args):
-            obj = cls.from_data(db_result['value'])
-            final_results.append(obj)
+    def iter_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
+        """Yield matching items, reading query results a page at a time.
 
-        return final_results
+        As with iter_all, order_by isn't supported and after is used for the
+        ExclusiveStartKey (our index only has a hash key, so results are in
+        DynamoDB's own order). See _query_plan for how values are queried.
+        """
+        items = self._index_items(cls, index_name, value, limit, after,
+                                  order_by)
+        for db_result in items:
+            yield from_stored(cls, stored_payload(db_result))
+
+    def _index_items(self, cls, index_name, value, limit, after, order_by,
+                     attributes=None):
+        # Raw items for iter_by_index (only the given attributes if not None)
+        return self._indexes_items(
+            cls, {index_name: value}, limit, after, order_by, attributes
+        )
 
-    def save(self, obj):
-        """Required functionality."""
+    def _indexes_items(self, cls, index_values, limit, after, order_by,
+                       attributes=None):
+        # Raw items matching all of index_values (see _query_plan)
+        self._check_order(order_by)
+        table = self.get_class_table(cls)
+
+        plan = self._query_plan(cls, index_values)
+        if plan is None:
+            return
+        gsi, key_filters, other_filters = plan
+
+        if gsi:
+            call_args = dict(key_filters)
+            call_args['index'] = gsi
+            call_args['query_filter'] = other_filters or None
+            call_args['attributes_to_get'] = attributes
+            target = table._query
+        else:
+            call_args = dict(other_filters)
+            call_args['attributes'] = attributes
+            target = table._scan
+        call_args['limit'] = limit
+
+        if after is not None:
+            start_key = {'id': after[0]}
+            for key, mapped_value in key_filters.items():
+                start_key[key[:-len('__eq')]] = mapped_value
+            call_args['exclusive_start_key'] = start_key
+
+        results = ResultSet()
+        results.to_call(target, **call_args)
+        for db_result in results:
+            yield db_result
+
+    def find_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Find all items matching all the index values."""
+        return list(self.iter_by_indexes(
+            cls, index_values, limit, after, order_by
+        ))
+
+    def iter_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Yield items matching all the index values (see _query_plan)."""
+        items = self._indexes_items(cls, index_values, limit, after, order_by)
+        for db_result in items:
+            yield from_stored(cls, stored_payload(db_result))
+
+    def iter_fields_all(self, cls, fields, limit=None, after=None,
+                        order_by=None):
+        """Yield (id, field values) for all items (see Database).
+
+        We store the object data as a single JSON string attribute, so we
+        read it (unless fields is empty) and pick out the fields here.
+        """
+        attributes = ['id', 'value'] if fields else ['id']
+        items = self._scan_items(cls, limit, after, order_by, attributes)
+        for db_result in items:
+            yield db_result['id'], self._item_fields(db_result, fields)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields,
+                             limit=None, after=None, order_by=None):
+        """Yield (id, field values) for matching items (see above)."""
+        attributes = ['id', 'value'] if fields else ['id']
+        items = self._index_items(
+            cls, index_name, value, limit, after, order_by, attributes
+        )
+        for db_result in items:
+            yield db_result['id'], self._item_fields(db_result, fields)
+
+    def _item_fields(self, db_result, fields):
+        if not fields:
+            return {}
+        values = payload_values(stored_payload(db_result))
+        return pick_fields(values, fields)
+
+    def iter_ids_by_index(self, cls, index_name, value, limit=None,
+                          after=None, order_by=None):
+        """Yield the ids of matching items (only the id attribute is read)."""
+        items = self._index_items(
+            cls, index_name, value, limit, after, order_by, ['id']
+        )
+        for db_result in items:
+            yield db_result['id']
+
+    def _index_filter(self, index_name, value, index_type=str):
+        """Return (use query, filter keywords) for an index value.
+
+        Equality uses a query on the index. A hash key can only be queried
+        for equality, so other gludb.query predicates use a scan with a
+        filter on the index attribute instead. Returns None if nothing can
+        match (an empty one_of). Values are mapped for the index's type (see
+        DynamoMappings.map_typed_val).
+        """
+        pred = as_predicate(value)
+        mapped_values = [
+            DynamoMappings.map_typed_val(val, index_type)
+            for val in pred.values
+        ]
+
+        if pred.op == 'eq' and mapped_values[0] is None:
+            # Typed indexes don't store None (see map_typed_val)
+            return False, {index_name + '__null': True}
+        if pred.op == 'eq':
+            return True, {index_name + '__eq': mapped_values[0]}
+
+        if pred.op == 'one_of' and not mapped_values:
+            return None
+
+        filter_arg = mapped_values
+        if pred.op not in ('between', 'one_of'):
+            filter_arg = mapped_values[0]
+        filter_op = 'in' if pred.op == 'one_of' else pred.op
+
+        return False, {index_name + '__' + filter_op: filter_arg}
+
+    def _query_plan(self, cls, index_values):
+        """Return (GSI name, key filters, other filters) for index values.
+
+        We query a GSI when at least one index value is an equality: a
+        composite GSI if the class has one whose indexes are all equalities
+        (and the table has its GSI), otherwise the GSI of the first
+        equality. Everything else becomes a server-side filter on the query.
+        If there's no equality, the GSI name is None and we scan with all
+        the filters instead. Returns None if nothing can match.
+        """
+        types = index_types(cls)
+        eq_names, filters = [], {}
+        for name in sorted(index_values):
+            index_filter = self._index_filter(
+                name, index_values[name], types.get(name, str)
+            )
+            if index_filter is None:
+                return None
+            is_eq, filter_kwargs = index_filter
+            if is_eq:
+                eq_names.append(name)
+            filters.update(filter_kwargs)
+
+        key_names = None
+        for names in composite_indexes(cls):
+            if not set(names[:2]).issubset(eq_names):
+                continue
+            if gsi_name('__'.join(names[:2])) in self._table_gsis(cls):
+                key_names = names[:2]
+                break
+        if key_names is None and eq_names:
+            key_names = eq_names[:1]
+        if key_names is None:
+            return None, {}, filters
+
+        key_filters = dict(
+            (name + '__eq', filters.pop(name + '__eq')) for name in key_names
+        )
+        return gsi_name('__'.join(key_names)), key_filters, filters
+
+    def count_all(self, cls):
+        """Count items with a COUNT scan (no items are returned)."""
+        return self._count(self.get_class_table(cls), (None, {}, {}))
+
+    def count_by_index(self, cls, index_name, value):
+        """Count matching items with a COUNT query or scan."""
+        plan = self._query_plan(cls, {index_name: value})
+        if plan is None:
+            return 0
+        return self._count(self.get_class_table(cls), plan)
+
+    def _count(self, table, plan):
+        # Select=COUNT still pages (by the data examined), so we follow
+        # LastEvaluatedKey until we've seen everything. The key comes back
+        # in DynamoDB's wire format, which is what the connection expects.
+        gsi, key_filters, other_filters = plan
+        other_filters = table._build_filters(
+            other_filters,
+            using=FILTER_OPERATORS
+        ) or None
+
+        count = 0
+        start_key = None
+        while True:
+            if gsi:
+                raw_results = table.connection.query(
+                    table.table_name,
+                    index_name=gsi,
+                    select='COUNT',
+                    key_conditions=table._build_filters(
+                        key_filters,
+                        using=QUERY_OPERATORS
+                    ),
+                    query_filter=other_filters,
+                    exclusive_start_key=start_key
+                )
+            else:
+                raw_results = table.connection.scan(
+                    table.table_name,
+                    select='COUNT',
+                    scan_filter=other_filters,
+                    exclusive_start_key=start_key
+                )
+
+            count += int(raw_results.get('Count', 0))
+            start_key = raw_results.get('LastEvaluatedKey', None)
+            if not start_key:
+                return count
+
+    def exists(self, cls, id):
+        """Return True if there is an item with the id (only id is read)."""
+        try:
+            self.get_class_table(cls).get_item(id=id, attributes=['id'])
+        except ItemNotFound:
+            return False
+        return True
+
+    def _check_order(self, order_by):
+        if order_by is not None:
+            raise ValueError('The DynamoDB backend does not support order_by')
+
+    def find_many(self, cls, ids):
+        """Find items for all the given ids, returned in the same order.
+
+        boto's batch_get takes care of DynamoDB's per-request key limit and of
+        retrying unprocessed keys.
+        """
+        keys = [{'id': id} for id in set(ids)]
+
+        found = dict()
+        if keys:
+            for db_result in self.get_class_table(cls).batch_get(keys=keys):
+                found[db_result['id']] = from_stored(cls, stored_payload(db_result))
+
+        return many_in_order(cls, ids, found)
+
+    def _stored_deferred(self, cls, ids):
+        # The (JSON) deferred attribute of the items that have one
+        keys = [{'id': id} for id in set(ids)]
+
+        found = dict()
+        if keys:
+            items = self.get_class_table(cls).batch_get(
+                keys=keys,
+                attributes=['id', 'deferred']
+            )
+            for db_result in items:
+                if db_result['deferred']:
+                    found[db_result['id']] = db_result['deferred']
+
+        return found
+
+    def find_deferred(self, cls, ids):
+        """Return the stored deferred field values for the ids."""
+        return dict(
+            (id, loads(deferred))
+            for id, deferred in self._stored_deferred(cls, ids).items()
+        )
+
+    def _keep_deferred(self, cls, stored_list):
+        # Batch puts replace the whole item, so items for objects that never
+        # loaded their deferred fields get the currently stored ones (with
+        # one batch read for all of them)
+        if not deferred_fields(cls):
+            return
+        missing = [sd for sd in stored_list if 'deferred' not in sd]
+        if not missing:
+            return
+        stored = self._stored_deferred(cls, [sd['id'] for sd in missing])
+        for stored_data in missing:
+            if stored_data['id'] in stored:
+                stored_data['deferred'] = stored[stored_data['id']]
+
+    def _stored_data(self, obj, data=None):
         if not obj.id:
             obj.id = uuid()
 
+        if data is None:
+            data = obj.to_data()
+        data, deferred = split_deferred(obj.__class__, data)
+
+        payload = encode_payload(obj.__class__, data)
+        if isinstance(payload, bytearray):
+            payload = Binary(bytes(payload))
+
         stored_data = {
             'id': obj.id,
-            'value': obj.to_data()
+            'value': payload
         }
+        if deferred is not None:
+            stored_data['deferred'] = deferred
 
         index_vals = obj.indexes() or {}
+        types = index_types(obj.__class__)
         for key in obj.__class__.index_names() or []:
-            val = index_vals.get(key, '')
-            stored_data[key] = DynamoMappings.map_index_val(val)
+            if types[key] is str:
+                val = index_vals.get(key, '')
+            else:
+                val = index_vals.get(key, None)
+            mapped_val = DynamoMappings.map_typed_val(val, types[key])
+            if mapped_val is not None:
+                stored_data[key] = mapped_val
+
+        return stored_data
+
+    def _update_item(self, cls, table, stored_data):
+        # Write an item like a put, except that an update leaves the stored
+        # deferred attribute alone (so we don't have to read it first)
+        dynamizer = Dynamizer()
+        updates = dict(
+            (name, {'Action': 'PUT', 'Value': dynamizer.encode(val)})
+            for name, val in stored_data.items()
+            if name != 'id'
+        )
+        # A put wouldn't keep index attributes that we don't have now
+        for name in cls.index_names() or []:
+            if name not in stored_data:
+                updates[name] = {'Action': 'DELETE'}
 
+        table.connection.update_item(
+            table.table_name,
+            {'id': dynamizer.encode(stored_data['id'])},
+            attribute_updates=updates
+        )
+
+    def save(self, obj, data=None):
+        """Required functionality."""
+        stored_data = self._stored_data(obj, data)
         table = self.get_class_table(obj.__class__)
-        item = Item(table, data=stored_data)
 
+        if deferred_fields(obj.__class__) and 'deferred' not in stored_data:
+            # The object never read its deferred fields
+            self._update_item(obj.__class__, table, stored_data)
+            return
+
+        item = Item(table, data=stored_data)
         item.save(overwrite=True)
 
+    def save_many(self, objs, data_list=None):
+        """Save all instances with batch writes.
+
+        boto's batch_write flushes every 25 items (the DynamoDB limit) and
+        resends any unprocessed items.
+        """
+        for cls, group in group_by_class(objs, data_list):
+            # A batch can't contain the same key twice, so the last instance
+            # for any id wins
+            by_id = dict()
+            for obj, data in group:
+                stored_data = self._stored_data(obj, data)
+                by_id[stored_data['id']] = stored_data
+            self._keep_deferred(cls, list(by_id.values()))
+
+            with self.get_class_table(cls).batch_write() as batch:
+                for stored_data in by_id.values():
+                    batch.put_item(data=stored_data)
+
     def delete(self, cls):
         """Unsupported functionality."""
         raise DeleteNotSupported()
+
+    def delete_many(self, objs):
+        """Unsupported functionality."""
+        raise DeleteNotSupported()
@@ -1,9 +1,22 @@
 """gludb.backends.gcd - backend Google Cloud Datastore module."""
 
 import sys
-
-from ..utils import uuid
-from ..data import DeleteNotSupported
+import heapq
+import numbers
+import datetime
+import itertools
+
+from ..utils import uuid, chunked, group_by_class, pick_fields
+from ..query import Predicate, as_predicate, index_value
+from ..data import (
+    DeleteNotSupported,
+    from_stored,
+    index_types,
+    deferred_fields,
+    split_deferred,
+    many_in_order,
+)
+from ..serializers import loads, encode_payload, payload_values
 
 if sys.version_info >= (3, 0):
     raise ImportError("GLUDB GCD Backend only supports Python 2.7")
@@ -12,6 +25,9 @@ import googledatastore as datastore  # NOQA
 # TODO: one day use this instead (when it has Python3 support)
 # from gcloud import datastore
 
+# GCD limits the number of mutations in a single commit
+MAX_COMMIT_MUTATIONS = 500
+
 
 class DatastoreTransaction(object):
     """GCD transction monitor."""
@@ -59,69 +75,204 @@ def make_key(table_name, objid):
     return key
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def set_value(value, val):
+    """Set the datastore Value message for val.
+
+    Typed index values are stored as the datastore's integer, double, and
+    timestamp types (timestamps are naive UTC datetimes, as for
+    gludb.query.index_value). Keys are stored as keys, None isn't set, and
+    everything else is stored as a string.
+    """
+    if val is None:
+        return
+    elif isinstance(val, datastore.Key):
+        value.key_value.CopyFrom(val)
+    elif isinstance(val, bool):
+        value.string_value = str(val)
+    elif isinstance(val, numbers.Integral):
+        value.integer_value = val  # Including Python 2's long
+    elif isinstance(val, float):
+        value.double_value = val
+    elif isinstance(val, datetime.datetime):
+        delta = val - EPOCH
+        value.timestamp_microseconds_value = (
+            (delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds
+        )
+    else:
+        value.string_value = str(val)
+
+
+def get_value(value):
+    """Inverse of set_value (except for keys)."""
+    if value.HasField('integer_value'):
+        return value.integer_value
+    elif value.HasField('double_value'):
+        return value.double_value
+    elif value.HasField('timestamp_microseconds_value'):
+        micros = value.timestamp_microseconds_value
+        return EPOCH + datetime.timedelta(microseconds=micros)
+    elif value.HasField('blob_value'):
+        return value.blob_value
+    return value.string_value
+
+
+def stored_index_value(val, index_type=str):
+    """Return what we store (and query) for an index value.
+
+    Index values are strings (even None) unless the index is typed, in which
+    case they are converted by gludb.query.index_value.
+    """
+    if index_type is str:
+        return str(val)
+    return index_value(val, index_type)
+
+
+def fill_entity(entity, table_name, objid, data, index_name_values):
+    """Populate an entity (usually an upsert command) for a record.
+
+    data is stored as a string, unless it's a bytearray (a binary or
+    compressed payload from gludb.serializers), which is stored as an
+    unindexed blob.
+    """
+    entity.key.CopyFrom(make_key(table_name, objid))
+
+    prop = entity.property.add()
+    prop.name = 'id'
+    prop.value.string_value = objid
+
+    prop = entity.property.add()
+    prop.name = 'value'
+    if isinstance(data, bytearray):
+        prop.value.blob_value = bytes(data)
+        prop.value.indexed = False
+    else:
+        prop.value.string_value = data
+
+    for name, val in index_name_values:
+        prop = entity.property.add()
+        prop.name = name
+        set_value(prop.value, val)
+
+
 def write_rec(table_name, objid, data, index_name_values):
     """Write (upsert) a record using a tran."""
-    with DatastoreTransaction() as tx:
-        entity = tx.get_upsert()
-
-        entity.key.CopyFrom(make_key(table_name, objid))
+    write_recs(table_name, [(objid, data, index_name_values)])
 
-        prop = entity.property.add()
-        prop.name = 'id'
-        prop.value.string_value = objid
 
-        prop = entity.property.add()
-        prop.name = 'value'
-        prop.value.string_value = data
+def write_recs(table_name, recs):
+    """Write (upsert) records using as few trans as possible.
 
-        for name, val in index_name_values:
-            prop = entity.property.add()
-            prop.name = name
-            prop.value.string_value = str(val)
+    Each rec is an (objid, data, index_name_values) tuple.
+    """
+    for chunk in chunked(recs, MAX_COMMIT_MUTATIONS):
+        with DatastoreTransaction() as tx:
+            for objid, data, index_name_values in chunk:
+                fill_entity(
+                    tx.get_upsert(),
+                    table_name,
+                    objid,
+                    data,
+                    index_name_values
+                )
 
 
 def extract_entity(found):
     """Copy found entity to a dict."""
     obj = dict()
     for prop in found.entity.property:
-        obj[prop.name] = prop.value.string_value
+        obj[prop.name] = get_value(prop.value)
     return obj
 
 
 def read_rec(table_name, objid):
     """Generator that yields keyed recs from store."""
-    req = datastore.LookupRequest()
-    req.key.extend([make_key(table_name, objid)])
+    return read_recs(table_name, [objid])
 
-    for found in datastore.lookup(req).found:
-        yield extract_entity(found)
 
+def read_recs(table_name, objids):
+    """Generator that yields keyed recs from store for all objids.
+
+    A single lookup is used for all keys, except that we re-request any keys
+    the datastore tells us it deferred.
+    """
+    keys = [make_key(table_name, objid) for objid in objids]
+
+    while keys:
+        req = datastore.LookupRequest()
+        req.key.extend(keys)
+
+        resp = datastore.lookup(req)
+        for found in resp.found:
+            yield extract_entity(found)
 
-def read_by_indexes(table_name, index_name_values=None):
-    """Index reader."""
+        keys = list(resp.deferred)
+
+
+def add_filters(query, filters):
+    """Add all filters to the query (as a composite AND filter if needed).
+
+    Each filter is a (property name, operator, value) tuple, where value is
+    stored as for set_value.
+    """
+    if not filters:
+        return
+
+    if len(filters) == 1:
+        targets = [query.filter]
+    else:
+        composite = query.filter.composite_filter
+        composite.operator = datastore.CompositeFilter.AND
+        targets = [composite.filter.add() for _ in filters]
+
+    for target, (name, operator, val) in zip(targets, filters):
+        prop_filter = target.property_filter
+        prop_filter.property.name = name
+        prop_filter.operator = operator
+        set_value(prop_filter.value, val)
+
+
+def run_query(table_name, filters, orders, limit=None, keys_only=False):
+    """Generator that yields recs for a query, following query cursors.
+
+    filters are as for add_filters, and orders is a list of property names
+    to sort by (ascending). If keys_only is True, we run a keys-only query
+    (no properties are returned) and the recs only have an id.
+    """
     req = datastore.RunQueryRequest()
 
     query = req.query
     query.kind.add().name = table_name
-
-    if not index_name_values:
-        index_name_values = []
-    for name, val in index_name_values:
-        queryFilter = query.filter.property_filter
-        queryFilter.property.name = name
-        queryFilter.operator = datastore.PropertyFilter.EQUAL
-        queryFilter.value.string_value = str(val)
+    add_filters(query, filters)
+    for name in orders:
+        query.order.add().property.name = name
+    if keys_only:
+        query.projection.add().property.name = '__key__'
 
     loop_its = 0
     have_more = True
+    remaining = limit
 
     while have_more:
+        if remaining is not None:
+            if remaining <= 0:
+                break
+            query.limit = remaining
+
         resp = datastore.run_query(req)
 
         found_something = False
         for found in resp.batch.entity_result:
-            yield extract_entity(found)
+            if keys_only:
+                yield {'id': found.entity.key.path_element[-1].name}
+            else:
+                yield extract_entity(found)
             found_something = True
+            if remaining is not None:
+                remaining -= 1
 
         if not found_something:
             # This is a guard against bugs or excessive looping - as long we
@@ -138,17 +289,166 @@ def read_by_indexes(table_name, index_name_values=None):
             query.start_cursor.CopyFrom(end_cursor)
 
 
+def index_filter_sets(index_name_values):
+    """Return a list of filter lists (as for add_filters) for index values.
+
+    Each value can be a gludb.query.Predicate. The datastore doesn't have an
+    IN filter, so we need a separate query (and filter list) for each value
+    of a one_of predicate.
+    """
+    operators = {
+        'eq': datastore.PropertyFilter.EQUAL,
+        'gt': datastore.PropertyFilter.GREATER_THAN,
+        'gte': datastore.PropertyFilter.GREATER_THAN_OR_EQUAL,
+        'lt': datastore.PropertyFilter.LESS_THAN,
+        'lte': datastore.PropertyFilter.LESS_THAN_OR_EQUAL,
+    }
+
+    choices = []
+    for name, value in index_name_values or []:
+        pred = as_predicate(value)
+        if pred.op == 'one_of':
+            choices.append([
+                [(name, operators['eq'], val)] for val in pred.values
+            ])
+        elif pred.op == 'between':
+            low, high = pred.values
+            choices.append([[
+                (name, operators['gte'], low),
+                (name, operators['lte'], high),
+            ]])
+        else:
+            choices.append([[(name, operators[pred.op], pred.values[0])]])
+
+    return [sum(combo, []) for combo in itertools.product(*choices)]
+
+
+def read_filtered(table_name, filters, limit=None, after=None, order_by=None,
+                  keys_only=False):
+    """Generator that yields recs matching all filters (see read_by_indexes).
+
+    If any of limit, after, or order_by are given, recs are sorted by
+    order_by (an index name, ties broken by key) or key, and start after the
+    (id, sort value) tuple after. The datastore doesn't support OR filters,
+    so when ordering by an index we start after a rec with two queries: the
+    rest of the recs with the same sort value, and then the recs with larger
+    sort values.
+    """
+    EQUAL = datastore.PropertyFilter.EQUAL
+    GREATER_THAN = datastore.PropertyFilter.GREATER_THAN
+
+    sort_prop = order_by if order_by not in (None, 'id') else None
+    if sort_prop:
+        orders = [sort_prop, '__key__']
+    elif order_by or limit is not None or after is not None:
+        orders = ['__key__']
+    else:
+        orders = []
+
+    if after is None:
+        queries = [(filters, orders)]
+    else:
+        after_id, after_val = after
+        after_key = ('__key__', GREATER_THAN, make_key(table_name, after_id))
+        if sort_prop:
+            same_val = [(sort_prop, EQUAL, after_val), after_key]
+            queries = [
+                (filters + same_val, ['__key__']),
+                (filters + [(sort_prop, GREATER_THAN, after_val)], orders),
+            ]
+        else:
+            queries = [(filters + [after_key], orders)]
+
+    remaining = limit
+    for query_filters, query_orders in queries:
+        recs = run_query(
+            table_name, query_filters, query_orders, remaining, keys_only
+        )
+        for rec in recs:
+            yield rec
+            if remaining is not None:
+                remaining -= 1
+        if remaining is not None and remaining <= 0:
+            break
+
+
+def read_by_indexes(table_name, index_name_values=None, limit=None,
+                    after=None, order_by=None, keys_only=False):
+    """Index reader.
+
+    index_name_values is a list of (index name, value) pairs, where value is
+    a plain value or a gludb.query.Predicate. When more than one query is
+    needed (for one_of predicates), the results are merged in sort order.
+    If keys_only is True, the recs only have an id (see run_query) - unless
+    we need to merge on an index value, which keys-only recs don't have.
+    """
+    filter_sets = index_filter_sets(index_name_values)
+    sort_prop = order_by if order_by not in (None, 'id') else None
+    if sort_prop and len(filter_sets) > 1:
+        keys_only = False
+
+    streams = [
+        read_filtered(table_name, filters, limit, after, order_by, keys_only)
+        for filters in filter_sets
+    ]
+    if len(streams) == 1:
+        for rec in streams[0]:
+            yield rec
+        return
+
+    def decorated(stream):
+        for rec in stream:
+            sort_val = rec.get(sort_prop, '') if sort_prop else ''
+            yield (sort_val, rec['id'], rec)
+
+    count = 0
+    for _, _, rec in heapq.merge(*[decorated(st) for st in streams]):
+        if limit is not None and count >= limit:
+            break
+        yield rec
+        count += 1
+
+
 def delete_table(table_name):
     """Mainly for testing."""
     to_delete = [
         make_key(table_name, rec['id'])
-        for rec in read_by_indexes(table_name, [])
+        for rec in read_by_indexes(table_name, [], keys_only=True)
     ]
 
     with DatastoreTransaction() as tx:
         tx.get_commit_req().mutation.delete.extend(to_delete)
 
 
+def rec_fields(rec, fields):
+    """Return the given fields from the value of a rec (see pick_fields)."""
+    if not fields:
+        return {}
+    return pick_fields(payload_values(rec['value']), fields)
+
+
+def count_by_indexes(table_name, index_name_values=None):
+    """Count recs matching index values using keys-only queries.
+
+    The queries for a one_of predicate can't overlap, so we just add up the
+    counts.
+    """
+    count = 0
+    for filters in index_filter_sets(index_name_values):
+        for _ in run_query(table_name, filters, [], keys_only=True):
+            count += 1
+    return count
+
+
+def rec_exists(table_name, objid):
+    """Return True if a rec with the id exists (with a keys-only query)."""
+    key_filter = ('__key__', datastore.PropertyFilter.EQUAL,
+                  make_key(table_name, objid))
+    for _ in run_query(table_name, [key_filter], [], 1, keys_only=True):
+        return True
+    return False
+
+
 class Backend(object):
     """Backend implementation."""
 
@@ -160,6 +460,30 @@ class Backend(object):
         """Required functionality."""
         pass  # Currently nothing needs to be done
 
+    def _index_args(self, cls, index_name_values, after=None, order_by=None):
+        """Return index values (and the after tuple) as we store them.
+
+        See stored_index_value: values and predicate operands are converted
+        for the type of their index, as is the sort value in after.
+        """
+        types = index_types(cls)
+        converted = []
+        for name, value in index_name_values:
+            pred = as_predicate(value)
+            converted.append((name, Predicate(pred.op, [
+                stored_index_value(val, types.get(name, str))
+                for val in pred.values
+            ])))
+
+        if after is not None and order_by not in (None, 'id'):
+            after_id, after_val = after
+            after_val = stored_index_value(
+                after_val, types.get(order_by, str)
+            )
+            after = (after_id, after_val)
+
+        return converted, after
+
     def find_one(self, cls, id):
         """Required functionality."""
         db_result = None
@@ -169,49 +493,216 @@ class Backend(object):
         if not db_result:
             return None
 
-        obj = cls.from_data(db_result['value'])
+        obj = from_stored(cls, db_result['value'])
         return obj
 
-    def find_all(self, cls):
+    def find_all(self, cls, limit=None, after=None, order_by=None):
         """Required functionality."""
-        final_results = []
-        for db_result in read_by_indexes(cls.get_table_name(), []):
-            obj = cls.from_data(db_result['value'])
-            final_results.append(obj)
+        return list(self.iter_all(cls, limit, after, order_by))
 
-        return final_results
+    def iter_all(self, cls, limit=None, after=None, order_by=None):
+        """Yield all records, following query cursors between batches."""
+        table_name = cls.get_table_name()
+        _, after = self._index_args(cls, [], after, order_by)
+        recs = read_by_indexes(table_name, [], limit, after, order_by)
+        for db_result in recs:
+            yield from_stored(cls, db_result['value'])
 
-    def find_by_index(self, cls, index_name, value):
+    def find_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
         """Required functionality."""
-        table_name = cls.get_table_name()
-        index_name_vals = [(index_name, value)]
+        return list(self.iter_by_index(
+            cls, index_name, value, limit, after, order_by
+        ))
 
-        final_results = []
-        for db_result in read_by_indexes(table_name, index_name_vals):
-            obj = cls.from_data(db_result['value'])
-            final_results.append(obj)
+    def iter_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
+        """Yield matching records, following query cursors between batches."""
+        table_name = cls.get_table_name()
+        index_name_vals, after = self._index_args(
+            cls, [(index_name, value)], after, order_by
+        )
 
-        return final_results
+        recs = read_by_indexes(
+            table_name, index_name_vals, limit, after, order_by
+        )
+        for db_result in recs:
+            yield from_stored(cls, db_result['value'])
+
+    def find_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Find all records matching all the index values."""
+        return list(self.iter_by_indexes(
+            cls, index_values, limit, after, order_by
+        ))
+
+    def iter_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Yield records matching all the index values (composite filter).
+
+        Queries that combine a filter with an inequality filter or ordering
+        on another index need a composite index in the datastore. Those are
+        defined in index.yaml (we can't create them), so ensure_table ignores
+        composite_indexes.
+        """
+        index_name_vals, after = self._index_args(
+            cls, sorted(index_values.items()), after, order_by
+        )
+        recs = read_by_indexes(
+            cls.get_table_name(), index_name_vals, limit, after, order_by
+        )
+        for db_result in recs:
+            yield from_stored(cls, db_result['value'])
+
+    def iter_fields_all(self, cls, fields, limit=None, after=None,
+                        order_by=None):
+        """Yield (id, field values) for all records (see Database).
+
+        We store the object data as a single string property, so we read it
+        and pick out the fields here (with a keys-only query if fields is
+        empty).
+        """
+        _, after = self._index_args(cls, [], after, order_by)
+        recs = read_by_indexes(
+            cls.get_table_name(), [], limit, after, order_by,
+            keys_only=not fields
+        )
+        for db_result in recs:
+            yield db_result['id'], rec_fields(db_result, fields)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields,
+                             limit=None, after=None, order_by=None):
+        """Yield (id, field values) for matching records (see above)."""
+        index_name_vals, after = self._index_args(
+            cls, [(index_name, value)], after, order_by
+        )
+        recs = read_by_indexes(
+            cls.get_table_name(), index_name_vals, limit, after, order_by,
+            keys_only=not fields
+        )
+        for db_result in recs:
+            yield db_result['id'], rec_fields(db_result, fields)
+
+    def iter_ids_by_index(self, cls, index_name, value, limit=None,
+                          after=None, order_by=None):
+        """Yield the ids of matching records using keys-only queries."""
+        index_name_vals, after = self._index_args(
+            cls, [(index_name, value)], after, order_by
+        )
+        recs = read_by_indexes(
+            cls.get_table_name(), index_name_vals, limit, after, order_by,
+            keys_only=True
+        )
+        for db_result in recs:
+            yield db_result['id']
+
+    def count_all(self, cls):
+        """Count records with keys-only queries."""
+        return count_by_indexes(cls.get_table_name())
+
+    def count_by_index(self, cls, index_name, value):
+        """Count matching records with keys-only queries."""
+        index_name_vals, _ = self._index_args(cls, [(index_name, value)])
+        return count_by_indexes(cls.get_table_name(), index_name_vals)
+
+    def exists(self, cls, id):
+        """Return True if there is a record with the id."""
+        return rec_exists(cls.get_table_name(), id)
+
+    def find_many(self, cls, ids):
+        """Find records for all the given ids, returned in the same order."""
+        found = dict()
+        for db_result in read_recs(cls.get_table_name(), set(ids)):
+            found[db_result['id']] = from_stored(cls, db_result['value'])
+
+        return many_in_order(cls, ids, found)
+
+    def _stored_deferred(self, cls, ids):
+        # The (JSON) deferred property of the records that have one
+        found = dict()
+        for db_result in read_recs(cls.get_table_name(), set(ids)):
+            if db_result.get('deferred', None):
+                found[db_result['id']] = db_result['deferred']
+        return found
+
+    def find_deferred(self, cls, ids):
+        """Return the stored deferred field values for the ids."""
+        return dict(
+            (id, loads(deferred))
+            for id, deferred in self._stored_deferred(cls, ids).items()
+        )
 
-    def save(self, obj):
-        """Required functionality."""
+    def _keep_deferred(self, cls, recs):
+        # Upserts replace the whole entity (Datastore can't update part of
+        # one), so records for objects that never loaded their deferred
+        # fields get the currently stored ones with a single lookup
+        missing = [rec[0] for rec in recs if rec[3] is None]
+        stored = dict()
+        if missing and deferred_fields(cls):
+            stored = self._stored_deferred(cls, missing)
+
+        kept = []
+        for objid, data, index_name_values, deferred in recs:
+            if deferred is None:
+                deferred = stored.get(objid, None)
+            if deferred is not None:
+                # Written like an index value, as a string property
+                index_name_values = index_name_values + [('deferred', deferred)]
+            kept.append((objid, data, index_name_values))
+        return kept
+
+    def _rec(self, obj, data=None):
         if not obj.id:
             obj.id = uuid()
 
+        if data is None:
+            data = obj.to_data()
+        data, deferred = split_deferred(obj.__class__, data)
+        data = encode_payload(obj.__class__, data)
+
         index_names = obj.__class__.index_names() or []
         index_dict = obj.indexes() or {}
+        types = index_types(obj.__class__)
+        # A missing string index is stored as '', but a missing typed index
+        # is None (an empty value), since '' doesn't convert to its type
         index_name_values = [
-            (key, index_dict.get(key, ''))
+            (key, stored_index_value(
+                index_dict.get(key, '' if types[key] is str else None),
+                types[key]
+            ))
             for key in index_names
         ]
 
+        return obj.id, data, index_name_values, deferred
+
+    def save(self, obj, data=None):
+        """Required functionality."""
+        recs = self._keep_deferred(obj.__class__, [self._rec(obj, data)])
+        objid, data, index_name_values = recs[0]
         write_rec(
             obj.__class__.get_table_name(),
-            obj.id,
-            obj.to_data(),
+            objid,
+            data,
             index_name_values
         )
 
+    def save_many(self, objs, data_list=None):
+        """Save all instances with multi-entity commits."""
+        for cls, group in group_by_class(objs, data_list):
+            # A commit can't upsert the same key twice, so the last instance
+            # for any id wins
+            by_id = dict()
+            for obj, data in group:
+                rec = self._rec(obj, data)
+                by_id[rec[0]] = rec
+
+            recs = self._keep_deferred(cls, list(by_id.values()))
+            write_recs(cls.get_table_name(), recs)
+
     def delete(self, cls):
         """Unsupported functionality."""
         raise DeleteNotSupported()
+
+    def delete_many(self, objs):
+        """Unsupported functionality."""
+        raise DeleteNotSupported()
@@ -1,11 +1,72 @@
 """MongoDB backend."""
 
-import json
-
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
 from pymongo.errors import CollectionInvalid
 
-from ..utils import uuid
+from ..utils import uuid, group_by_class, pick_fields
+from ..query import as_predicate, index_value
+from ..data import (
+    from_stored_values,
+    object_values,
+    composite_indexes,
+    index_types,
+    deferred_fields,
+    split_deferred_values,
+    many_in_order,
+)
+
+# Documents fetched per round trip when iterating a cursor
+ITER_BATCH_SIZE = 1000
+
+
+_MONGO_OPERATORS = {'gt': '$gt', 'gte': '$gte', 'lt': '$lt', 'lte': '$lte'}
+
+
+def _index_condition(value, convert=str):
+    # Query condition for an index value (or gludb.query.Predicate) - note
+    # that we store index values as strings unless the index has a type (see
+    # _typed_condition). Fields in the stored value are compared as they are
+    # (see iter_where)
+    pred = as_predicate(value)
+    vals = [convert(val) for val in pred.values]
+
+    if pred.op == 'eq':
+        return vals[0]
+    elif pred.op == 'between':
+        return {'$gte': vals[0], '$lte': vals[1]}
+    elif pred.op == 'one_of':
+        return {'$in': vals}
+    else:
+        return {_MONGO_OPERATORS[pred.op]: vals[0]}
+
+
+def _typed_condition(cls, index_name, value):
+    # Typed indexes are stored as native BSON values, so their query values
+    # are converted the same way
+    index_type = index_types(cls).get(index_name, str)
+    return _index_condition(value, lambda val: index_value(val, index_type))
+
+
+def _index_fields(obj):
+    # Index values to store for obj
+    index_vals = obj.indexes() or {}
+    types = index_types(obj.__class__)
+    fields = {}
+    for key in obj.__class__.index_names() or []:
+        if types[key] is str:
+            fields[key] = str(index_vals.get(key, ''))
+        else:
+            fields[key] = index_value(index_vals.get(key, None), types[key])
+    return fields
+
+
+def _count(coll, query, limit=0):
+    # Count matching documents on the server. count_documents is new in
+    # pymongo 3.7 - older versions have Cursor.count instead
+    if hasattr(coll, 'count_documents'):
+        kwrds = {'limit': limit} if limit else {}
+        return coll.count_documents(query, **kwrds)
+    return coll.find(query).limit(limit).count(with_limit_and_skip=True)
 
 
 def delete_collection(db_name, collection_name, host='localhost', port=27017):
@@ -39,18 +100,59 @@ class Backend(object):
         coll = self.get_collection(coll_name)
         for idx_name in cls.index_names():
             coll.ensure_index(idx_name)
+        for names in composite_indexes(cls):
+            coll.ensure_index([(name, 1) for name in names])
+
+    def _iter(self, cls, query, limit=None, after=None, order_by=None,
+              fields=None):
+        # If any of limit, after, or order_by are given, documents are sorted
+        # by order_by (an index name, ties broken by id) or id, and start
+        # after the (id, sort value) tuple after. If fields is given, we use
+        # a projection and yield (id, field values) tuples
+        sort_key = order_by if order_by not in (None, 'id') else None
+        if after is not None:
+            after_id, after_val = after
+            if sort_key and after_val is None:
+                # Nulls (and missing values) sort first, and $gt never
+                # matches null, so rows after a null need their own test
+                keyset = {"$or": [
+                    {sort_key: {"$ne": None}},
+                    {sort_key: None, "_id": {"$gt": after_id}},
+                ]}
+            elif sort_key:
+                if index_types(cls).get(sort_key, str) is str:
+                    after_val = str(after_val)
+                keyset = {"$or": [
+                    {sort_key: {"$gt": after_val}},
+                    {sort_key: after_val, "_id": {"$gt": after_id}},
+                ]}
+            else:
+                keyset = {"_id": {"$gt": after_id}}
+            query = {"$and": [query, keyset]} if query else keyset
 
-    def _find(self, cls, query):
         coll = self.get_collection(cls.get_table_name())
+        projection = None
+        if fields is not None:
+            projection = dict(('value.' + name, 1) for name in fields)
+            projection['_id'] = 1
+        cursor = coll.find(query, projection).batch_size(ITER_BATCH_SIZE)
 
-        final_results = []
-        for db_result in coll.find(query):
-            # We need to give JSON to from_data
-            obj_data = json.dumps(db_result['value'])
-            obj = cls.from_data(obj_data)
-            final_results.append(obj)
+        if sort_key:
+            cursor = cursor.sort([(sort_key, 1), ("_id", 1)])
+        elif order_by or limit is not None or after is not None:
+            cursor = cursor.sort("_id", 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
 
-        return final_results
+        for db_result in cursor:
+            if fields is None:
+                yield from_stored_values(cls, db_result['value'])
+            else:
+                values = db_result.get('value', {})
+                yield db_result['_id'], pick_fields(values, fields)
+
+    def _find(self, cls, query):
+        return list(self._iter(cls, query))
 
     def find_one(self, cls, id):
         """Required functionality."""
@@ -59,31 +161,174 @@ class Backend(object):
             return None
         return one[0]
 
-    def find_all(self, cls):
+    def find_all(self, cls, limit=None, after=None, order_by=None):
         """Required functionality."""
-        return self._find(cls, {})
+        return list(self.iter_all(cls, limit, after, order_by))
 
-    def find_by_index(self, cls, index_name, value):
-        """Required functionality."""
-        return self._find(cls, {index_name: str(value)})
+    def iter_all(self, cls, limit=None, after=None, order_by=None):
+        """Yield all documents from a batched cursor."""
+        return self._iter(cls, {}, limit, after, order_by)
 
-    def save(self, obj):
+    def find_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
         """Required functionality."""
+        return list(self.iter_by_index(
+            cls, index_name, value, limit, after, order_by
+        ))
+
+    def iter_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
+        """Yield matching documents from a batched cursor."""
+        query = {index_name: _typed_condition(cls, index_name, value)}
+        return self._iter(cls, query, limit, after, order_by)
+
+    def count_all(self, cls):
+        """Return the number of documents without reading them."""
+        return _count(self.get_collection(cls.get_table_name()), {})
+
+    def count_by_index(self, cls, index_name, value):
+        """Return the number of documents matching index query."""
+        query = {index_name: _typed_condition(cls, index_name, value)}
+        return _count(self.get_collection(cls.get_table_name()), query)
+
+    def exists(self, cls, id):
+        """Return True if there is a document with the id (not read)."""
+        coll = self.get_collection(cls.get_table_name())
+        return _count(coll, {"_id": id}, limit=1) > 0
+
+    def find_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Find all documents matching all the index values."""
+        return list(self.iter_by_indexes(
+            cls, index_values, limit, after, order_by
+        ))
+
+    def iter_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Yield documents matching all the index values (one query)."""
+        query = dict(
+            (name, _typed_condition(cls, name, value))
+            for name, value in index_values.items()
+        )
+        return self._iter(cls, query, limit, after, order_by)
+
+    def iter_where(self, cls, where, limit=None, after=None, order_by=None):
+        """Yield documents whose stored fields match where (see Database)."""
+        query = dict(
+            ('value.' + name, _index_condition(cond, lambda val: val))
+            for name, cond in where.items()
+        )
+        return self._iter(cls, query, limit, after, order_by)
+
+    def iter_fields_all(self, cls, fields, limit=None, after=None,
+                        order_by=None):
+        """Yield (id, field values) for all documents (see Database)."""
+        return self._iter(cls, {}, limit, after, order_by, fields)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields,
+                             limit=None, after=None, order_by=None):
+        """Yield (id, field values) for documents matching index query."""
+        query = {index_name: _typed_condition(cls, index_name, value)}
+        return self._iter(cls, query, limit, after, order_by, fields)
+
+    def iter_ids_by_index(self, cls, index_name, value, limit=None,
+                          after=None, order_by=None):
+        """Yield the ids of documents matching index query."""
+        query = {index_name: _typed_condition(cls, index_name, value)}
+        docs = self._iter(cls, query, limit, after, order_by, [])
+        return (id for id, _ in docs)
+
+    def find_many(self, cls, ids):
+        """Find documents for all the given ids, returned in the same order."""
+        found = dict(
+            (obj.get_id(), obj)
+            for obj in self._find(cls, {"_id": {"$in": list(set(ids))}})
+        )
+        return many_in_order(cls, ids, found)
+
+    def find_deferred(self, cls, ids):
+        """Return the stored deferred field values for the ids."""
+        coll = self.get_collection(cls.get_table_name())
+        cursor = coll.find(
+            {"_id": {"$in": list(set(ids))}, "deferred": {"$exists": True}},
+            {"deferred": 1}
+        )
+        return dict((doc['_id'], doc['deferred']) for doc in cursor)
+
+    def _stored_data(self, obj, data=None):
         if not obj.id:
             obj.id = uuid()
 
+        values, deferred = split_deferred_values(
+            obj.__class__,
+            object_values(obj, data)
+        )
+
         stored_data = {
             '_id': obj.id,
-            'value': json.loads(obj.to_data())
+            'value': values
         }
+        if deferred is not None:
+            stored_data['deferred'] = deferred
+
+        stored_data.update(_index_fields(obj))
 
-        index_vals = obj.indexes() or {}
-        for key in obj.__class__.index_names() or []:
-            val = index_vals.get(key, '')
-            stored_data[key] = str(val)
+        return stored_data
+
+    def _keeps_deferred(self, obj, stored_data):
+        # True if the object never loaded its deferred fields, so we need to
+        # update the document (keeping them) instead of replacing it
+        return 'deferred' not in stored_data and deferred_fields(obj.__class__)
+
+    def save(self, obj, data=None):
+        """Required functionality."""
+        stored_data = self._stored_data(obj, data)
 
         coll = self.get_collection(obj.__class__.get_table_name())
-        coll.update({"_id": obj.id}, stored_data, upsert=True)
+        if self._keeps_deferred(obj, stored_data):
+            updates = dict(stored_data)
+            del updates['_id']
+            coll.update_one({"_id": obj.id}, {"$set": updates}, upsert=True)
+        else:
+            coll.update({"_id": obj.id}, stored_data, upsert=True)
+
+    def update_fields(self, obj, data, changes):
+        """Update only the changed top-level fields of a saved instance.
+
+        We $set each changed field under value (index fields are always
+        updated). Field names that can't be used in a $set path, or a missing
+        document, mean a full save instead.
+        """
+        if any('.' in name or name.startswith('$') for name in changes):
+            return self.save(obj, data)
+
+        updates = dict(('value.' + name, val) for name, val in changes.items())
+        updates.update(_index_fields(obj))
+
+        coll = self.get_collection(obj.__class__.get_table_name())
+        result = coll.update_one({"_id": obj.id}, {"$set": updates})
+        if not result.matched_count:
+            self.save(obj, data)
+
+    def save_many(self, objs, data_list=None):
+        """Save all instances with one bulk_write per collection."""
+        for cls, group in group_by_class(objs, data_list):
+            requests = []
+            for obj, data in group:
+                stored_data = self._stored_data(obj, data)
+                if self._keeps_deferred(obj, stored_data):
+                    updates = dict(stored_data)
+                    del updates['_id']
+                    requests.append(UpdateOne(
+                        {"_id": obj.id}, {"$set": updates}, upsert=True
+                    ))
+                else:
+                    requests.append(
+                        ReplaceOne({"_id": obj.id}, stored_data, upsert=True)
+                    )
+
+            coll = self.get_collection(cls.get_table_name())
+            coll.bulk_write(requests, ordered=True)
 
     def delete(self, obj):
         """Required functionality."""
@@ -93,3 +338,11 @@ class Backend(object):
 
         coll = self.get_collection(obj.__class__.get_table_name())
         coll.delete_one({"_id": del_id})
+
+    def delete_many(self, objs):
+        """Delete all instances with one delete_many per collection."""
+        for cls, group in group_by_class(objs):
+            del_ids = [obj.get_id() for obj, _ in group if obj.get_id()]
+            if del_ids:
+                coll = self.get_collection(cls.get_table_name())
+                coll.delete_many({"_id": {"$in": del_ids}})
@@ -2,11 +2,69 @@
 
 # pylama:ignore=E501
 
+import datetime
 import threading
 
 import psycopg2
 
-from ..utils import uuid
+from ..utils import uuid, chunked, group_by_class
+from ..query import (
+    sql_condition,
+    sql_keyset,
+    as_predicate,
+    typed_predicate,
+    index_value,
+    json_type,
+)
+from ..serializers import dumps, loads
+from ..data import (
+    from_stored,
+    composite_indexes,
+    index_types,
+    deferred_fields,
+    split_deferred,
+    index_type_error,
+    many_in_order,
+)
+
+# Rows per multi-row insert statement in save_many
+MAX_BATCH_ROWS = 500
+
+# Rows fetched per round trip when streaming from a server-side cursor
+ITER_SIZE = 1000
+
+
+# Column types for typed indexes (see gludb.query.INDEX_TYPES)
+_COLUMN_TYPES = {
+    str: 'text',
+    int: 'bigint',
+    float: 'double precision',
+    datetime.datetime: 'timestamp',
+}
+
+# How information_schema.columns names those types (if different)
+_SCHEMA_TYPES = {
+    'timestamp': 'timestamp without time zone',
+}
+
+
+def _index_param(val):
+    # Index columns are text, and Postgres won't compare text with numbers
+    return val if val is None else str(val)
+
+
+def _index_values(obj, index_names):
+    # Values for the index columns: typed indexes are converted to their
+    # types (psycopg2 adapts ints, floats, and datetimes for us)
+    index_vals = obj.indexes() or {}
+    types = index_types(obj.__class__)
+    values = []
+    for name in index_names:
+        if types[name] is str:
+            values.append(index_vals.get(name, 'NULL'))
+        else:
+            values.append(index_value(index_vals.get(name, None), types[name]))
+    return values
 
 
 class Backend(object):
@@ -21,9 +79,9 @@ class Backend(object):
         # We technically don't need a conn per thread (since psycopg2 is
         # thread-safe), but this should give us a balance between a connection
         # per request (lots of TCP/SSL connections) and one global connection
-        # (all transactions for this process get serialized)
+        # (all transactions for this process get serialized). Connections
+        # are opened as each thread needs one
         self.thread_local = threading.local()
-        self._conn()
 
     def _conn(self):
         conn = getattr(self.thread_local, "conn", None)
@@ -38,12 +96,16 @@ class Backend(object):
         """Ensure table's existence - as per the gludb spec."""
         id_len = len(uuid())
         index_names = cls.index_names() or []
+        types = index_types(cls)
         cols = [
             'id char(%d) primary key' % (id_len,),
             'value jsonb'
         ] + [
-            name + ' text' for name in index_names
+            name + ' ' + _COLUMN_TYPES[types[name]] for name in index_names
         ]
+        has_deferred = bool(deferred_fields(cls))
+        if has_deferred:
+            cols.append('deferred jsonb')
 
         table_name = cls.get_table_name()
 
@@ -53,78 +115,441 @@ class Backend(object):
                     table_name,
                     ','.join(cols)
                 ))
+                if has_deferred:
+                    # Tables created before the class had deferred fields
+                    cur.execute(
+                        'alter table %s add column if not exists '
+                        'deferred jsonb;' % (table_name,)
+                    )
+                self._check_index_columns(cur, cls)
                 for name in index_names:
                     cur.execute('create index if not exists %s on %s(%s);' % (
                         table_name + '_' + name + '_idx',
                         table_name,
                         name
                     ))
+                for names in composite_indexes(cls):
+                    cur.execute('create index if not exists %s on %s(%s);' % (
+                        table_name + '_' + '_'.join(names) + '_idx',
+                        table_name,
+                        ','.join(names)
+                    ))
         # End of conn with - transction should commit here if not exception
 
+    def _check_index_columns(self, cur, cls):
+        """Raise IndexTypeError if an index column has the wrong type.
+
+        Tables created before an index had its type have a text column,
+        and Postgres won't compare text with the typed query parameters.
+        """
+        types = index_types(cls)
+        cur.execute(
+            'select column_name, data_type from information_schema.columns '
+            'where table_schema = current_schema() and table_name = %s;',
+            (cls.get_table_name().lower(),)
+        )
+        column_types = dict(cur.fetchall())
+        for name in cls.index_names() or []:
+            wanted = _COLUMN_TYPES[types[name]]
+            wanted = _SCHEMA_TYPES.get(wanted, wanted)
+            stored = column_types.get(name.lower(), None)
+            if stored is not None and stored != wanted:
+                raise index_type_error(cls, name, stored)
+
     def find_one(self, cls, id):
         """Find single keyed row - as per the gludb spec."""
         found = self.find_by_index(cls, 'id', id)
         return found[0] if found else None
 
-    def find_all(self, cls):
+    def find_all(self, cls, limit=None, after=None, order_by=None):
         """Find all rows - as per the gludb spec."""
-        return self.find_by_index(cls, '1', 1)
+        return self._find_rows(cls, [], [], limit, after, order_by)
+
+    def iter_all(self, cls, limit=None, after=None, order_by=None):
+        """Yield all rows - as per the gludb spec."""
+        return self._iter_rows(cls, [], [], limit, after, order_by)
 
-    def find_by_index(self, cls, index_name, value):
+    def find_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
         """Find all rows matching index query - as per the gludb spec."""
-        cur = self._conn().cursor()
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._find_rows(cls, [cond], params, limit, after, order_by)
+
+    def iter_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
+        """Yield all rows matching index query - as per the gludb spec."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._iter_rows(cls, [cond], params, limit, after, order_by)
+
+    def find_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Find all rows matching all the index values (see Database)."""
+        conds, params = self._indexes_conditions(cls, index_values)
+        return self._find_rows(cls, conds, params, limit, after, order_by)
+
+    def iter_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Yield all rows matching all the index values (see Database)."""
+        conds, params = self._indexes_conditions(cls, index_values)
+        return self._iter_rows(cls, conds, params, limit, after, order_by)
+
+    def _indexes_conditions(self, cls, index_values):
+        """Return (conditions, params) for a dict of index values."""
+        conds, params = [], []
+        for name in sorted(index_values):
+            cond, cond_params = self._index_condition(
+                cls, name, index_values[name]
+            )
+            conds.append(cond)
+            params += cond_params
+        return conds, params
+
+    def find_where(self, cls, where, limit=None, after=None, order_by=None):
+        """Find rows whose stored fields match where (see Database)."""
+        conds, params = self._where_conditions(where)
+        return self._find_rows(cls, conds, params, limit, after, order_by)
+
+    def iter_where(self, cls, where, limit=None, after=None, order_by=None):
+        """Yield rows whose stored fields match where (see Database)."""
+        conds, params = self._where_conditions(where)
+        return self._iter_rows(cls, conds, params, limit, after, order_by)
+
+    def _where_conditions(self, where):
+        """Return (conditions, params) for the where of find_where.
+
+        Equality with a scalar uses containment (value @> '{"field": ...}'),
+        which a GIN index on value can serve. Containment would also match
+        longer arrays and objects with more keys, so arrays and objects (and
+        other predicates) compare value->'field' as jsonb, which an
+        expression index can serve. jsonb orders values
+        of different types too (e.g. every string is greater than every
+        number), so ordering comparisons also check the field's type.
+        """
+        conds, params = [], []
+        for name in sorted(where):
+            pred = as_predicate(where[name])
+            if pred.op == 'eq' and pred.values[0] is None:
+                conds.append(
+                    "(value->%s is null or value->%s = 'null'::jsonb)"
+                )
+                params += [name, name]
+            elif pred.op == 'eq' and json_type(pred.values[0]) in (
+                'array', 'object'
+            ):
+                conds.append('value->%s = %s::jsonb')
+                params += [name, dumps(pred.values[0])]
+            elif pred.op == 'eq':
+                conds.append('value @> %s::jsonb')
+                params.append(dumps({name: pred.values[0]}))
+            else:
+                cond, cond_params = sql_condition(
+                    'value->%s', pred, '%s::jsonb', dumps
+                )
+                conds.append(cond)
+                params += [name] + cond_params
+                if pred.op != 'one_of':  # jsonb equality checks the type
+                    for operand in cond_params:
+                        conds.append(
+                            'jsonb_typeof(value->%s) = jsonb_typeof(%s::jsonb)'
+                        )
+                        params += [name, operand]
+        return conds, params
+
+    def iter_fields_all(self, cls, fields, limit=None, after=None,
+                        order_by=None):
+        """Yield (id, field values) for all rows (see Database)."""
+        return self._iter_rows(cls, [], [], limit, after, order_by, fields)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields,
+                             limit=None, after=None, order_by=None):
+        """Yield (id, field values) for rows matching index query."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._iter_rows(
+            cls, [cond], params, limit, after, order_by, fields
+        )
+
+    def iter_ids_by_index(self, cls, index_name, value, limit=None,
+                          after=None, order_by=None):
+        """Yield the ids of rows matching index query (value isn't read)."""
+        cond, params = self._index_condition(cls, index_name, value)
+        rows = self._iter_rows(
+            cls, [cond], params, limit, after, order_by, []
+        )
+        return (id for id, _ in rows)
+
+    def _index_condition(self, cls, index_name, value):
+        """Return (condition, params) for an index value or predicate.
+
+        Values for typed indexes are converted to the index's type, and
+        everything else is compared as text.
+        """
+        index_type = index_types(cls).get(index_name, str)
+        if index_type is str:
+            return sql_condition(index_name, value, '%s', _index_param)
+        pred = typed_predicate(value, index_type)
+        return sql_condition(index_name, pred, '%s')
+
+    def _find_rows(self, cls, conds, params, limit, after, order_by,
+                   fields=None):
+        """Return a list of objects for rows matching all of conds.
+
+        Like _iter_rows, but the result is read all at once with a plain
+        (client-side) cursor: a server-side cursor costs extra round trips
+        to declare, fetch from, and close it.
+        """
+        query, params = self._rows_query(
+            cls, conds, params, limit, after, order_by, fields
+        )
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+        return [self._row_result(cls, row, fields) for row in rows]
+
+    def _iter_rows(self, cls, conds, params, limit, after, order_by,
+                   fields=None):
+        """Yield objects for rows matching all of conds (with params).
+
+        We use a named (server-side) cursor so that only ITER_SIZE rows are
+        in memory at a time. The cursor is declared WITH HOLD so that saves
+        made while iterating (which commit) don't invalidate it. See
+        _rows_query for the other parameters.
+        """
+        query, params = self._rows_query(
+            cls, conds, params, limit, after, order_by, fields
+        )
+        with self._conn() as conn:
+            cur_name = 'gludb_iter_' + uuid()
+            with conn.cursor(name=cur_name, withhold=True) as cur:
+                cur.itersize = ITER_SIZE
+                cur.execute(query, params)
+                for row in cur:
+                    yield self._row_result(cls, row, fields)
+
+    def _rows_query(self, cls, conds, params, limit, after, order_by,
+                    fields):
+        """Return (query, params) to select the rows matching all of conds.
+
+        If any of limit, after, or order_by are given, rows are ordered by
+        order_by (an index name with NULLs first, ties broken by id) or id,
+        and start after the (id, sort value) tuple after.
+
+        If fields is given, rows are (id, field values) instead, with the
+        fields extracted from the jsonb value by the server (the value isn't
+        read at all if fields is empty).
+        """
+        conds, params = list(conds), list(params)
+
+        sort_col = order_by if order_by not in (None, 'id') else None
+        if after is not None:
+            after_id, after_val = after
+            if sort_col:
+                if index_types(cls).get(sort_col, str) is str:
+                    after_val = _index_param(after_val)
+                keyset, keyset_params = sql_keyset(
+                    sort_col, after_id, after_val, '%s'
+                )
+                conds.append(keyset)
+                params += keyset_params
+            else:
+                conds.append('id > %s')
+                params.append(after_id)
 
         # psycopg2 supports using Python formatters for queries
-        # we also request our JSON as a string for the from_data calls
-        query = 'select id, value::text from {0} where {1} = %s;'.format(
+        # we also request our JSON as a string for the from_stored calls
+        if fields is None:
+            cols = 'id, value::text'
+        elif fields:
+            cols = 'id, jsonb_build_array(%s)::text' % ', '.join(
+                ['value->%s'] * len(fields)
+            )
+            params = list(fields) + params
+        else:
+            cols = 'id, null'
+        query = 'select ' + cols + ' from ' + cls.get_table_name()
+        if conds:
+            query += ' where ' + ' and '.join(conds)
+        if sort_col:
+            query += ' order by {0} nulls first, id'.format(sort_col)
+        elif order_by or limit is not None or after is not None:
+            query += ' order by id'
+        if limit is not None:
+            query += ' limit %s'
+            params.append(limit)
+
+        return query + ';', tuple(params)
+
+    def _row_result(self, cls, row, fields):
+        """Return the object (or (id, field values)) for a selected row."""
+        id, data = str(row[0]).strip(), row[1]
+        if fields is None:
+            return from_stored(cls, data)
+        elif fields:
+            return id, dict(zip(fields, loads(data)))
+        return id, {}
+
+    def count_all(self, cls):
+        """Return the number of rows without reading them."""
+        return self._count_rows(cls, [], [])
+
+    def count_by_index(self, cls, index_name, value):
+        """Return the number of rows matching index query."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._count_rows(cls, [cond], params)
+
+    def _count_rows(self, cls, conds, params):
+        query = 'select count(*) from ' + cls.get_table_name()
+        if conds:
+            query += ' where ' + ' and '.join(conds)
+
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query + ';', tuple(params))
+                return cur.fetchone()[0]
+
+    def exists(self, cls, id):
+        """Return True if there is a row with the id (value isn't read)."""
+        query = 'select 1 from %s where id = %%s limit 1;' % (
             cls.get_table_name(),
-            index_name
         )
 
-        found = []
         with self._conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(query, (value,))
+                cur.execute(query, (id,))
+                return cur.fetchone() is not None
+
+    def find_many(self, cls, ids):
+        """Find rows for all the given ids, returned in the same order."""
+        query = 'select id, value::text from {0} where id = any(%s);'.format(
+            cls.get_table_name()
+        )
+
+        found = dict()
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (list(set(ids)),))
                 for row in cur:
                     id, data = str(row[0]).strip(), row[1]
-                    obj = cls.from_data(data)
-                    assert id == obj.id
-                    found.append(obj)
+                    obj = from_stored(cls, data)
+                    found[id] = obj
 
-        return found
+        return many_in_order(cls, ids, found)
 
-    def save(self, obj):
-        """Save current instance - as per the gludb spec."""
-        cur = self._conn().cursor()
+    def find_deferred(self, cls, ids):
+        """Return the stored deferred field values for the ids."""
+        query = (
+            'select id, deferred::text from {0} '
+            'where id = any(%s) and deferred is not null;'
+        ).format(cls.get_table_name())
 
-        tabname = obj.__class__.get_table_name()
+        found = dict()
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (list(set(ids)),))
+                for row in cur:
+                    found[str(row[0]).strip()] = loads(row[1])
 
-        index_names = obj.__class__.index_names() or []
+        return found
+
+    def _save_query(self, cls, row_count=1):
+        index_names = cls.index_names() or []
 
         col_names = ['id', 'value'] + index_names
-        value_holders = ['%s'] * len(col_names)
         updates = ['%s = EXCLUDED.%s' % (cn, cn) for cn in col_names[1:]]
+        if deferred_fields(cls):
+            # A null means the instance never loaded its deferred fields, so
+            # we keep the ones already stored
+            col_names.append('deferred')
+            updates.append(
+                'deferred = coalesce(EXCLUDED.deferred, %s.deferred)' % (
+                    cls.get_table_name(),
+                )
+            )
+        row_holder = '(%s)' % ','.join(['%s'] * len(col_names))
+
+        query = 'insert into {0} ({1}) values {2} on conflict(id) do update set {3};'.format(
+            cls.get_table_name(),
+            ','.join(col_names),
+            ','.join([row_holder] * row_count),
+            ','.join(updates),
+        )
+
+        return query, index_names
 
+    def _save_values(self, obj, index_names, data=None):
         if not obj.id:
             id = uuid()
             obj.id = id
 
-        query = 'insert into {0} ({1}) values ({2}) on conflict(id) do update set {3};'.format(
-            tabname,
-            ','.join(col_names),
-            ','.join(value_holders),
-            ','.join(updates),
-        )
+        if data is None:
+            data = obj.to_data()
+        data, deferred = split_deferred(obj.__class__, data)
+
+        values = [obj.id, data]
+        values += _index_values(obj, index_names)
+        if deferred_fields(obj.__class__):
+            values.append(deferred)
 
-        values = [obj.id, obj.to_data()]
+        return values
 
-        index_vals = obj.indexes() or {}
-        values += [index_vals.get(name, 'NULL') for name in index_names]
+    def save(self, obj, data=None):
+        """Save current instance - as per the gludb spec."""
+        query, index_names = self._save_query(obj.__class__)
+        values = self._save_values(obj, index_names, data)
 
         with self._conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(query, tuple(values))
 
+    def update_fields(self, obj, data, changes):
+        """Update only the changed top-level fields of a saved instance.
+
+        The changes are merged into the stored document with jsonb's ||
+        operator (index columns are always updated). If there isn't a row to
+        update, we fall back to a full save.
+        """
+        cls = obj.__class__
+        index_names = cls.index_names() or []
+
+        sets = ['value = value || %s::jsonb']
+        sets += ['%s = %%s' % name for name in index_names]
+        query = 'update {0} set {1} where id = %s;'.format(
+            cls.get_table_name(),
+            ','.join(sets)
+        )
+
+        values = [dumps(changes)]
+        values += _index_values(obj, index_names)
+        values.append(obj.id)
+
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, tuple(values))
+                updated = cur.rowcount
+
+        if not updated:
+            self.save(obj, data)
+
+    def save_many(self, objs, data_list=None):
+        """Save all instances with multi-row upserts in one transaction."""
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                for cls, group in group_by_class(objs, data_list):
+                    # A single upsert can't touch the same row twice, so the
+                    # last instance for any id wins
+                    by_id = dict()
+                    for obj, data in group:
+                        if not obj.id:
+                            obj.id = uuid()
+                        by_id[obj.id] = (obj, data)
+
+                    for chunk in chunked(by_id.values(), MAX_BATCH_ROWS):
+                        query, index_names = self._save_query(cls, len(chunk))
+                        values = []
+                        for obj, data in chunk:
+                            values += self._save_values(obj, index_names, data)
+                        cur.execute(query, tuple(values))
+
     def delete(self, obj):
         """Required functionality."""
         del_id = obj.get_id()
@@ -139,3 +564,16 @@ class Backend(object):
         with self._conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(query, (del_id,))
+
+    def delete_many(self, objs):
+        """Delete all instances in one transaction."""
+        with self._conn() as conn:
+            with conn.cursor() as cur:
+                for cls, group in group_by_class(objs):
+                    del_ids = [o.get_id() for o, _ in group if o.get_id()]
+                    if not del_ids:
+                        continue
+                    query = 'delete from {0} where id = any(%s);'.format(
+                        cls.get_table_name()
+                    )
+                    cur.execute(query, (del_ids,))
@@ -2,11 +2,119 @@
 
 # pylama:ignore=E501
 
+import datetime
 import threading
 
 import sqlite3
 
-from ..utils import uuid
+from collections import OrderedDict
+
+from ..utils import uuid, chunked, group_by_class, pick_fields
+from ..query import (
+    sql_condition,
+    sql_keyset,
+    as_predicate,
+    typed_predicate,
+    index_value,
+    json_type,
+    one_of,
+)
+from ..data import (
+    from_stored,
+    composite_indexes,
+    filter_where,
+    index_types,
+    deferred_fields,
+    split_deferred,
+    index_type_error,
+    many_in_order,
+)
+from ..serializers import loads, stores_json, encode_payload, payload_values
+
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER (999 in older builds)
+MAX_QUERY_VARS = 500
+
+# Rows read per query when iterating over query results
+ITER_PAGE_SIZE = 1000
+
+
+# Column types for typed indexes (see gludb.query.INDEX_TYPES)
+_COLUMN_TYPES = {
+    str: 'text',
+    int: 'integer',
+    float: 'real',
+    datetime.datetime: 'timestamp',
+}
+
+
+# The json_type names for each gludb.query.json_type
+_SQLITE_JSON_TYPES = {
+    'null': ('null',),
+    'boolean': ('true', 'false'),
+    'number': ('integer', 'real'),
+    'string': ('text',),
+    'array': ('array',),
+    'object': ('object',),
+}
+
+
+def _column_value(val):
+    # SQLite doesn't have a timestamp type, so timestamps are stored as text
+    # that sorts in time order
+    if isinstance(val, datetime.datetime):
+        return val.strftime('%Y-%m-%d %H:%M:%S.%f')
+    return val
+
+
+def json_path(field_name):
+    """Return the SQLite JSON path for a top-level field."""
+    return '$."%s"' % field_name
+
+
+def _type_condition(field_name, operand):
+    # Return (condition, params) checking that a field has operand's type
+    sqlite_types = _SQLITE_JSON_TYPES[json_type(operand)]
+    cond = 'json_type(value,?) in (%s)' % ','.join('?' * len(sqlite_types))
+    return cond, [json_path(field_name)] + list(sqlite_types)
+
+
+def _field_condition(field_name, pred):
+    # Return (condition, params) for a find_where predicate on a field with
+    # scalar operands. one_of operands are grouped by type, and each group
+    # only matches fields of that type
+    path = json_path(field_name)
+    column = 'json_extract(value,?)'
+
+    if pred.op == 'one_of':
+        groups = OrderedDict()
+        for operand in pred.values:
+            groups.setdefault(json_type(operand), []).append(operand)
+        if not groups:
+            return '1 = 0', []
+
+        conds, params = [], []
+        for operands in groups.values():
+            if operands[0] is None:
+                conds.append('%s is null' % column)
+                params.append(path)
+                continue
+            type_cond, type_params = _type_condition(field_name, operands[0])
+            cond, cond_params = sql_condition(column, one_of(operands))
+            conds.append('(%s and %s)' % (type_cond, cond))
+            params += type_params + [path] + cond_params
+        return '(%s)' % ' or '.join(conds), params
+
+    if pred.op == 'eq' and pred.values[0] is None:
+        return '%s is null' % column, [path]
+
+    cond, params = sql_condition(column, pred)
+    conds, params = [cond], [path] + params
+    if None not in pred.values:
+        for operand in pred.values:
+            type_cond, type_params = _type_condition(field_name, operand)
+            conds.append(type_cond)
+            params += type_params
+    return ' and '.join(conds), params
 
 
 class Backend(object):
@@ -19,10 +127,13 @@ class Backend(object):
             raise ValueError('sqlite backend requires a filename parameter')
 
         # sqlite requires one connection per thread in Python
-        # We set up our thread local storage and init the connection
+        # We set up our thread local storage - connections are opened as
+        # each thread needs one
         self.tl_count = 0
         self.thread_local = threading.local()
-        self._conn()
+
+        # Whether this SQLite has the JSON functions (checked when needed)
+        self.json_functions = None
 
     def _conn(self):
         conn = getattr(self.thread_local, "conn", None)
@@ -39,6 +150,22 @@ class Backend(object):
 
         return conn
 
+    def _has_json(self):
+        has_json = self.json_functions
+        if has_json is None:
+            try:
+                self._conn().execute('select json_array()').fetchone()
+                has_json = True
+            except sqlite3.OperationalError:
+                has_json = False
+            self.json_functions = has_json
+        return has_json
+
+    def _json_values(self, cls):
+        # True if SQLite can read fields from the stored values of cls (they
+        # need to be uncompressed JSON, and we need the JSON functions)
+        return self._has_json() and stores_json(cls)
+
     def ensure_table(self, cls):
         """Ensure table's existence - as per the gludb spec."""
         cur = self._conn().cursor()
@@ -46,15 +173,37 @@ class Backend(object):
         table_name = cls.get_table_name()
         index_names = cls.index_names() or []
 
+        types = index_types(cls)
         cols = ['id text primary key', 'value text']
         for name in index_names:
-            cols.append(name + ' text')
+            cols.append(name + ' ' + _COLUMN_TYPES[types[name]])
+
+        has_deferred = bool(deferred_fields(cls))
+        if has_deferred:
+            cols.append('deferred text')
 
         cur.execute('create table if not exists %s (%s)' % (
             table_name,
             ','.join(cols)
         ))
 
+        table_info = cur.execute('pragma table_info(%s)' % table_name)
+        column_types = dict((row[1], row[2].lower()) for row in table_info)
+
+        # Tables created before the class had deferred fields need the column
+        if has_deferred and 'deferred' not in column_types:
+            cur.execute('alter table %s add column deferred text' % (
+                table_name,
+            ))
+
+        # Tables created before an index had its type have the wrong column
+        # type (which SQLite would use to compare values as text)
+        for name in index_names:
+            stored = column_types.get(name, None)
+            if stored is not None and stored != _COLUMN_TYPES[types[name]]:
+                cur.close()
+                raise index_type_error(cls, name, stored)
+
         for name in index_names:
             cur.execute('create index if not exists %s on %s(%s)' % (
                 table_name + '_' + name + '_idx',
@@ -62,6 +211,13 @@ class Backend(object):
                 name
             ))
 
+        for names in composite_indexes(cls):
+            cur.execute('create index if not exists %s on %s(%s)' % (
+                table_name + '_' + '_'.join(names) + '_idx',
+                table_name,
+                ','.join(names)
+            ))
+
         self._conn().commit()
         cur.close()
 
@@ -70,61 +226,338 @@ class Backend(object):
         found = self.find_by_index(cls, 'id', id)
         return found[0] if found else None
 
-    def find_all(self, cls):
+    def find_all(self, cls, limit=None, after=None, order_by=None):
         """Find all rows - as per the gludb spec."""
-        return self.find_by_index(cls, '1', 1)
+        return list(self.iter_all(cls, limit, after, order_by))
+
+    def iter_all(self, cls, limit=None, after=None, order_by=None):
+        """Yield all rows - as per the gludb spec."""
+        return self._iter_rows(cls, [], [], limit, after, order_by)
 
-    def find_by_index(self, cls, index_name, value):
+    def find_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
         """Find all rows matching index query - as per the gludb spec."""
-        cur = self._conn().cursor()
+        return list(self.iter_by_index(
+            cls, index_name, value, limit, after, order_by
+        ))
+
+    def iter_by_index(self, cls, index_name, value, limit=None, after=None,
+                      order_by=None):
+        """Yield all rows matching index query - as per the gludb spec."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._iter_rows(cls, [cond], params, limit, after, order_by)
+
+    def find_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Find all rows matching all the index values (see Database)."""
+        return list(self.iter_by_indexes(
+            cls, index_values, limit, after, order_by
+        ))
 
-        query = 'select id,value from %s where %s = ?' % (
+    def iter_by_indexes(self, cls, index_values, limit=None, after=None,
+                        order_by=None):
+        """Yield all rows matching all the index values (see Database)."""
+        conds, params = [], []
+        for name in sorted(index_values):
+            cond, cond_params = self._index_condition(
+                cls, name, index_values[name]
+            )
+            conds.append(cond)
+            params += cond_params
+        return self._iter_rows(cls, conds, params, limit, after, order_by)
+
+    def iter_where(self, cls, where, limit=None, after=None, order_by=None):
+        """Yield rows whose stored fields match where (see Database).
+
+        Fields are read with json_extract. SQLite compares values of
+        different types too (and JSON booleans are extracted as 1 and 0), so
+        we also check each field's json_type against the operands' type.
+        Array and object operands can't be compared in SQL, so those fields
+        are checked as the rows are read (as are all fields for older SQLite
+        builds without the JSON functions and for classes stored in a binary
+        or compressed format).
+        """
+        if not self._json_values(cls):
+            objs = self._iter_rows(cls, [], [], None, after, order_by)
+            return filter_where(objs, where, limit)
+
+        conds, params, client_where = [], [], {}
+        for name in sorted(where):
+            pred = as_predicate(where[name])
+            if any(json_type(v) in ('array', 'object') for v in pred.values):
+                client_where[name] = pred
+                continue
+            cond, cond_params = _field_condition(name, pred)
+            conds.append(cond)
+            params += cond_params
+
+        if client_where:
+            objs = self._iter_rows(cls, conds, params, None, after, order_by)
+            return filter_where(objs, client_where, limit)
+        return self._iter_rows(cls, conds, params, limit, after, order_by)
+
+    def iter_fields_all(self, cls, fields, limit=None, after=None,
+                        order_by=None):
+        """Yield (id, field values) for all rows (see Database)."""
+        return self._iter_rows(cls, [], [], limit, after, order_by, fields)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields,
+                             limit=None, after=None, order_by=None):
+        """Yield (id, field values) for rows matching index query."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._iter_rows(
+            cls, [cond], params, limit, after, order_by, fields
+        )
+
+    def iter_ids_by_index(self, cls, index_name, value, limit=None,
+                          after=None, order_by=None):
+        """Yield the ids of rows matching index query (value isn't read)."""
+        cond, params = self._index_condition(cls, index_name, value)
+        rows = self._iter_rows(
+            cls, [cond], params, limit, after, order_by, []
+        )
+        return (id for id, _ in rows)
+
+    def _index_condition(self, cls, index_name, value):
+        """Return (condition, params) for an index value or predicate.
+
+        Typed index values are converted for their columns. String indexes
+        pass values through as they always have (SQLite converts them for
+        the text column).
+        """
+        index_type = index_types(cls).get(index_name, str)
+        if index_type is not str:
+            value = typed_predicate(value, index_type, _column_value)
+        return sql_condition(index_name, value)
+
+    def _iter_rows(self, cls, conds, params, limit, after, order_by,
+                   fields=None):
+        """Yield objects for rows matching all of conds (with params).
+
+        If fields is given, we yield (id, field values) tuples instead, with
+        the fields extracted by SQLite's JSON functions (the value isn't read at
+        all if fields is empty). Older SQLite builds without the JSON functions
+        (and classes stored in a binary or compressed format) read the whole
+        value.
+
+        Rows are returned ordered by order_by (an index name with NULLs first,
+        ties broken by id) or by id. We read ITER_PAGE_SIZE rows at a time,
+        using the sort value and id of the last row seen to start the next
+        page (starting after the given (id, sort value) tuple if there is
+        one). A single
+        long-running select isn't safe here: "insert or replace" deletes and
+        re-inserts a row, so a save made while iterating could make the scan
+        see that row again.
+        """
+        json_fields = bool(fields) and self._json_values(cls)
+        if fields is None or (fields and not json_fields):
+            cols, col_params = 'id,value', []
+        elif json_fields:
+            cols = 'id,json_array(%s)' % ','.join(
+                ['json_extract(value,?)'] * len(fields)
+            )
+            col_params = [json_path(name) for name in fields]
+        else:
+            cols, col_params = 'id,null', []
+
+        sort_col = order_by if order_by not in (None, 'id') else None
+        if sort_col:
+            cols += ',' + sort_col
+            order = sort_col + ',id'  # SQLite sorts NULLs first
+        else:
+            order = 'id'
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = ITER_PAGE_SIZE
+            if remaining is not None:
+                page_size = min(page_size, remaining)
+
+            page_conds, page_params = list(conds), list(params)
+            if after is not None:
+                after_id, after_val = after
+                if sort_col:
+                    keyset, keyset_params = sql_keyset(
+                        sort_col, after_id, _column_value(after_val)
+                    )
+                else:
+                    keyset, keyset_params = 'id > ?', [after_id]
+                page_conds.append(keyset)
+                page_params += keyset_params
+
+            query = 'select %s from %s %s order by %s limit ?' % (
+                cols,
+                cls.get_table_name(),
+                ('where ' + ' and '.join(page_conds)) if page_conds else '',
+                order
+            )
+
+            cur = self._conn().cursor()
+            query_params = col_params + page_params + [page_size]
+            rows = cur.execute(query, query_params).fetchall()
+            cur.close()
+
+            for row in rows:
+                id, data = row[0], row[1]
+                if fields is None:
+                    obj = from_stored(cls, data)
+                    yield obj
+                elif json_fields:
+                    yield id, dict(zip(fields, loads(data)))
+                elif fields:
+                    yield id, pick_fields(payload_values(data), fields)
+                else:
+                    yield id, {}
+
+            if len(rows) < page_size:
+                break
+            if remaining is not None:
+                remaining -= len(rows)
+
+            last = rows[-1]
+            after = (last[0], last[2] if sort_col else last[0])
+
+    def count_all(self, cls):
+        """Return the number of rows without reading them."""
+        return self._count_rows(cls, [], [])
+
+    def count_by_index(self, cls, index_name, value):
+        """Return the number of rows matching index query."""
+        cond, params = self._index_condition(cls, index_name, value)
+        return self._count_rows(cls, [cond], params)
+
+    def _count_rows(self, cls, conds, params):
+        query = 'select count(*) from %s %s' % (
             cls.get_table_name(),
-            index_name
+            ('where ' + ' and '.join(conds)) if conds else ''
         )
 
-        found = []
-        for row in cur.execute(query, (value,)):
-            id, data = row[0], row[1]
-            obj = cls.from_data(data)
-            assert id == obj.id
-            found.append(obj)
+        cur = self._conn().cursor()
+        count = cur.execute(query, params).fetchone()[0]
+        cur.close()
+
+        return count
 
+    def exists(self, cls, id):
+        """Return True if there is a row with the id (value isn't read)."""
+        query = 'select 1 from %s where id = ? limit 1' % cls.get_table_name()
+
+        cur = self._conn().cursor()
+        found = cur.execute(query, (id,)).fetchone()
         cur.close()
 
-        return found
+        return found is not None
 
-    def save(self, obj):
-        """Save current instance - as per the gludb spec."""
+    def find_many(self, cls, ids):
+        """Find rows for all the given ids, returned in the same order."""
         cur = self._conn().cursor()
 
-        tabname = obj.__class__.get_table_name()
+        found = dict()
+        for chunk in chunked(set(ids), MAX_QUERY_VARS):
+            query = 'select id,value from %s where id in (%s)' % (
+                cls.get_table_name(),
+                ','.join('?' * len(chunk))
+            )
+            for row in cur.execute(query, tuple(chunk)):
+                id, data = row[0], row[1]
+                obj = from_stored(cls, data)
+                found[id] = obj
 
-        index_names = obj.__class__.index_names() or []
+        cur.close()
+
+        return many_in_order(cls, ids, found)
+
+    def find_deferred(self, cls, ids):
+        """Return the deferred field values for ids (see Database)."""
+        cur = self._conn().cursor()
+
+        found = dict()
+        for chunk in chunked(set(ids), MAX_QUERY_VARS):
+            query = 'select id,deferred from %s where id in (%s)' % (
+                cls.get_table_name(),
+                ','.join('?' * len(chunk))
+            )
+            for id, deferred in cur.execute(query, tuple(chunk)):
+                if deferred is not None:
+                    found[id] = loads(deferred)
+
+        cur.close()
 
+        return found
+
+    def _save_query(self, cls):
+        index_names = cls.index_names() or []
         col_names = ['id', 'value'] + index_names
-        value_holders = ','.join(['?' * len(col_names)])
+        params = ['?'] * len(col_names)
+
+        # "insert or replace" replaces the whole row, so if we don't have
+        # deferred data for an object we keep what's there
+        if deferred_fields(cls):
+            col_names.append('deferred')
+            params.append('coalesce(?, (select deferred from %s where id = ?))' % (
+                cls.get_table_name(),
+            ))
+
+        query = 'insert or replace into %s (%s) values (%s)' % (
+            cls.get_table_name(),
+            ','.join(col_names),
+            ','.join(params)
+        )
 
+        return query, index_names
+
+    def _save_values(self, obj, index_names, data=None):
         if not obj.id:
             id = uuid()
             obj.id = id
 
-        query = 'insert or replace into %s (%s) values (%s)' % (
-            tabname,
-            ','.join(col_names),
-            ','.join(value_holders)
-        )
+        if data is None:
+            data = obj.to_data()
+        data, deferred = split_deferred(obj.__class__, data)
 
-        values = [obj.id, obj.to_data()]
+        payload = encode_payload(obj.__class__, data)
+        if isinstance(payload, bytearray):
+            payload = sqlite3.Binary(payload)
+        values = [obj.id, payload]
 
         index_vals = obj.indexes() or {}
-        values += [index_vals.get(name, 'NULL') for name in index_names]
+        types = index_types(obj.__class__)
+        for name in index_names:
+            if types[name] is str:
+                values.append(index_vals.get(name, 'NULL'))
+            else:
+                values.append(_column_value(
+                    index_value(index_vals.get(name, None), types[name])
+                ))
 
-        cur.execute(query, tuple(values))
+        if deferred_fields(obj.__class__):
+            values += [deferred, obj.id]
+
+        return tuple(values)
+
+    def save(self, obj, data=None):
+        """Save current instance - as per the gludb spec."""
+        cur = self._conn().cursor()
+
+        query, index_names = self._save_query(obj.__class__)
+        cur.execute(query, self._save_values(obj, index_names, data))
         self._conn().commit()
 
         cur.close()
 
+    def save_many(self, objs, data_list=None):
+        """Save all instances in a single transaction."""
+        with self._conn() as conn:
+            cur = conn.cursor()
+            for cls, group in group_by_class(objs, data_list):
+                query, index_names = self._save_query(cls)
+                cur.executemany(query, [
+                    self._save_values(obj, index_names, data)
+                    for obj, data in group
+                ])
+            cur.close()
+        # End of conn with - transction should commit here if not exception
+
     def delete(self, obj):
         """Required functionality."""
         del_id = obj.get_id()
@@ -139,3 +572,14 @@ class Backend(object):
 
         self._conn().commit()
         cur.close()
+
+    def delete_many(self, objs):
+        """Delete all instances in a single transaction."""
+        with self._conn() as conn:
+            cur = conn.cursor()
+            for cls, group in group_by_class(objs):
+                query = 'delete from %s where id = ?' % cls.get_table_name()
+                cur.executemany(query, [
+                    (obj.get_id(),) for obj, _ in group if obj.get_id()
+                ])
+            cur.close()
@@ -13,14 +13,14 @@ from importlib import import_module
 from inspect import getmembers, isclass, getmro
 from tempfile import NamedTemporaryFile
 
-from boto.s3.connection import S3Connection, OrdinaryCallingFormat
-from boto.s3.key import Key
-
 from .utils import now_field
 from .config import get_mapping
 from .data import Storable
 from .simple import DBObject, Field
 
+# Note that boto is only imported when a backup is actually run, so importing
+# this module (e.g. to configure backups) doesn't pull it in
+
 # TODO: need the back to check for previous backups and only run if enough time
 #       has elapsed. Best way is probably: store json for backup after
 #       success. Then we read it back to get date/time of last backup
@@ -212,8 +212,15 @@ class Backup(object):
 
             rec_count = 0
 
+            # to_data only includes deferred fields that have been read, so
+            # we read them for all the records at once
+            recs = cls.find_all()
+            load_deferred = getattr(cls, 'load_deferred', None)
+            if load_deferred is not None:
+                load_deferred(recs)
+
             with NamedTemporaryFile() as record_file:
-                for rec in cls.find_all():
+                for rec in recs:
                     write_line(record_file, rec.to_data())
                     rec_count += 1
 
@@ -231,6 +238,9 @@ class Backup(object):
         key_name = ('Backup_' + now_field() + '.tar.gz').replace(':', '_')
 
         # upload archive to s3
+        from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+        from boto.s3.key import Key
+
         if os.environ.get('DEBUG', False) or os.environ.get('travis', False):
             # Local or CI - connect to our mock s3 service
             conn = S3Connection(
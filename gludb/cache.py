@@ -0,0 +1,362 @@
+"""Provide an optional read-through cache for gludb databases.
+
+A CachedDatabase wraps a gludb.config.Database and is configured in its
+place:
+
+    from gludb.config import Database, class_database
+    from gludb.cache import CachedDatabase
+
+    db = CachedDatabase(Database('sqlite', filename='app.sqlite'), ttl=60)
+    class_database(MyHotClass, db)
+
+Calls to find_one (and find_many) first check the cache. The cache holds the
+serialized data read from the database (keyed by table name and id), so every
+call still returns a new instance created by from_data - callers never share
+(or change) a cached object. Ids that aren't found are cached too, so repeated
+lookups for a missing object don't keep going to the database.
+
+Saves and deletes made through the CachedDatabase invalidate the entries for
+the objects involved. Note that changes made any other way (another process,
+or a Database instance that isn't wrapped) are NOT seen until an entry
+expires: use a ttl if that can happen. Everything else (find_all,
+find_by_index, ensure_table, etc) goes straight to the wrapped database.
+
+Each table gets its own LRU cache. The max_size and ttl given to
+CachedDatabase are the defaults for every class, and can be changed (or
+caching turned off) for a single class with configure.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from .data import Storable, from_stored, orig_version
+
+
+# Marks a cached miss (since None can't be cached data)
+class _NOT_FOUND(object):
+    pass
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded mapping with optional time-to-live.
+
+    When full, adding a key evicts the least recently used entry. If ttl (in
+    seconds) is given, entries older than ttl are treated as missing. Note
+    that expired entries aren't counted as evictions.
+    """
+
+    def __init__(self, max_size=1000, ttl=None, timer=time.time):
+        """Create an empty cache holding at most max_size entries."""
+        if max_size < 1:
+            raise ValueError('LRUCache max_size must be at least 1')
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key => (expiration, value)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Return the number of entries (which might include expired ones)."""
+        return len(self.entries)
+
+    def get(self, key):
+        """Return a tuple (found, value) for the given key."""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                expiration, value = entry
+                if expiration is None or expiration > self.timer():
+                    # Move to the end - the most recently used entry
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return True, value
+                del self.entries[key]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation=None):
+        """Add value for key, evicting the least recently used if necessary.
+
+        If generation is given, the value is only added if nothing has been
+        invalidated since generation was read (see current_generation).
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            expiration = None
+            if self.ttl is not None:
+                expiration = self.timer() + self.ttl
+
+            self.entries.pop(key, None)
+            self.entries[key] = (expiration, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def current_generation(self):
+        """Return a value that changes every time an entry is invalidated.
+
+        Read it before fetching a value to be cached, and pass it to put: a
+        value that was read before a concurrent invalidation won't be added.
+        """
+        with self.lock:
+            return self.generation
+
+    def invalidate(self, key):
+        """Remove the entry for key (if there is one)."""
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries (the counters aren't reset)."""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dictionary of the current counters."""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class CachedDatabase(object):
+    """Read-through cache in front of a gludb.config.Database instance."""
+
+    def __init__(self, db, max_size=1000, ttl=None, cache_misses=True):
+        """Wrap db, caching up to max_size objects per class for ttl seconds.
+
+        If ttl is None, entries only leave the cache when they're invalidated
+        or evicted. If cache_misses is False, ids that aren't found aren't
+        cached.
+        """
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_misses = cache_misses
+
+        self.lock = threading.Lock()
+        self.class_config = {}  # table name => config dict (None = no cache)
+        self.caches = {}  # table name => LRUCache
+        self.miss_caching = {}  # table name => cache_misses override
+
+    def __getattr__(self, name):
+        """Anything we don't cache is handled by the wrapped database."""
+        # Don't forward before __init__ sets db (e.g. during unpickling)
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def run_async(self, method_name, *args):
+        """Return an awaitable for one of our methods (see Database.run_async).
+
+        Our methods always run on the wrapped database's executor, so that
+        async calls are also cached.
+        """
+        return self.db.run_in_executor(getattr(self, method_name), *args)
+
+    def configure(self, cls, max_size=None, ttl=None, cache_misses=None,
+                  enabled=True):
+        """Override the cache settings for a single class.
+
+        Settings that are None use the CachedDatabase defaults. Any entries
+        already cached for the class are discarded.
+        """
+        table_name = cls.get_table_name()
+        if enabled:
+            config = {
+                'max_size': self.max_size if max_size is None else max_size,
+                'ttl': self.ttl if ttl is None else ttl,
+                'cache_misses': (
+                    self.cache_misses if cache_misses is None else cache_misses
+                ),
+            }
+        else:
+            config = None
+
+        with self.lock:
+            self.class_config[table_name] = config
+            if config is not None:
+                self.miss_caching[table_name] = config['cache_misses']
+            self.caches.pop(table_name, None)
+
+    def get_cache(self, cls):
+        """Return the LRUCache for the class (or None if it isn't cached)."""
+        table_name = cls.get_table_name()
+        cache = self.caches.get(table_name, None)
+        if cache is not None:
+            return cache
+
+        with self.lock:
+            cache = self.caches.get(table_name, None)
+            if cache is None:
+                config = self.class_config.get(table_name, {})
+                if config is None:
+                    return None
+                cache = LRUCache(
+                    max_size=config.get('max_size', self.max_size),
+                    ttl=config.get('ttl', self.ttl)
+                )
+                self.caches[table_name] = cache
+            return cache
+
+    def stats(self, cls=None):
+        """Return the cache counters for the class (or totals for all)."""
+        if cls is not None:
+            cache = self.get_cache(cls)
+            return cache.stats() if cache is not None else None
+
+        totals = {'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        with self.lock:
+            caches = list(self.caches.values())
+        for cache in caches:
+            for key, val in cache.stats().items():
+                totals[key] += val
+        return totals
+
+    def clear(self, cls=None):
+        """Discard cached entries for the class (or for all classes)."""
+        if cls is not None:
+            cache = self.get_cache(cls)
+            if cache is not None:
+                cache.clear()
+            return
+
+        with self.lock:
+            caches = list(self.caches.values())
+        for cache in caches:
+            cache.clear()
+
+    def _cache_loaded(self, cls, cache, generation, id, obj):
+        if obj is not None:
+            if orig_version(obj) is None:
+                # Backend didn't record the data it read
+                setattr(obj, Storable.ORIG_VER_FIELD_NAME, obj.to_data())
+            cache.put(id, orig_version(obj), generation)
+        elif self.miss_caching.get(cls.get_table_name(), self.cache_misses):
+            cache.put(id, _NOT_FOUND, generation)
+
+    def find_one(self, cls, id):
+        """Find one record, checking the cache first."""
+        cache = self.get_cache(cls)
+        if cache is None:
+            return self.db.find_one(cls, id)
+
+        found, data = cache.get(id)
+        if found:
+            return None if data is _NOT_FOUND else from_stored(cls, data)
+
+        generation = cache.current_generation()
+        obj = self.db.find_one(cls, id)
+        self._cache_loaded(cls, cache, generation, id, obj)
+        return obj
+
+    def find_many(self, cls, ids):
+        """Find records by id, only reading uncached ids from the database."""
+        cache = self.get_cache(cls)
+        if cache is None:
+            return self.db.find_many(cls, ids)
+
+        cached = {}  # id => data (or None if not found)
+        missing = []
+        for id in ids:
+            if id in cached:
+                continue
+            found, data = cache.get(id)
+            if found:
+                cached[id] = None if data is _NOT_FOUND else data
+            else:
+                cached[id] = None
+                missing.append(id)
+
+        loaded = {}
+        if missing:
+            generation = cache.current_generation()
+            for id, obj in zip(missing, self.db.find_many(cls, missing)):
+                self._cache_loaded(cls, cache, generation, id, obj)
+                if obj is not None:
+                    loaded[id] = obj
+                    cached[id] = orig_version(obj)
+
+        # Each position gets its own instance, even if an id is repeated
+        results = []
+        for id in ids:
+            obj = loaded.pop(id, None)
+            if obj is None and cached[id] is not None:
+                obj = from_stored(cls, cached[id])
+            results.append(obj)
+        return results
+
+    def exists(self, cls, id):
+        """Check for a record, answering from the cache if we can."""
+        cache = self.get_cache(cls)
+        if cache is None:
+            return self.db.exists(cls, id)
+
+        found, data = cache.get(id)
+        if found:
+            return data is not _NOT_FOUND
+
+        generation = cache.current_generation()
+        exists = self.db.exists(cls, id)
+        if not exists:
+            self._cache_loaded(cls, cache, generation, id, None)
+        return exists
+
+    def _invalidate(self, objs):
+        for obj in objs:
+            cache = self.get_cache(obj.__class__)
+            if cache is not None:
+                cache.invalidate(obj.get_id())
+
+    def save(self, obj, data=None):
+        """Save the object instance and invalidate its cache entry."""
+        try:
+            self.db.save(obj, data)
+        finally:
+            self._invalidate([obj])
+
+    def update_fields(self, obj, data, changes):
+        """Update the object instance and invalidate its cache entry."""
+        try:
+            self.db.update_fields(obj, data, changes)
+        finally:
+            self._invalidate([obj])
+
+    def save_many(self, objs, data_list=None):
+        """Save the object instances and invalidate their cache entries."""
+        try:
+            self.db.save_many(objs, data_list)
+        finally:
+            self._invalidate(objs)
+
+    def delete(self, obj):
+        """Delete the object instance and invalidate its cache entry."""
+        try:
+            self.db.delete(obj)
+        finally:
+            self._invalidate([obj])
+
+    def delete_many(self, objs):
+        """Delete the object instances and invalidate their cache entries."""
+        try:
+            self.db.delete_many(objs)
+        finally:
+            self._invalidate(objs)
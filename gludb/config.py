@@ -46,12 +46,23 @@ would work *sort of*. Some notes:
 
 # pylama:ignore=D213
 
+import threading
+
 from inspect import getmro
+from itertools import islice
 from importlib import import_module
 
+from .utils import pick_fields
+from .query import typed_predicate, index_value
+from .serializers import loads
+
 _APPLICATION_PREFIX = None
 _APPLICATION_SEP = '_'
 
+# Default number of worker threads each Database uses for the awaitable
+# methods in gludb.aio
+DEFAULT_ASYNC_WORKERS = 4
+
 
 class Database(object):
     """Configuration class.
@@ -60,10 +71,83 @@ class Database(object):
     """
 
     def __init__(self, db_driver, **kwrds):
-        """Construct instance for a driver (and optionally parameters)."""
-        mod = import_module('.backends.'+db_driver, __package__)
-        Backend = getattr(mod, "Backend")
-        self.backend = Backend(**kwrds)
+        """Construct instance for a driver (and optionally parameters).
+
+        Note that the backend module (and the driver library it uses) isn't
+        imported, and the backend isn't created, until the first time it's
+        needed. That means an invalid configuration is reported by the first
+        database operation rather than here.
+        """
+        self.db_driver = db_driver
+        self.backend_kwrds = kwrds
+        self._backend = None
+        self._backend_lock = threading.Lock()
+
+        self.async_workers = DEFAULT_ASYNC_WORKERS
+        self._executor = None
+
+    @property
+    def backend(self):
+        """The backend instance - created on first use."""
+        backend = self._backend
+        if backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    mod = import_module(
+                        '.backends.'+self.db_driver,
+                        __package__
+                    )
+                    Backend = getattr(mod, "Backend")
+                    self._backend = Backend(**self.backend_kwrds)
+                backend = self._backend
+        return backend
+
+    def set_async_workers(self, max_workers):
+        """Set the number of threads used for async database calls.
+
+        This limits how many calls made with the awaitable methods (see
+        gludb.aio) can run at once for this database. Calls already running
+        are allowed to finish.
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+
+        with self._backend_lock:
+            self.async_workers = max_workers
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    @property
+    def executor(self):
+        """The thread pool for async calls - created on first use."""
+        executor = self._executor
+        if executor is None:
+            with self._backend_lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self.async_workers)
+                executor = self._executor
+        return executor
+
+    def run_in_executor(self, func, *args):
+        """Return an asyncio future for func(*args) run on our executor."""
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def run_async(self, method_name, *args):
+        """Return an awaitable for calling one of our methods with args.
+
+        If the backend has a native coroutine version of the method (named
+        with an async_ prefix, e.g. async_find_one), then it is used.
+        Otherwise the method is called on our executor.
+        """
+        native = getattr(self.backend, 'async_' + method_name, None)
+        if native is not None:
+            return native(*args)
+        return self.run_in_executor(getattr(self, method_name), *args)
 
     def ensure_table(self, cls):
         """Ensure the table exists - defer to backend."""
@@ -73,44 +157,311 @@ class Database(object):
         """Find one record  - defer to backend."""
         return self.backend.find_one(cls, id)
 
-    def find_all(self, cls):
-        """Find all records - defer to backend."""
-        return self.backend.find_all(cls)
+    def find_all(self, cls, **page):
+        """Find all records - defer to backend.
 
-    def find_by_index(self, cls, index_name, value):
-        """Find records matching index query - defer to backend."""
-        return self.backend.find_by_index(cls, index_name, value)
+        Any page keywords (limit, after, order_by) are only passed on if
+        given: see gludb.data for their meaning.
+        """
+        return self.backend.find_all(cls, **page)
 
-    def save(self, obj):
-        """Save the object instance - defer to backend."""
-        self.backend.save(obj)
+    def find_by_index(self, cls, index_name, value, **page):
+        """Find records matching index query - defer to backend."""
+        return self.backend.find_by_index(cls, index_name, value, **page)
+
+    def iter_all(self, cls, **page):
+        """Iterate over all records - defer to backend.
+
+        Backends without a streaming read fall back to find_all.
+        """
+        iter_all = getattr(self.backend, 'iter_all', None)
+        if iter_all is None:
+            return iter(self.backend.find_all(cls, **page))
+        return iter_all(cls, **page)
+
+    def iter_by_index(self, cls, index_name, value, **page):
+        """Iterate over records matching index query - defer to backend.
+
+        Backends without a streaming read fall back to find_by_index.
+        """
+        iter_by_index = getattr(self.backend, 'iter_by_index', None)
+        if iter_by_index is None:
+            return iter(self.backend.find_by_index(
+                cls, index_name, value, **page
+            ))
+        return iter_by_index(cls, index_name, value, **page)
+
+    def iter_by_indexes(self, cls, index_values, **page):
+        """Iterate over records matching all index values - defer to backend.
+
+        index_values is a dict of index name to value (or gludb.query
+        predicate). Backends without multi-index queries use iter_by_index
+        for one of the indexes and check the rest here.
+        """
+        if not index_values:
+            return self.iter_all(cls, **page)
+
+        iter_by_indexes = getattr(self.backend, 'iter_by_indexes', None)
+        if iter_by_indexes is not None:
+            return iter_by_indexes(cls, index_values, **page)
+
+        # Any limit has to wait until we've checked the other indexes
+        limit = page.pop('limit', None)
+        name = sorted(index_values)[0]
+        objs = self.iter_by_index(cls, name, index_values[name], **page)
+        return islice(_matching(cls, objs, index_values), limit)
+
+    def find_by_indexes(self, cls, index_values, **page):
+        """Find records matching all index values - defer to backend.
+
+        See iter_by_indexes. Backends without find_by_indexes read the
+        results of iter_by_indexes.
+        """
+        find_by_indexes = getattr(self.backend, 'find_by_indexes', None)
+        if not index_values or find_by_indexes is None:
+            return list(self.iter_by_indexes(cls, index_values, **page))
+        return find_by_indexes(cls, index_values, **page)
+
+    def find_where(self, cls, where, **page):
+        """Find records whose stored fields match - defer to backend.
+
+        See iter_where. Backends without find_where read the results of
+        iter_where.
+        """
+        find_where = getattr(self.backend, 'find_where', None)
+        if find_where is None:
+            return list(self.iter_where(cls, where, **page))
+        return find_where(cls, where, **page)
+
+    def iter_where(self, cls, where, **page):
+        """Iterate over records whose stored fields match - defer to backend.
+
+        where is a dict of top-level field name to value (or gludb.query
+        predicate). Backends that can't query the stored data (and backends
+        without iter_where) check each record as it is read.
+        """
+        iter_where = getattr(self.backend, 'iter_where', None)
+        if iter_where is not None:
+            return iter_where(cls, where, **page)
+
+        from .data import filter_where
+        limit = page.pop('limit', None)
+        return filter_where(self.iter_all(cls, **page), where, limit)
+
+    def iter_fields_all(self, cls, fields, **page):
+        """Iterate over (id, field values) for all records - defer to backend.
+
+        Field values are a dict with the top-level fields named in fields.
+        Backends without projection support read the full records.
+        """
+        fields = list(fields)
+        iter_fields_all = getattr(self.backend, 'iter_fields_all', None)
+        if iter_fields_all is None:
+            return _projected(self.iter_all(cls, **page), fields)
+        return iter_fields_all(cls, fields, **page)
+
+    def iter_fields_by_index(self, cls, index_name, value, fields, **page):
+        """Iterate over (id, field values) for index query - defer to backend.
+
+        See iter_fields_all.
+        """
+        fields = list(fields)
+        method = getattr(self.backend, 'iter_fields_by_index', None)
+        if method is None:
+            objs = self.iter_by_index(cls, index_name, value, **page)
+            return _projected(objs, fields)
+        return method(cls, index_name, value, fields, **page)
+
+    def iter_ids_by_index(self, cls, index_name, value, **page):
+        """Iterate over ids of records matching index query - defer to backend.
+
+        Backends without an ids-only query read the full records.
+        """
+        method = getattr(self.backend, 'iter_ids_by_index', None)
+        if method is None:
+            objs = self.iter_by_index(cls, index_name, value, **page)
+            return (obj.get_id() for obj in objs)
+        return method(cls, index_name, value, **page)
+
+    def count_all(self, cls):
+        """Count all records - defer to backend.
+
+        Backends without a native count read (and count) every record.
+        """
+        count_all = getattr(self.backend, 'count_all', None)
+        if count_all is None:
+            return sum(1 for _ in self.iter_all(cls))
+        return count_all(cls)
+
+    def count_by_index(self, cls, index_name, value):
+        """Count records matching index query - defer to backend.
+
+        Backends without a native count read (and count) every match.
+        """
+        count_by_index = getattr(self.backend, 'count_by_index', None)
+        if count_by_index is None:
+            return sum(1 for _ in self.iter_by_index(cls, index_name, value))
+        return count_by_index(cls, index_name, value)
+
+    def exists(self, cls, id):
+        """Return True if there is a record with the id - defer to backend.
+
+        Backends without a native check use find_one.
+        """
+        exists = getattr(self.backend, 'exists', None)
+        if exists is None:
+            return self.backend.find_one(cls, id) is not None
+        return exists(cls, id)
+
+    def save(self, obj, data=None):
+        """Save the object instance - defer to backend.
+
+        If given, data is the result of obj.to_data() - passing it along lets
+        the backend skip serializing the object again.
+        """
+        self.backend.save(obj, data)
+
+    def update_fields(self, obj, data, changes):
+        """Save the changed fields of the object instance - defer to backend.
+
+        data is the result of obj.to_data() and changes is a dictionary of
+        the top-level fields (and their new values) that are different from
+        the stored version. Backends that can't update part of a document
+        save the whole thing.
+        """
+        update_fields = getattr(self.backend, 'update_fields', None)
+        if update_fields is None:
+            self.backend.save(obj, data)
+        else:
+            update_fields(obj, data, changes)
 
     def delete(self, obj):
         """Delete the object instance - defer to backend."""
         self.backend.delete(obj)
 
+    def find_many(self, cls, ids):
+        """Find records by id - defer to backend.
+
+        The list returned is in the same order as ids, with None for any id
+        not found. A repeated id gets a separate instance in each position
+        (see gludb.data.many_in_order). Backends without a bulk read use one
+        find_one per id.
+        """
+        find_many = getattr(self.backend, 'find_many', None)
+        if find_many is None:
+            return [self.backend.find_one(cls, id) for id in ids]
+        return find_many(cls, ids)
+
+    def find_deferred(self, cls, ids):
+        """Return the deferred field values for ids - defer to backend.
+
+        The result is a dictionary of id to a dictionary of field values (see
+        gludb.data.split_deferred), with no entry for ids that have none.
+        Backends that don't store deferred fields separately keep them with
+        the rest of the data, so there's nothing more to read.
+        """
+        find_deferred = getattr(self.backend, 'find_deferred', None)
+        if find_deferred is None:
+            return {}
+        return find_deferred(cls, list(ids))
+
+    def save_many(self, objs, data_list=None):
+        """Save all the object instances - defer to backend.
+
+        If given, data_list holds the to_data() result for each object (see
+        save). Backends without a bulk write use one save per object.
+        """
+        if data_list is None:
+            data_list = [None] * len(objs)
+
+        save_many = getattr(self.backend, 'save_many', None)
+        if save_many is None:
+            for obj, data in zip(objs, data_list):
+                self.backend.save(obj, data)
+        else:
+            save_many(objs, data_list)
+
+    def delete_many(self, objs):
+        """Delete all the object instances - defer to backend.
+
+        Backends without a bulk delete use one delete per object.
+        """
+        delete_many = getattr(self.backend, 'delete_many', None)
+        if delete_many is None:
+            for obj in objs:
+                self.backend.delete(obj)
+        else:
+            delete_many(objs)
+
+
+def _matching(cls, objs, index_values):
+    # Fallback for backends without multi-index queries: check index values
+    # (converted to their index types) in the full objects
+    from .data import index_types
+    types = index_types(cls)
+
+    preds = [
+        (name, typed_predicate(val, types[name]))
+        for name, val in index_values.items()
+    ]
+    for obj in objs:
+        indexes = obj.indexes() or {}
+        if all(
+            pred.matches_field(index_value(indexes.get(name), types[name]))
+            for name, pred in preds
+        ):
+            yield obj
+
+
+def _projected(objs, fields):
+    # Fallback for backends without projections: pick the fields out of the
+    # full objects
+    for obj in objs:
+        values = loads(obj.to_data())
+        yield obj.get_id(), pick_fields(values, fields)
+
 
 # Note our use of a class with a singleton instance - so configuration is
 # process-wide. This makes things much simpler for some users (which is one
 # of our main design drivers). One potential enhancement is to allow multiple
 # database mappings - perhaps as a Flask Blueprint plugin/addon
+#
+# Walking the MRO for every database operation adds up, so we also keep a
+# cache of resolved lookups. Any configuration change replaces the cache with
+# a new, empty dict (always AFTER changing the configuration). Lookups don't
+# lock: they get the cache dict once and only ever write to that dict, so a
+# lookup racing with a change can at worst fill in a cache that has already
+# been thrown away.
 class _DatabaseMapping(object):
     def __init__(self):
+        self.lock = threading.Lock()
         self.clear_mappings()
 
     def add_mapping(self, cls, db):
-        self.mapping[cls] = db
+        with self.lock:
+            self.mapping[cls] = db
+            self.resolved = {}
 
-    def get_mapping(self, cls, no_mapping_ok=False):
-        db = None
+    def set_default(self, db):
+        with self.lock:
+            self.default_database = db
+            self.resolved = {}
 
+    def resolve(self, cls):
         for candidate_cls in getmro(cls):
             db = self.mapping.get(candidate_cls, None)
             if db is not None:
-                break
+                return db
 
-        if db is None:
-            db = self.default_database
+        return self.default_database
+
+    def get_mapping(self, cls, no_mapping_ok=False):
+        resolved = self.resolved
+        try:
+            db = resolved[cls]
+        except KeyError:
+            db = self.resolve(cls)
+            resolved[cls] = db
 
         if db is None:
             if no_mapping_ok:
@@ -120,15 +471,17 @@ class _DatabaseMapping(object):
         return db
 
     def clear_mappings(self):
-        self.default_database = None
-        self.mapping = {}
+        with self.lock:
+            self.default_database = None
+            self.mapping = {}
+            self.resolved = {}
 
 _database_mapping = _DatabaseMapping()
 
 
 def default_database(db):
     """Set default database config for classes without a specific mapping."""
-    _database_mapping.default_database = db
+    _database_mapping.set_default(db)
 
 
 def class_database(cls, db):
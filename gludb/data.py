@@ -5,18 +5,94 @@ gludb.simple. This module is for those needing advanced functionality or
 customization
 """
 
+import sys
+import marshal
+
 from abc import ABCMeta, abstractmethod
 
 from .config import get_mapping
+from .session import current_session
+from .query import where_matches, index_value
+from .utils import uuid, chunked
+from .serializers import (
+    dumps,
+    loads,
+    encode_data,
+    strip_encoding,
+    decode_payload,
+)
 
 # pylama:ignore=E501
 
+# The most objects from one query that read their deferred fields together
+# (see Storable.share_deferred)
+DEFERRED_GROUP_SIZE = 100
+
 
 class DeleteNotSupported(Exception):  # NOQA
     """Exception thrown when delete is not supported by the backend."""
     pass
 
 
+class ReadOnlyError(Exception):  # NOQA
+    """Exception thrown when saving or deleting a read-only object."""
+    pass
+
+
+class IndexTypeError(Exception):  # NOQA
+    """Exception thrown when a table stores an index as the wrong type.
+
+    ensure_table raises it for tables created before an index was declared
+    with a type (or with a different one), since queries would fail or
+    compare the wrong way.
+    """
+    pass
+
+
+class _READ_ONLY:
+    """Helper stored as the original version of read-only objects."""
+    pass
+
+
+class _StoredVersion(object):
+    """Original version of an object loaded from a dictionary.
+
+    It's only encoded as JSON if something asks for the text (see
+    orig_version): change detection and versioning use the dictionary. The
+    dictionary is a private copy (the instance might change the one it was
+    created from), and nothing should change it. Instead of the dictionary,
+    we can have a function that decodes it, which isn't called until the
+    dictionary is needed.
+    """
+
+    __slots__ = ('_values', '_decode')
+
+    def __init__(self, values=None, decode=None):
+        """Keep values (or decode, which returns them) as the original."""
+        self._values = values
+        self._decode = decode
+
+    @property
+    def values(self):
+        """The original version as a dictionary."""
+        if self._decode is not None:
+            self._values, self._decode = self._decode(), None
+        return self._values
+
+    @classmethod
+    def copied(cls, values):
+        """Return the original version for values (which are copied).
+
+        marshal copies dictionaries of JSON types in about half the time it
+        takes to encode them. Values it can't handle (e.g. driver-specific
+        types) are encoded now instead.
+        """
+        try:
+            return cls(marshal.loads(marshal.dumps(values)))
+        except (ValueError, TypeError):
+            return dumps(values)
+
+
 # A little magic for using metaclasses with both Python 2 and 3
 def _with_metaclass(meta, *bases):
     """Taken from future.utils, who took it from jinja2/_compat.py (BSD license)."""
@@ -75,6 +151,26 @@ class Storable(_with_metaclass(ABCMeta)):
         """Return a new instance of the subclass populated from the JSON representation."""
         pass
 
+    def to_dict(self):
+        """Return the instance's state as a dictionary.
+
+        Optional method. This should be the same data as to_data, but without
+        the JSON encoding: backends that store structured documents (and the
+        change detection done when saving) use it to avoid encoding and then
+        decoding the data. Returning None means it isn't supported.
+        """
+        return None
+
+    @classmethod
+    def from_dict(self, values):
+        """Return a new instance of the subclass populated from a dictionary.
+
+        Optional method, the inverse of to_dict. The instance may keep the
+        (mutable) values in the dictionary. Returning None means it isn't
+        supported, and from_data is used instead.
+        """
+        return None
+
     @classmethod
     def index_names(self):
         """Return an iterable of index names.
@@ -92,49 +188,698 @@ class Storable(_with_metaclass(ABCMeta)):
         """
         return None
 
+    @classmethod
+    def index_types(self):
+        """Return a dictionary of index name to the type of the index values.
+
+        Optional method. Types are from gludb.query.INDEX_TYPES, and indexes
+        that aren't in the dictionary are strings. Backends store typed index
+        values natively where they can, so they compare as that type.
+        """
+        return None
+
+    @classmethod
+    def composite_indexes(self):
+        """Return an iterable of composite indexes (tuples of index names).
+
+        Optional method. Backends that support it create a database index
+        over the index values together (in the order given) in ensure_table,
+        which find_by_indexes can use.
+        """
+        return None
+
+    @classmethod
+    def deferred_fields(self):
+        """Return an iterable of the names of deferred fields.
+
+        Optional method. Backends store the values of these fields (when they
+        are in the to_data result) apart from the rest of the data, so they
+        aren't read by queries. The class is responsible for reading them
+        with the database's find_deferred when they're needed; see
+        split_deferred.
+        """
+        return None
+
+    @classmethod
+    def share_deferred(self, obj, group):
+        """Note that obj was loaded by the same query as the objects in group.
+
+        Optional method for classes with deferred fields. group is a list
+        (including obj) of up to DEFERRED_GROUP_SIZE objects loaded by one
+        query, so the class can read the deferred fields for the whole group
+        with one find_deferred call instead of one call per object.
+        """
+        return None
+
+    @classmethod
+    def volatile_fields(self):
+        """Return an iterable of field names ignored when checking for changes.
+
+        Optional method. Saving an object whose data only differs from the
+        original version in these fields (e.g. a last-update timestamp set by
+        to_data) doesn't write anything.
+        """
+        return None
+
+    @classmethod
+    def serializer(self):
+        """Return the name of the format for the class's stored data.
+
+        Optional method. Backends that store data as an opaque value use the
+        named serializer from gludb.serializers (the default, None, is JSON).
+        Backends that store structured documents always use JSON.
+        """
+        return None
+
+    @classmethod
+    def compression(self):
+        """Return how to compress the class's stored data.
+
+        Optional method. The result is a gludb.serializers.Compression, the
+        name of a compression method ('zlib' or 'lzma'), or None for no
+        compression. Only backends that store data as an opaque value
+        compress it.
+        """
+        return None
+
 
 def _ensure_table(cls):
     get_mapping(cls).ensure_table(cls)
 
 
-def _post_load(obj):
+def from_stored(cls, data):
+    """Return a new instance of cls created from data read by a backend.
+
+    Backends should use this instead of calling cls.from_data directly: data
+    is also recorded as the instance's original version, so that it doesn't
+    need to be re-created by serializing the instance again after loading.
+    data can be a payload in any of the formats in gludb.serializers. Binary
+    formats are decoded to a dictionary for from_dict (like
+    from_stored_values), and the original version is decoded again if it's
+    needed.
+    """
+    values, text = decode_payload(data)
+    if values is None:
+        obj = cls.from_data(text)
+        setattr(obj, Storable.ORIG_VER_FIELD_NAME, text)
+        return obj
+
+    orig = _StoredVersion(decode=lambda: decode_payload(data)[0])
+    obj = _from_values(cls, values)
+    setattr(obj, Storable.ORIG_VER_FIELD_NAME, orig)
+    return obj
+
+
+def from_stored_values(cls, values):
+    """Like from_stored, but for stored data that's already a dictionary.
+
+    Backends that store structured documents use this: the instance is
+    created with from_dict if cls supports it, and the original version is
+    only encoded as JSON if it's asked for (see orig_version), so there's
+    usually no JSON encoding at all. The dictionary might be used by the
+    instance, so backends shouldn't use it afterwards.
+    """
+    # Copied before the instance exists, since setup could change values
+    orig = _StoredVersion.copied(values)
+    obj = _from_values(cls, values)
+    setattr(obj, Storable.ORIG_VER_FIELD_NAME, orig)
+    return obj
+
+
+def many_in_order(cls, ids, found):
+    """Return the instances in found (id => instance) in the order of ids.
+
+    Backends use this for find_many. Ids that weren't found are None. An id
+    that's repeated gets a new instance for each repeat (from the first
+    instance's original version), so no two positions share an instance.
+    """
+    results, seen = [], set()
+    for id in ids:
+        obj = found.get(id, None)
+        if obj is not None and id in seen:
+            obj = from_stored(cls, orig_version(obj))
+        seen.add(id)
+        results.append(obj)
+    return results
+
+
+def _from_values(cls, values):
+    method = getattr(cls, 'from_dict', None)
+    obj = method(values) if method else None
+    if obj is None:
+        obj = cls.from_data(dumps(values))
+    return obj
+
+
+def object_values(obj, data=None):
+    """Return the stored data of obj as a dictionary.
+
+    data is the to_data result if the caller has one (it's decoded). Otherwise
+    we use the object's to_dict, falling back to decoding to_data.
+    """
+    if data is None:
+        method = getattr(obj, 'to_dict', None)
+        values = method() if method else None
+        if values is not None:
+            return values
+        data = obj.to_data()
+    return loads(data)
+
+
+class PartialRecord(object):
+    """Some of the fields of a stored object, as returned by a fields= query.
+
+    The id and each requested field can be read as attributes (a field that
+    the stored object doesn't have is None). Partial records are always
+    read-only: calling save or delete raises ReadOnlyError.
+    """
+
+    def __init__(self, cls, id, values):
+        """Create a partial record for the stored object of class cls."""
+        self._cls = cls
+        self._id = id
+        self._values = dict(values)
+
+    def __getattr__(self, name):
+        """Fields are attributes."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name == 'id':
+            return self._id
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(
+                "%s wasn't requested for this partial record" % name
+            )
+
+    def __repr__(self):
+        """Readable version of the record for debugging."""
+        return 'PartialRecord(%s, %s, %s)' % (
+            self._cls.__name__, repr(self._id), repr(self._values)
+        )
+
+    def get_id(self):
+        """Return the id of the stored object."""
+        return self._id
+
+    def stored_class(self):
+        """Return the class of the stored object."""
+        return self._cls
+
+    def to_dict(self):
+        """Return the field values (including id) as a dictionary."""
+        values = dict(self._values)
+        values['id'] = self._id
+        return values
+
+    def save(self, *args, **kwrds):
+        """Partial records can't be saved."""
+        raise ReadOnlyError("Partial records can't be saved")
+
+    def delete(self):
+        """Partial records can't be deleted."""
+        raise ReadOnlyError("Partial records can't be deleted")
+
+
+def _partial(cls, results):
+    # Backends yield (id, field values) pairs for fields= queries
+    for id, values in results:
+        yield PartialRecord(cls, id, values)
+
+
+def _post_load(obj, readonly=False, session=None):
     # Perform all necessary post load operations we want done when reading
     # from the database. We return the changed object, but make NO EFFORT
-    # to keep from mutating the original object.
-    if obj:
-        setattr(obj, Storable.ORIG_VER_FIELD_NAME, obj.to_data())
+    # to keep from mutating the original object. If there is a session, the
+    # object returned is the session's instance for the object's id.
+    if not obj:
+        pass
+    elif readonly:
+        # No original version to keep around (and it marks the object)
+        setattr(obj, Storable.ORIG_VER_FIELD_NAME, _READ_ONLY)
+    else:
+        if getattr(obj, Storable.ORIG_VER_FIELD_NAME, None) is None:
+            # Backend didn't use from_stored, so we need to serialize
+            setattr(obj, Storable.ORIG_VER_FIELD_NAME, obj.to_data())
+        if session is not None:
+            obj = session.add(obj)
     return obj
 
 
-def _find_one(cls, id):
-    return _post_load(get_mapping(cls).find_one(cls, id))
+def _shares_deferred(cls):
+    return bool(deferred_fields(cls)) and hasattr(cls, 'share_deferred')
 
 
-def _find_all(cls):
-    return [
-        _post_load(obj)
-        for obj in get_mapping(cls).find_all(cls)
-    ]
+def _share_deferred(cls, objs):
+    # Let each group of DEFERRED_GROUP_SIZE objects loaded by one query read
+    # their deferred fields together (see Storable.share_deferred). Returns
+    # the list objs.
+    if _shares_deferred(cls):
+        loaded = [obj for obj in objs if obj is not None]
+        for group in chunked(loaded, DEFERRED_GROUP_SIZE):
+            for obj in group:
+                cls.share_deferred(obj, group)
+    return objs
 
 
-def _find_by_index(cls, index_name, value):
-    return [
-        _post_load(obj)
-        for obj in get_mapping(cls).find_by_index(cls, index_name, value)
-    ]
+def _load_all(cls, objs, readonly, session):
+    # Yield the _post_load result for each object from a backend iterator.
+    # Objects with deferred fields are loaded a group at a time, so that
+    # their group is complete when they're yielded.
+    if not _shares_deferred(cls):
+        for obj in objs:
+            yield _post_load(obj, readonly, session)
+        return
+
+    for chunk in chunked(objs, DEFERRED_GROUP_SIZE):
+        loaded = [_post_load(obj, readonly, session) for obj in chunk]
+        for obj in _share_deferred(cls, loaded):
+            yield obj
+
+
+def _load_session(readonly):
+    # Read-only loads never use the current session
+    return None if readonly else current_session()
+
+
+def _find_one(cls, id, readonly=False):
+    session = _load_session(readonly)
+    if session is not None:
+        obj = session.get(cls, id)
+        if obj is not None:
+            return obj
+
+    return _post_load(get_mapping(cls).find_one(cls, id), readonly, session)
+
+
+def _page_args(cls, limit, after, order_by):
+    # Check the paging parameters for a query and return the keywords for
+    # the backend. Backends get after as an (id, sort value) tuple, where the
+    # sort value is the after object's value for the order_by index (for
+    # typed indexes, converted by gludb.query.index_value) or its id. We only
+    # include keywords that were given, so that backends without paging
+    # support work as before for unpaged queries.
+    orderable = [None, 'id'] + list(cls.index_names() or [])
+    if order_by not in orderable:
+        raise ValueError("Can't order %s by %s" % (repr(cls), repr(order_by)))
+    if limit is not None and limit < 0:
+        raise ValueError("A query limit can't be negative")
+
+    page = dict()
+    if limit is not None:
+        page['limit'] = limit
+    if order_by is not None:
+        page['order_by'] = order_by
+
+    if after is not None:
+        if hasattr(after, 'get_id'):
+            after_obj, after_id = after, after.get_id()
+        else:
+            after_obj, after_id = None, after
+        if isinstance(after_obj, PartialRecord):
+            after_obj = None  # Doesn't have index values
+
+        sort_value = after_id
+        if order_by not in (None, 'id'):
+            if after_obj is None:
+                after_obj = get_mapping(cls).find_one(cls, after_id)
+                if after_obj is None:
+                    raise ValueError("No %s with id %s (for after)" % (
+                        repr(cls), repr(after_id)
+                    ))
+            sort_value = (after_obj.indexes() or {}).get(order_by, None)
+            index_type = index_types(cls)[order_by]
+            if index_type is not str:
+                sort_value = index_value(sort_value, index_type)
+
+        page['after'] = (after_id, sort_value)
 
+    return page
 
-def _save(self):
-    # Actual save
-    get_mapping(self.__class__).save(self)
+
+def _find_list(cls, method_name, args, readonly, limit, after, order_by):
+    # Read a whole result list with the Database's find method (which can
+    # be cheaper than streaming it, e.g. no server-side cursor)
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return []
+
+    method = getattr(get_mapping(cls), method_name)
+    objs = method(cls, *args, **page)
+    session = _load_session(readonly)
+    return list(_load_all(cls, objs, readonly, session))
+
+
+def _find_all(cls, readonly=False, limit=None, after=None, order_by=None,
+              fields=None):
+    if fields is not None:
+        return list(_iter_all(cls, readonly, limit, after, order_by, fields))
+    return _find_list(cls, 'find_all', (), readonly, limit, after, order_by)
+
+
+def _iter_all(cls, readonly=False, limit=None, after=None, order_by=None,
+              fields=None):
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return
+
+    db = get_mapping(cls)
+    if fields is not None:
+        for rec in _partial(cls, db.iter_fields_all(cls, fields, **page)):
+            yield rec
+        return
+
+    session = _load_session(readonly)
+    objs = db.iter_all(cls, **page)
+    for obj in _load_all(cls, objs, readonly, session):
+        yield obj
+
+
+def _find_by_index(cls, index_name, value, readonly=False, limit=None,
+                   after=None, order_by=None, fields=None):
+    if fields is not None:
+        return list(_iter_by_index(
+            cls, index_name, value, readonly, limit, after, order_by, fields
+        ))
+    return _find_list(
+        cls, 'find_by_index', (index_name, value), readonly, limit, after,
+        order_by
+    )
+
+
+def _iter_by_index(cls, index_name, value, readonly=False, limit=None,
+                   after=None, order_by=None, fields=None):
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return
+
+    db = get_mapping(cls)
+    if fields is not None:
+        recs = db.iter_fields_by_index(cls, index_name, value, fields, **page)
+        for rec in _partial(cls, recs):
+            yield rec
+        return
+
+    session = _load_session(readonly)
+    objs = db.iter_by_index(cls, index_name, value, **page)
+    for obj in _load_all(cls, objs, readonly, session):
+        yield obj
+
+
+def _where_args(where, field_values):
+    # find_where conditions can be a dict, keywords, or both
+    where = dict(where or {})
+    where.update(field_values)
+    return where
+
+
+def _find_where(cls, where=None, readonly=False, limit=None, after=None,
+                order_by=None, **field_values):
+    where = _where_args(where, field_values)
+    return _find_list(
+        cls, 'find_where', (where,), readonly, limit, after, order_by
+    )
+
+
+def _iter_where(cls, where=None, readonly=False, limit=None, after=None,
+                order_by=None, **field_values):
+    where = _where_args(where, field_values)
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return
+
+    session = _load_session(readonly)
+    objs = get_mapping(cls).iter_where(cls, where, **page)
+    for obj in _load_all(cls, objs, readonly, session):
+        yield obj
+
+
+def filter_where(objs, where, limit=None):
+    """Yield the objects whose stored data matches where (up to limit).
+
+    This is the client-side version of find_where for backends that can't
+    query the stored data: objects are checked as they are read, so nothing
+    is held in memory.
+    """
+    count = 0
+    for obj in objs:
+        if limit is not None and count >= limit:
+            break
+        values = _orig_values(obj)
+        if values is None:
+            values = loads(obj.to_data())
+        if where_matches(values, where):
+            yield obj
+            count += 1
+
+
+def _check_index_names(cls, index_values):
+    # Return index_values as a dict, checking that all the names are indexes
+    index_values = dict(index_values)
+    known = set(cls.index_names() or [])
+    for name in index_values:
+        if name not in known:
+            raise ValueError("%s has no index %s" % (repr(cls), repr(name)))
+    return index_values
+
+
+def _find_by_indexes(cls, index_values, readonly=False, limit=None,
+                     after=None, order_by=None):
+    index_values = _check_index_names(cls, index_values)
+    return _find_list(
+        cls, 'find_by_indexes', (index_values,), readonly, limit, after,
+        order_by
+    )
+
+
+def _iter_by_indexes(cls, index_values, readonly=False, limit=None,
+                     after=None, order_by=None):
+    index_values = _check_index_names(cls, index_values)
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return
+
+    session = _load_session(readonly)
+    objs = get_mapping(cls).iter_by_indexes(cls, index_values, **page)
+    for obj in _load_all(cls, objs, readonly, session):
+        yield obj
+
+
+def _find_ids_by_index(cls, index_name, value, limit=None, after=None,
+                       order_by=None):
+    page = _page_args(cls, limit, after, order_by)
+    if limit == 0:
+        return []
+
+    db = get_mapping(cls)
+    return list(db.iter_ids_by_index(cls, index_name, value, **page))
+
+
+def _count_all(cls):
+    return get_mapping(cls).count_all(cls)
+
+
+def _count_by_index(cls, index_name, value):
+    return get_mapping(cls).count_by_index(cls, index_name, value)
+
+
+def _exists(cls, id):
+    return get_mapping(cls).exists(cls, id)
+
+
+def _session_objects(session, cls, ids):
+    # Return a dict of the session's instances for ids and a list of the ids
+    # that still need to be read
+    found = dict()
+    for id in ids:
+        obj = session.get(cls, id)
+        if obj is not None:
+            found[id] = obj
+
+    return found, [id for id in ids if id not in found]
+
+
+def _find_many(cls, ids, readonly=False):
+    ids = list(ids)
+    session = _load_session(readonly)
+    if session is None:
+        return _share_deferred(cls, [
+            _post_load(obj, readonly)
+            for obj in get_mapping(cls).find_many(cls, ids)
+        ])
+
+    # Only read the ids that aren't already in the session
+    found, missing = _session_objects(session, cls, ids)
+    if missing:
+        for id, obj in zip(missing, get_mapping(cls).find_many(cls, missing)):
+            found[id] = _post_load(obj, readonly, session)
+
+    return _share_deferred(cls, [found[id] for id in ids])
+
+
+def _check_writable(obj):
+    if is_readonly(obj):
+        raise ReadOnlyError(
+            "%s was loaded read-only and can't be changed in the database" %
+            repr(obj)
+        )
+
+
+def _ensure_id(obj):
+    # IDs are created before serializing so that the saved data has them
+    if not obj.get_id():
+        obj.set_id(uuid())
+
+
+def _changed_fields(obj, data, curr=None):
+    # Compare data (a to_data() result) with the object's original version.
+    # Returns None if we can't tell what changed (so everything must be
+    # written), an empty dict if only volatile fields changed (so nothing
+    # needs to be written), or else a dict of the top-level fields to update
+    # (including any changed volatile fields). curr is data as a dictionary
+    # if the caller has it.
+    orig = getattr(obj, Storable.ORIG_VER_FIELD_NAME, None)
+    if orig is None or orig is _READ_ONLY:
+        return None
+    if orig == data:
+        return {}
+
+    try:
+        prev = _orig_values(obj)
+        if curr is None:
+            curr = loads(data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(prev, dict) or not isinstance(curr, dict):
+        return None
+    if any(name not in curr for name in prev):
+        return None  # Removing a field needs a full write
+
+    changes = dict(
+        (name, val) for name, val in curr.items()
+        if name not in prev or prev[name] != val
+    )
+
+    volatile_fields = getattr(obj.__class__, 'volatile_fields', None)
+    volatile = set((volatile_fields and volatile_fields()) or [])
+    if all(name in volatile for name in changes):
+        return {}
+
+    # Deferred fields aren't in the stored data, so they need a full write
+    if set(changes).intersection(deferred_fields(obj.__class__)):
+        return None
+
+    return changes
+
+
+def _prepare_save(obj, data=None):
+    # Everything we do before saving: returns the data to write and the
+    # changes in it (as per _changed_fields)
+    _check_writable(obj)
+
+    # data is the to_data() result if the caller already has it: we serialize
+    # exactly once and use the result for the backend and the orig version
+    values = None
+    if data is None:
+        _ensure_id(obj)
+        data, values = _encoded(obj)
+
+    return data, _changed_fields(obj, data, values)
+
+
+def _encoded(obj):
+    # Return (data, values) for obj: its to_data result, and the dictionary
+    # we encoded it from (or None if there's no to_dict). Change detection
+    # can use values instead of decoding data again
+    method = getattr(obj, 'to_dict', None)
+    values = method() if method else None
+    if values is None:
+        return obj.to_data(), None
+    return encode_data(obj.__class__, values), values
+
+
+def _save(self, data=None):
+    data, changes = _prepare_save(self, data)
+    if changes is not None and not changes:
+        return  # Nothing to write (and the original version is still valid)
+
+    # Actual save - or wait for the current session to be flushed
+    session = current_session()
+    if session is not None:
+        session.add_pending(self, data)
+    elif changes:
+        get_mapping(self.__class__).update_fields(self, data, changes)
+    else:
+        get_mapping(self.__class__).save(self, data)
 
     # Now we have a new original version
-    setattr(self, Storable.ORIG_VER_FIELD_NAME, self.to_data())
+    setattr(self, Storable.ORIG_VER_FIELD_NAME, strip_encoding(data))
+
+
+def _prepare_save_many(objs, data_list=None):
+    # Like _prepare_save for a list of objects: returns the objects with
+    # changes to write and their data
+    objs = list(objs)
+    for obj in objs:
+        _check_writable(obj)
+
+    values_list = [None] * len(objs)
+    if data_list is None:
+        for obj in objs:
+            _ensure_id(obj)
+        encoded = [_encoded(obj) for obj in objs]
+        data_list = [data for data, _ in encoded]
+        values_list = [values for _, values in encoded]
+
+    # Skip objects without changes to write
+    to_save = [
+        (obj, data) for obj, data, values in zip(objs, data_list, values_list)
+        if _changed_fields(obj, data, values) != {}
+    ]
+    return [obj for obj, _ in to_save], [data for _, data in to_save]
+
+
+def _save_many(cls, objs, data_list=None):
+    objs, data_list = _prepare_save_many(objs, data_list)
+    if not objs:
+        return
+
+    session = current_session()
+    if session is not None:
+        for obj, data in zip(objs, data_list):
+            session.add_pending(obj, data)
+    else:
+        get_mapping(cls).save_many(objs, data_list)
+
+    for obj, data in zip(objs, data_list):
+        setattr(obj, Storable.ORIG_VER_FIELD_NAME, strip_encoding(data))
 
 
 def _delete(self):
+    _check_writable(self)
+
     # Actual delete - and note no version changes
     get_mapping(self.__class__).delete(self)
+    _deleted([self])
+
+
+def _deleted(objs):
+    # Deletes are never deferred by a session, but the objects are no longer
+    # part of it
+    session = current_session()
+    if session is not None:
+        for obj in objs:
+            session.remove(obj)
+
+
+def _delete_many(cls, objs):
+    objs = list(objs)
+    for obj in objs:
+        _check_writable(obj)
+
+    get_mapping(cls).delete_many(objs)
+    _deleted(objs)
 
 
 # TODO: we need a function ensure_package_db - it should work mainly like the
@@ -156,13 +901,109 @@ def DatabaseEnabled(cls):
     cls.ensure_table = classmethod(_ensure_table)
     cls.find_one = classmethod(_find_one)
     cls.find_all = classmethod(_find_all)
+    cls.iter_all = classmethod(_iter_all)
     cls.find_by_index = classmethod(_find_by_index)
+    cls.iter_by_index = classmethod(_iter_by_index)
+    cls.find_by_indexes = classmethod(_find_by_indexes)
+    cls.find_where = classmethod(_find_where)
+    cls.iter_where = classmethod(_iter_where)
+    cls.iter_by_indexes = classmethod(_iter_by_indexes)
+    cls.find_ids_by_index = classmethod(_find_ids_by_index)
+    cls.find_many = classmethod(_find_many)
+    cls.count_all = classmethod(_count_all)
+    cls.count_by_index = classmethod(_count_by_index)
+    cls.exists = classmethod(_exists)
     cls.save = _save
+    cls.save_many = classmethod(_save_many)
     cls.delete = _delete
+    cls.delete_many = classmethod(_delete_many)
+
+    # Awaitable versions of the above need async/await
+    if sys.version_info >= (3, 5):
+        from .aio import add_async_methods
+        add_async_methods(cls)
 
     return cls
 
 
+def index_type_error(cls, index_name, stored_as):
+    """Return an IndexTypeError for a table that stores an index wrongly.
+
+    Backends call this from ensure_table. stored_as is what the existing
+    table uses for the index (e.g. a column type).
+    """
+    return IndexTypeError(
+        "%s index %s has type %s, but table %s stores it as %s (the table "
+        "was created before the index had this type): migrate the stored "
+        "index values or use a new table" % (
+            cls.__name__,
+            index_name,
+            index_types(cls)[index_name].__name__,
+            cls.get_table_name(),
+            stored_as,
+        )
+    )
+
+
+def index_types(cls):
+    """Return a dictionary of index name to type for every index of cls.
+
+    As with composite_indexes, the class might not have an index_types
+    method, and indexes without a type are strings.
+    """
+    method = getattr(cls, 'index_types', None)
+    declared = (method() if method else None) or {}
+    return dict(
+        (name, declared.get(name, str)) for name in cls.index_names() or []
+    )
+
+
+def composite_indexes(cls):
+    """Return a list of the composite indexes (tuples of names) for cls.
+
+    Backends use this since classes registered as virtual subclasses of
+    Storable might not have a composite_indexes method.
+    """
+    method = getattr(cls, 'composite_indexes', None)
+    return [tuple(names) for names in (method() if method else None) or []]
+
+
+def deferred_fields(cls):
+    """Return a list of the deferred field names for cls (see Storable)."""
+    method = getattr(cls, 'deferred_fields', None)
+    return list((method() if method else None) or [])
+
+
+def split_deferred(cls, data):
+    """Split a to_data result into (data, deferred data) for a backend.
+
+    Deferred data is the JSON for the deferred fields in data (which are
+    removed from the data returned), or None if there aren't any. Backends
+    should keep the deferred data they already have for an object when it's
+    None: the object didn't read its deferred fields, so they haven't changed.
+    """
+    if not deferred_fields(cls):
+        return data, None
+
+    values, deferred = split_deferred_values(cls, loads(data))
+    if deferred is None:
+        return data, None
+    return encode_data(cls, values), dumps(deferred)
+
+
+def split_deferred_values(cls, values):
+    """Like split_deferred, but for data that's a dictionary.
+
+    Returns (values, deferred values) where the deferred values are a
+    dictionary or None. values is changed in place.
+    """
+    deferred = dict(
+        (name, values.pop(name)) for name in deferred_fields(cls)
+        if name in values
+    )
+    return values, deferred or None
+
+
 def orig_version(obj):
     """Return the original version of an object.
 
@@ -171,4 +1012,28 @@ def orig_version(obj):
     objects don't have a previous version), then None is returned. Mainly useful
     for testing.
     """
-    return getattr(obj, Storable.ORIG_VER_FIELD_NAME, None)
+    orig = getattr(obj, Storable.ORIG_VER_FIELD_NAME, None)
+    if isinstance(orig, _StoredVersion):
+        orig = dumps(orig.values)
+        setattr(obj, Storable.ORIG_VER_FIELD_NAME, orig)
+    return None if orig is _READ_ONLY else orig
+
+
+def _orig_values(obj):
+    # The original version of obj as a dictionary (or None), without encoding
+    # it if it was loaded from a dictionary. Don't change the result
+    orig = getattr(obj, Storable.ORIG_VER_FIELD_NAME, None)
+    if isinstance(orig, _StoredVersion):
+        return orig.values
+    if orig is None or orig is _READ_ONLY:
+        return None
+    return loads(orig)
+
+
+def is_readonly(obj):
+    """Return True if the object was loaded with readonly=True.
+
+    Read-only objects don't keep an original version, and trying to save or
+    delete one raises ReadOnlyError.
+    """
+    return getattr(obj, Storable.ORIG_VER_FIELD_NAME, None) is _READ_ONLY
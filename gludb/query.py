@@ -0,0 +1,268 @@
+"""Index predicates for find_by_index and iter_by_index.
+
+Normally find_by_index returns the objects whose index has the value given.
+You can also pass one of the predicates created by the functions here in
+place of the value:
+
+    from gludb.query import gte, between, one_of
+
+    MyClass.find_by_index('last_update', gte('2016-01-01'))
+    MyClass.find_by_index('age_group', between('20', '29'))
+    MyClass.find_by_index('status', one_of(['new', 'open', 'pending']))
+
+Backends handle predicates in the database (SQL comparisons and IN, MongoDB
+query operators, DynamoDB scan filters, and GCD property filters). Keep in
+mind that index values are stored as strings, so comparisons are string
+comparisons (e.g. '10' < '9').
+
+Indexes declared with a type (e.g. @Index(type=int) in gludb.simple) are
+stored as that type, so they compare (and sort) as numbers or timestamps. See
+index_value for the conversions.
+
+Predicates also work with find_where, which queries fields in the stored data
+instead of index values. Those comparisons use the field's JSON type: a field
+only matches operands of the same type (see json_type), so gt(30) doesn't
+match strings or booleans.
+"""
+
+import numbers
+import datetime
+
+from .utils import parse_now_field
+
+# The types an index can be declared with
+INDEX_TYPES = (str, int, float, datetime.datetime)
+
+
+class Predicate(object):
+    """A comparison to use for an index value in a query.
+
+    op is one of the names in OPERATORS and values is the list of operands:
+    one value for the comparison operators, (low, high) for between (which
+    includes both ends), and any number of values for one_of.
+    """
+
+    OPERATORS = ('eq', 'gt', 'gte', 'lt', 'lte', 'between', 'one_of')
+
+    def __init__(self, op, values):
+        """Create a predicate - you probably want the functions below."""
+        if op not in self.OPERATORS:
+            raise ValueError('Unknown index predicate %s' % repr(op))
+        self.op = op
+        self.values = list(values)
+
+    def __repr__(self):
+        """Readable version of the predicate for debugging."""
+        return 'Predicate(%s, %s)' % (repr(self.op), repr(self.values))
+
+    def __eq__(self, other):
+        """Predicates are equal if their operators and operands are."""
+        if not isinstance(other, Predicate):
+            return NotImplemented
+        return self.op == other.op and self.values == other.values
+
+    def __ne__(self, other):
+        """Python 2 doesn't derive != from ==."""
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def matches(self, value):
+        """Return True if the index value satisfies the predicate.
+
+        This is for checking index values outside of the database, so (like
+        the database) we compare string versions of the values.
+        """
+        return _compare(self.op, str(value), [str(v) for v in self.values])
+
+    def matches_field(self, value):
+        """Return True if the value of a stored field satisfies the predicate.
+
+        Unlike index values, field values are compared as they are (see
+        find_where). None is only equal to None (which is also what we use
+        for a missing field), and values that can't be compared don't match.
+        """
+        if value is None and self.op not in ('eq', 'one_of'):
+            return False
+
+        value_type = json_type(value)
+        operands = self.values
+        if self.op == 'one_of':
+            operands = [v for v in operands if json_type(v) == value_type]
+        elif any(json_type(v) != value_type for v in operands):
+            return False
+
+        try:
+            return _compare(self.op, value, operands)
+        except TypeError:
+            return False
+
+
+def _compare(op, value, operands):
+    if op == 'eq':
+        return value == operands[0]
+    elif op == 'gt':
+        return value > operands[0]
+    elif op == 'gte':
+        return value >= operands[0]
+    elif op == 'lt':
+        return value < operands[0]
+    elif op == 'lte':
+        return value <= operands[0]
+    elif op == 'between':
+        return operands[0] <= value <= operands[1]
+    else:
+        return value in operands
+
+
+def json_type(value):
+    """Return the JSON type of a stored field value or find_where operand.
+
+    The type is one of 'null', 'boolean', 'number', 'string', 'array', or
+    'object' (the names used by PostgreSQL's jsonb_typeof).
+    """
+    if value is None:
+        return 'null'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, numbers.Number):
+        return 'number'
+    elif isinstance(value, (list, tuple)):
+        return 'array'
+    elif isinstance(value, dict):
+        return 'object'
+    return 'string'
+
+
+def where_matches(values, where):
+    """Return True if the dict values satisfies every condition in where.
+
+    where is a dict of field name to value (or Predicate), as used by
+    find_where, and values is the (deserialized) data of a stored object.
+    """
+    return all(
+        as_predicate(cond).matches_field(values.get(name, None))
+        for name, cond in where.items()
+    )
+
+
+def as_predicate(value):
+    """Return value if it's a Predicate, otherwise an equality predicate.
+
+    Backends use this so that plain values and predicates are handled the
+    same way.
+    """
+    if isinstance(value, Predicate):
+        return value
+    return Predicate('eq', [value])
+
+
+def index_value(value, index_type=str):
+    """Convert an index value (or query operand) to the index's type.
+
+    None stays None. Timestamp indexes accept datetimes and the strings from
+    gludb.utils.now_field (which are UTC). Anything else that can't be
+    converted raises ValueError.
+    """
+    if value is None:
+        return None
+    if index_type is str:
+        return str(value)
+    if index_type is datetime.datetime:
+        if isinstance(value, datetime.datetime):
+            return value
+        parsed = None
+        if hasattr(value, 'startswith'):
+            parsed = parse_now_field(value)
+        if parsed is None:
+            raise ValueError('Not a timestamp: %s' % repr(value))
+        return parsed
+    return index_type(value)
+
+
+def typed_predicate(value, index_type=str, convert=None):
+    """Return a Predicate for value with operands converted by index_value.
+
+    If convert is given, it is called on every converted operand (backends
+    use this for their own representation of a type).
+    """
+    pred = as_predicate(value)
+    values = [index_value(val, index_type) for val in pred.values]
+    if convert is not None:
+        values = [convert(val) for val in values]
+    return Predicate(pred.op, values)
+
+
+def gt(value):
+    """Index values greater than value."""
+    return Predicate('gt', [value])
+
+
+def gte(value):
+    """Index values greater than or equal to value."""
+    return Predicate('gte', [value])
+
+
+def lt(value):
+    """Index values less than value."""
+    return Predicate('lt', [value])
+
+
+def lte(value):
+    """Index values less than or equal to value."""
+    return Predicate('lte', [value])
+
+
+def between(low, high):
+    """Index values from low to high (including both)."""
+    return Predicate('between', [low, high])
+
+
+def one_of(values):
+    """Index values equal to any of the given values."""
+    return Predicate('one_of', values)
+
+
+_SQL_OPERATORS = {'eq': '=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+
+def sql_condition(column, value, placeholder='?', convert=None):
+    """Return a (condition, params) tuple for a SQL where clause.
+
+    value is a plain value or a Predicate. placeholder is the parameter
+    marker for the database driver, and convert (if given) is called on
+    every parameter.
+    """
+    pred = as_predicate(value)
+    params = [convert(v) for v in pred.values] if convert else pred.values
+
+    if pred.op == 'between':
+        cond = '%s between %s and %s' % (column, placeholder, placeholder)
+    elif pred.op == 'one_of':
+        if not params:
+            return '1 = 0', []
+        cond = '%s in (%s)' % (column, ','.join([placeholder] * len(params)))
+    else:
+        cond = '%s %s %s' % (column, _SQL_OPERATORS[pred.op], placeholder)
+
+    return cond, params
+
+
+def sql_keyset(column, after_id, after_value, placeholder='?'):
+    """Return (condition, params) for the rows after a row in a paged query.
+
+    Rows are ordered by column and then id, with NULLs first (SQLite's
+    default - PostgreSQL needs NULLS FIRST in the order by), and the row we
+    start after has id after_id and after_value in column. NULL never
+    compares as true, so a NULL after_value needs its own condition.
+    """
+    if after_value is None:
+        cond = '(%s is not null or id > %s)' % (column, placeholder)
+        return cond, [after_id]
+
+    cond = '(%s > %s or (%s = %s and id > %s))' % (
+        column, placeholder, column, placeholder, placeholder
+    )
+    return cond, [after_value, after_value, after_id]
+
@@ -0,0 +1,573 @@
+"""Serialization of gludb data.
+
+Everything gludb serializes (to_data/from_data in gludb.simple, version
+history, and the values backends read and write) goes through dumps and loads
+here. They use the standard library's json module unless you call
+use_json_codec('orjson') (which needs the orjson package). orjson is much
+faster, but its output isn't identical: it's compact (no spaces), and it
+serializes some values the json module rejects (e.g. UUIDs become strings).
+NaN and infinite floats are written by the json module even with orjson,
+since orjson would store them as null.
+
+Backends that store data as an opaque value (sqlite, DynamoDB, and Google
+Cloud Datastore) can also store it in a compact binary format. A class picks
+one with its serializer class method (e.g. DBObject(serializer='msgpack') in
+gludb.simple). Binary payloads start with a tag byte naming their format, and
+JSON never starts with one of those, so existing JSON rows keep loading after
+a class changes formats (and are rewritten in the new format the next time
+they are saved). Backends that store structured documents (MongoDB and
+PostgreSQL) always store JSON.
+
+The same backends can also compress stored data (see Compression). Compressed
+payloads have their own tag byte, so compressed and uncompressed rows can be
+mixed too. compression_stats reports how well compression is working and how
+long it takes.
+"""
+
+import json
+import time
+import threading
+
+# orjson is imported by use_json_codec('orjson'), so importing gludb doesn't
+# pay for it
+orjson = None
+
+# Python 2 doesn't have perf_counter
+_timer = getattr(time, 'perf_counter', time.time)
+
+# Python 2&3 compatible text type
+try:
+    _text_type = unicode
+except NameError:
+    _text_type = str
+
+
+def _std_dumps(value):
+    return json.dumps(value)
+
+
+_INF = float('inf')
+
+
+def _has_non_finite(value):
+    if isinstance(value, float):
+        return value != value or value in (_INF, -_INF)
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, (list, tuple)):
+        return False
+    return any(_has_non_finite(v) for v in value)
+
+
+def _orjson_dumps(value):
+    try:
+        text = orjson.dumps(value, option=_ORJSON_OPTIONS)
+    except TypeError:
+        # Values orjson won't handle (e.g. integers over 64 bits) get the same
+        # treatment they always have
+        return json.dumps(value)
+    if b'null' in text and _has_non_finite(value):
+        # orjson writes NaN and infinity as null, which would lose them
+        return json.dumps(value)
+    return text.decode('utf-8')
+
+
+def _orjson_loads(text):
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        # The standard library accepts a few things orjson doesn't (NaN)
+        return json.loads(text)
+
+
+def _std_codec():
+    return _std_dumps, json.loads
+
+
+def _orjson_codec():
+    global orjson, _ORJSON_OPTIONS
+    import orjson
+    # datetimes aren't JSON, so they still raise TypeError
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    return _orjson_dumps, _orjson_loads
+
+
+# JSON codec name => function returning (dumps, loads), which raises
+# ImportError if the codec's package isn't installed
+JSON_CODECS = {'json': _std_codec, 'orjson': _orjson_codec}
+
+_json_codec = 'json'
+_dumps, _loads = _std_codec()
+
+
+def use_json_codec(name):
+    """Use the named JSON codec (one of the JSON_CODECS) from now on.
+
+    The default is 'json' (the standard library). 'orjson' needs the orjson
+    package, which is imported the first time it's used.
+    """
+    global _json_codec, _dumps, _loads
+    if name not in JSON_CODECS:
+        raise ValueError('Unknown JSON codec %s' % repr(name))
+    try:
+        codec = JSON_CODECS[name]()
+    except ImportError:
+        raise ValueError('JSON codec %s is not installed' % repr(name))
+    _json_codec = name
+    _dumps, _loads = codec
+
+
+def json_codecs():
+    """Return the names of the JSON codecs that are installed (sorted)."""
+    names = []
+    for name in sorted(JSON_CODECS):
+        try:
+            JSON_CODECS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def json_codec():
+    """Return the name of the JSON codec in use."""
+    return _json_codec
+
+
+def dumps(value):
+    """Return value serialized as JSON text."""
+    return _dumps(value)
+
+
+def loads(text):
+    """Return the value for the JSON text."""
+    return _loads(text)
+
+
+class JSONSerializer(object):
+    """Stored data as JSON text (what gludb has always stored)."""
+
+    name = 'json'
+    tag = None
+    binary = False
+
+    def dumps(self, value):
+        """Return value as JSON text."""
+        return dumps(value)
+
+    def loads(self, payload):
+        """Return the value for the JSON text payload."""
+        return loads(payload)
+
+
+class MsgpackSerializer(object):
+    """Stored data as MessagePack, which needs the msgpack package."""
+
+    name = 'msgpack'
+    tag = b'\x01'
+    binary = True
+
+    def __init__(self):
+        """Fail now (instead of on the first save) without msgpack."""
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        """Return value as MessagePack bytes."""
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, payload):
+        """Return the value for the MessagePack payload.
+
+        Payloads are encoded from the data dictionary, so dictionary keys
+        that aren't strings stay that way (JSON would make them strings).
+        """
+        return self.msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+# Serializer classes by name, and instances created as they're needed
+_SERIALIZER_CLASSES = {
+    JSONSerializer.name: JSONSerializer,
+    MsgpackSerializer.name: MsgpackSerializer,
+}
+_serializers = {}
+
+
+def register_serializer(serializer_class):
+    """Make a serializer class available by its name.
+
+    Binary serializers need a tag: a single byte (other than those used by
+    the serializers already registered) that JSON text can't start with.
+    """
+    if serializer_class.binary:
+        tag = serializer_class.tag
+        if len(tag or b'') != 1 or tag in b'{[ \t\r\n':
+            raise ValueError('Binary serializers need a one byte tag')
+        if tag in _reserved_tags():
+            raise ValueError('Tag %s is used for compression' % repr(tag))
+        for other in _SERIALIZER_CLASSES.values():
+            if other.tag == tag and other.name != serializer_class.name:
+                raise ValueError('Tag %s is used by %s' % (
+                    repr(tag), other.name
+                ))
+    _SERIALIZER_CLASSES[serializer_class.name] = serializer_class
+    _serializers.pop(serializer_class.name, None)
+
+
+def get_serializer(name=None):
+    """Return the serializer with the given name (None means JSON)."""
+    name = name or JSONSerializer.name
+    serializer = _serializers.get(name, None)
+    if serializer is None:
+        serializer_class = _SERIALIZER_CLASSES.get(name, None)
+        if serializer_class is None:
+            raise ValueError('Unknown serializer %s' % repr(name))
+        serializer = _serializers[name] = serializer_class()
+    return serializer
+
+
+def class_serializer(cls):
+    """Return the serializer for the stored data of cls.
+
+    Classes choose one with the optional serializer class method (see
+    gludb.data.Storable). The default is JSON.
+    """
+    method = getattr(cls, 'serializer', None)
+    return get_serializer(method() if method else None)
+
+
+class _EncodedText(str):
+    """JSON text that also carries its binary encoding (see encode_data)."""
+
+    pass
+
+
+def encode_data(cls, values):
+    """Return the JSON text for the data dictionary values of cls.
+
+    If cls uses a binary format, the encoding is made now (from values,
+    instead of decoding the JSON again when it's stored) and travels with the
+    text to encode_payload. Use strip_encoding on the text before keeping it
+    around.
+    """
+    data = dumps(values)
+    serializer = class_serializer(cls)
+    if serializer.binary and type(data) is str:
+        try:
+            encoded = serializer.tag + serializer.dumps(values)
+        except (TypeError, ValueError):
+            return data  # encode_payload tries again from the JSON
+        data = _EncodedText(data)
+        data.encoded = encoded
+    return data
+
+
+def strip_encoding(data):
+    """Return data without the binary encoding encode_data attached."""
+    return str(data) if isinstance(data, _EncodedText) else data
+
+
+def encode_payload(cls, data):
+    """Return the value an opaque-value backend should store for data.
+
+    data is the JSON from cls's to_data (or encode_data). JSON that isn't
+    compressed is stored as is (text). Anything else is returned as a
+    bytearray so that backends can tell it's binary: a tag byte followed by
+    the encoding (binary serializers), possibly inside another tag byte and
+    the compressed encoding (see Compression).
+    """
+    serializer = class_serializer(cls)
+    payload = data
+    if serializer.binary:
+        payload = getattr(data, 'encoded', None)
+        if payload is None:
+            payload = serializer.tag + serializer.dumps(loads(data))
+
+    compression = class_compression(cls)
+    if compression is not None:
+        compressed = compression.compress(payload)
+        if compressed is not None:
+            return bytearray(compressed)
+
+    return bytearray(payload) if serializer.binary else payload
+
+
+def stores_json(cls):
+    """Return True if every payload encode_payload makes for cls is JSON text.
+
+    Backends that can query inside JSON values (e.g. SQLite's json_extract)
+    can only do that for these classes.
+    """
+    return not class_serializer(cls).binary and class_compression(cls) is None
+
+
+def _payload_bytes(payload):
+    # Backends hand us text, bytes, or a buffer/memoryview for sqlite blobs
+    if isinstance(payload, _text_type):
+        return None
+    return bytes(payload)
+
+
+def _decoded(payload):
+    # Return (serializer, encoded value) for a payload: compression is
+    # removed, and serializer is None for JSON (with the value as text or
+    # UTF-8 bytes)
+    while True:
+        raw = _payload_bytes(payload)
+        if not raw:
+            return None, payload
+        tag = raw[:1]
+        compressor = _compressor_for_tag(tag)
+        if compressor is not None:
+            payload = _decompress(compressor, raw[1:])
+            continue
+        for serializer_class in _SERIALIZER_CLASSES.values():
+            if serializer_class.binary and serializer_class.tag == tag:
+                return get_serializer(serializer_class.name), raw[1:]
+        return None, raw
+
+
+def _json_text(encoded):
+    if isinstance(encoded, _text_type):
+        return encoded
+    try:
+        return encoded.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError('Unknown stored data format')
+
+
+def payload_values(payload):
+    """Return the (decoded) data for a stored payload of any format."""
+    serializer, encoded = _decoded(payload)
+    if serializer is not None:
+        return serializer.loads(encoded)
+    return loads(_json_text(encoded))
+
+
+def decode_payload(payload):
+    """Return (values, text) for a stored payload of any format.
+
+    Binary formats are decoded straight to the data dictionary (values), with
+    text None. JSON payloads are returned as text (for from_data), with
+    values None.
+    """
+    serializer, encoded = _decoded(payload)
+    if serializer is not None:
+        return serializer.loads(encoded), None
+    return None, _json_text(encoded)
+
+
+def payload_text(payload):
+    """Return the JSON (as from to_data) for a stored payload."""
+    serializer, encoded = _decoded(payload)
+    if serializer is not None:
+        return dumps(serializer.loads(encoded))
+    return _json_text(encoded)
+
+
+class ZlibCompressor(object):
+    """zlib compression (from the standard library)."""
+
+    name = 'zlib'
+    tag = b'\x02'
+
+    def __init__(self):
+        """Import zlib (which some Python builds don't have)."""
+        import zlib
+        self.zlib = zlib
+
+    def compress(self, raw, level=None):
+        """Return raw compressed, at level 0-9 (default 6)."""
+        return self.zlib.compress(raw, 6 if level is None else level)
+
+    def decompress(self, compressed):
+        """Return the bytes that were compressed."""
+        return self.zlib.decompress(compressed)
+
+
+class LzmaCompressor(object):
+    """LZMA (xz) compression, which needs Python 3.3+.
+
+    It's slower than zlib, but usually compresses further.
+    """
+
+    name = 'lzma'
+    tag = b'\x03'
+
+    def __init__(self):
+        """Import lzma (Python 3.3+)."""
+        import lzma
+        self.lzma = lzma
+
+    def compress(self, raw, level=None):
+        """Return raw compressed, with preset level 0-9 (default 6)."""
+        return self.lzma.compress(raw, preset=level)
+
+    def decompress(self, compressed):
+        """Return the bytes that were compressed."""
+        return self.lzma.decompress(compressed)
+
+
+_COMPRESSOR_CLASSES = {
+    ZlibCompressor.name: ZlibCompressor,
+    LzmaCompressor.name: LzmaCompressor,
+}
+_compressors = {}
+
+
+def get_compressor(name):
+    """Return the compressor with the given name ('zlib' or 'lzma')."""
+    compressor = _compressors.get(name, None)
+    if compressor is None:
+        compressor_class = _COMPRESSOR_CLASSES.get(name, None)
+        if compressor_class is None:
+            raise ValueError('Unknown compression %s' % repr(name))
+        compressor = _compressors[name] = compressor_class()
+    return compressor
+
+
+def _reserved_tags():
+    return [c.tag for c in _COMPRESSOR_CLASSES.values()]
+
+
+def _compressor_for_tag(tag):
+    for compressor_class in _COMPRESSOR_CLASSES.values():
+        if compressor_class.tag == tag:
+            return get_compressor(compressor_class.name)
+    return None
+
+
+class CompressionStats(object):
+    """Running totals for one kind of compression (see compression_stats).
+
+    Payloads that were compressed count towards raw_bytes and stored_bytes
+    (so ratio is raw_bytes / stored_bytes for them). skipped counts payloads
+    that were large enough to try but didn't get smaller (they're stored
+    uncompressed). The times are in seconds.
+    """
+
+    def __init__(self):
+        """Start with everything at zero."""
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    @property
+    def ratio(self):
+        """Return raw_bytes / stored_bytes (or None before any compression)."""
+        if not self.stored_bytes:
+            return None
+        return float(self.raw_bytes) / self.stored_bytes
+
+    def as_dict(self):
+        """Return the totals (and ratio) as a dictionary."""
+        values = dict(self.__dict__)
+        values['ratio'] = self.ratio
+        return values
+
+
+_stats_lock = threading.Lock()
+_stats = {}  # Compressor name => CompressionStats
+
+
+def _record(name, **amounts):
+    with _stats_lock:
+        stats = _stats.get(name, None)
+        if stats is None:
+            stats = _stats[name] = CompressionStats()
+        for key, amount in amounts.items():
+            setattr(stats, key, getattr(stats, key) + amount)
+
+
+def compression_stats():
+    """Return a dictionary of compressor name to its CompressionStats totals.
+
+    The totals (as dictionaries, see CompressionStats.as_dict) cover every
+    payload compressed or decompressed by this process since the last call
+    to reset_compression_stats.
+    """
+    with _stats_lock:
+        return dict((name, stats.as_dict()) for name, stats in _stats.items())
+
+
+def reset_compression_stats():
+    """Set all the compression totals back to zero."""
+    with _stats_lock:
+        _stats.clear()
+
+
+def _decompress(compressor, compressed):
+    start = _timer()
+    raw = compressor.decompress(compressed)
+    _record(
+        compressor.name,
+        decompressed=1,
+        decompress_seconds=_timer() - start
+    )
+    return raw
+
+
+class Compression(object):
+    """Compression settings for the stored data of a class.
+
+    Give one to DBObject (or return one from a Storable's compression class
+    method). method is 'zlib' or 'lzma'. Payloads smaller than min_size bytes
+    aren't compressed, and neither are payloads that compression doesn't
+    make smaller. level is the compressor's level (None for its default).
+    """
+
+    def __init__(self, method='zlib', min_size=1024, level=None):
+        """Check that the method is available now, not on the first save."""
+        self.compressor = get_compressor(method)
+        self.method = method
+        self.min_size = min_size
+        self.level = level
+
+    def __repr__(self):
+        """Readable version for debugging."""
+        return 'Compression(%s, min_size=%d, level=%s)' % (
+            repr(self.method), self.min_size, repr(self.level)
+        )
+
+    def compress(self, payload):
+        """Return the tagged, compressed payload, or None to store it as is."""
+        raw = payload
+        if isinstance(raw, _text_type):
+            raw = raw.encode('utf-8')
+        if len(raw) < self.min_size:
+            return None
+
+        start = _timer()
+        compressed = self.compressor.compress(raw, self.level)
+        elapsed = _timer() - start
+
+        stored = len(compressed) + 1
+        if stored >= len(raw):
+            _record(self.method, skipped=1, compress_seconds=elapsed)
+            return None
+        _record(
+            self.method,
+            compressed=1,
+            raw_bytes=len(raw),
+            stored_bytes=stored,
+            compress_seconds=elapsed
+        )
+        return self.compressor.tag + compressed
+
+
+def class_compression(cls):
+    """Return the Compression for the stored data of cls (or None).
+
+    Classes choose compression with the optional compression class method
+    (see gludb.data.Storable), which can return a Compression or just a
+    method name.
+    """
+    method = getattr(cls, 'compression', None)
+    compression = method() if method else None
+    if compression is None or isinstance(compression, Compression):
+        return compression
+    return Compression(compression)
@@ -0,0 +1,177 @@
+"""Provide sessions: a unit-of-work scope for gludb objects.
+
+Inside a session, every object loaded or saved is kept in an identity map,
+so loading the same (class, id) again returns the SAME instance without going
+to the database:
+
+    from gludb.session import Session
+
+    with Session():
+        a = MyClass.find_one(some_id)   # Read from the database
+        b = MyClass.find_one(some_id)   # No database call: b is a
+        a.name = 'new name'
+        a.save()                        # Not written yet...
+    # ... all saves in the session are written here, with one save_many per
+    # database
+
+Sessions are per thread and per asyncio task (on Python 3.7+ the current
+session is kept in a context variable, so concurrent tasks on one event loop
+each see their own), and each has at most one current session (a session
+started inside another session replaces it until it exits). If the with block
+exits with an exception (or flushing fails), the pending saves are discarded
+and the objects get back the original versions they had before they were
+saved, so saving them again later writes them.
+
+Some notes:
+
+* Queries (find_all, find_by_index, etc) still go to the database, although
+  any object in the identity map is returned instead of a new instance. Objects
+  with pending saves aren't written until the session is flushed, so call
+  flush() first if a query needs to see them.
+* Read-only loads (readonly=True) skip the session completely.
+* Deletes are NOT deferred: the object is deleted immediately (and removed from
+  the session).
+* Calling save on an object records what the object looks like at that time
+  (e.g. changes made after calling save aren't written unless you call save
+  again).
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from .config import get_mapping
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+if ContextVar is not None:
+    _current = ContextVar('gludb_session', default=None)
+
+    def current_session():
+        """Return the session for the current thread or task (or None)."""
+        return _current.get()
+
+    def _set_session(session):
+        # Return a token for _reset_session
+        return _current.set(session)
+
+    def _reset_session(token):
+        _current.reset(token)
+else:
+    # Python 2 (and 3 before 3.7) - no asyncio tasks to keep apart
+    _session_state = threading.local()
+
+    def current_session():
+        """Return the session for the current thread (or None)."""
+        return getattr(_session_state, 'session', None)
+
+    def _set_session(session):
+        token = current_session()
+        _session_state.session = session
+        return token
+
+    def _reset_session(token):
+        _session_state.session = token
+
+
+class Session(object):
+    """Identity map and pending saves for objects used in a with block."""
+
+    def __init__(self):
+        """Create an empty session - it's used when entered as a context."""
+        self.identity_map = {}  # (class, id) => instance
+        self.pending = OrderedDict()  # (class, id) => (instance, data)
+        self.orig_versions = {}  # (class, id) => orig version before saving
+        self.token = None
+
+    def __enter__(self):
+        """Make this the current session for this thread or task."""
+        self.token = _set_session(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Flush the session unless we're exiting with an exception."""
+        _reset_session(self.token)
+        self.token = None
+
+        if exc_type is None:
+            try:
+                self.flush()
+            except Exception:
+                self.discard()
+                raise
+        else:
+            self.discard()
+
+        self.identity_map.clear()
+        return False
+
+    def get(self, cls, id):
+        """Return the instance for (cls, id) in this session (or None)."""
+        return self.identity_map.get((cls, id), None)
+
+    def add(self, obj):
+        """Add the instance to the identity map and return the mapped instance.
+
+        If the session already has a different instance for the same class and
+        id, then THAT instance is returned (and obj is ignored).
+        """
+        if obj is None:
+            return None
+        key = (obj.__class__, obj.get_id())
+        return self.identity_map.setdefault(key, obj)
+
+    def add_pending(self, obj, data):
+        """Record that obj should be saved (as data) when the session ends."""
+        key = (obj.__class__, obj.get_id())
+        self.identity_map[key] = obj
+        self.pending.pop(key, None)
+        self.pending[key] = (obj, data)
+        # The caller replaces the original version after this, so keep the
+        # one that matches the database in case the save is discarded
+        from .data import Storable
+        self.orig_versions.setdefault(
+            key, getattr(obj, Storable.ORIG_VER_FIELD_NAME, None)
+        )
+
+    def remove(self, obj):
+        """Remove the instance (and any pending save) from the session."""
+        key = (obj.__class__, obj.get_id())
+        self.identity_map.pop(key, None)
+        self.pending.pop(key, None)
+        self.orig_versions.pop(key, None)
+
+    def discard(self):
+        """Drop all pending saves, restoring each object's original version."""
+        from .data import Storable
+        for key, (obj, _) in self.pending.items():
+            if key in self.orig_versions:
+                orig = self.orig_versions[key]
+                setattr(obj, Storable.ORIG_VER_FIELD_NAME, orig)
+        self.pending.clear()
+        self.orig_versions.clear()
+
+    def flush(self):
+        """Write all pending saves, with one save_many call per database."""
+        groups = []
+        by_db = dict()
+        for (cls, _), (obj, data) in self.pending.items():
+            db = get_mapping(cls)
+            if id(db) not in by_db:
+                by_db[id(db)] = ([], [])
+                groups.append((db, by_db[id(db)]))
+            objs, data_list = by_db[id(db)]
+            objs.append(obj)
+            data_list.append(data)
+
+        # Pending saves are only removed once they are written
+        for db, (objs, data_list) in groups:
+            db.save_many(objs, data_list)
+            for obj in objs:
+                key = (obj.__class__, obj.get_id())
+                self.pending.pop(key, None)
+                self.orig_versions.pop(key, None)
@@ -42,12 +42,18 @@ you should use `Field(default=dict)`.
 
 # pylama:ignore=D204,D213,D401
 
-import json
-
-from .config import apply_db_application_prefix
-from .utils import now_field
-from .data import Storable, DatabaseEnabled, orig_version
+from .config import apply_db_application_prefix, get_mapping
+from .utils import now_field, uuid
+from .serializers import (
+    dumps,
+    loads,
+    encode_data,
+    get_serializer,
+    Compression,
+)
+from .data import Storable, DatabaseEnabled, is_readonly, _orig_values
 from .versioning import VersioningTypes, record_diff, append_diff_hist
+from .query import INDEX_TYPES
 
 
 class _NO_VAL:
@@ -58,10 +64,16 @@ class _NO_VAL:
 class Field(object):
     """Support for class-level field declaration."""
 
-    def __init__(self, default=''):
-        """Ctor - should have a default (default is empty string)."""
+    def __init__(self, default='', deferred=False):
+        """Ctor - should have a default (default is empty string).
+
+        A deferred field isn't stored with the rest of the object's data: it
+        is only read from the database the first time it's used (see
+        DBObject).
+        """
         self.name = None
         self.default = default
+        self.deferred = deferred
 
     def get_default_val(self):
         """Helper to expand default value (support callables)."""
@@ -71,13 +83,25 @@ class Field(object):
         return val
 
 
+def _field_specs(fields):
+    # What __init__ and to_data need for each field, worked out once when the
+    # class is decorated: (name, field, True if the default must be called)
+    return tuple((fld.name, fld, callable(fld.default)) for fld in fields)
+
+
+def _default_val(fld, call_default):
+    # Same as fld.get_default_val(), without the call for plain defaults
+    return fld.get_default_val() if call_default else fld.default
+
+
 def _auto_init(self, *args, **kwrds):
     """Our decorator will add this as __init__ to target classes."""
-    for fld in getattr(self, '__fields__', []):
-        val = kwrds.get(fld.name, _NO_VAL)
-        if val is _NO_VAL:
-            val = fld.get_default_val()
-        setattr(self, fld.name, val)
+    for name, fld, call_default in getattr(self, '__field_specs__', ()):
+        if name in kwrds:
+            val = kwrds[name]
+        else:
+            val = _default_val(fld, call_default)
+        setattr(self, name, val)
 
     if callable(getattr(self, 'setup', None)):
         self.setup(*args, **kwrds)
@@ -103,6 +127,36 @@ def ctor_overridable(cls):
     return False  # Not on our list
 
 
+def _make_init(cls):
+    # Generate the same __init__ as _auto_init, but with a line per field
+    # (as attrs and dataclasses do) instead of a loop over __field_specs__.
+    # Each default is a name in the function's globals.
+    namespace = {}
+    lines = ['def __init__(self, *args, **kwrds):']
+    for pos, (name, fld, call_default) in enumerate(cls.__field_specs__):
+        if call_default:
+            namespace['_field_%d' % pos] = fld
+            default = '_field_%d.get_default_val()' % pos
+        else:
+            namespace['_default_%d' % pos] = fld.default
+            default = '_default_%d' % pos
+        lines.append('    self.%s = kwrds[%r] if %r in kwrds else %s' % (
+            name, name, name, default
+        ))
+    lines.append("    if callable(getattr(self, 'setup', None)):")
+    lines.append('        self.setup(*args, **kwrds)')
+
+    filename = '<gludb.simple generated %s.__init__>' % cls.__name__
+    exec(compile('\n'.join(lines) + '\n', filename, 'exec'), namespace)
+
+    init = namespace['__init__']
+    init.__doc__ = _auto_init.__doc__
+    if hasattr(cls, '__qualname__'):
+        init.__qualname__ = cls.__qualname__ + '.__init__'
+    init._clobber_ok = True  # Decorating a subclass replaces it
+    return init
+
+
 def _get_table_name(cls):
     return apply_db_application_prefix(cls.__table_name__)
 
@@ -115,30 +169,193 @@ def _set_id(self, new_id):
     self.id = new_id
 
 
-def _to_data(self):
-    def getval(fld):
-        val = getattr(self, fld.name, _NO_VAL)
-        if val is _NO_VAL:
-            val = fld.get_default_val()
-        return val
+# Saving an object only to update _last_update would be pointless
+_VOLATILE_FIELDS = ('_last_update',)
+
+
+_VOLATILE_PATHS = [[name] for name in _VOLATILE_FIELDS]
+
+
+def _volatile_fields(cls):
+    return _VOLATILE_FIELDS
+
+
+def _serializer(cls):
+    return cls.__serializer__
+
+
+def _compression(cls):
+    return cls.__compression__
+
+
+def _data_dict(obj):
+    # The dictionary that to_data serializes
 
     # Update the datetime fields that we add automatically
     now = now_field()
-    setattr(self, '_last_update', now)
-    if not getattr(self, '_create_date', ''):
-        setattr(self, '_create_date', now)
+    obj._last_update = now
+    if not getattr(obj, '_create_date', ''):
+        obj._create_date = now
+
+    # Deferred fields are only included if they've been read (or set), and
+    # then we need all of them (see gludb.data.split_deferred)
+    deferred = obj.__deferred_fields__
+    if deferred:
+        loaded = [name for name in deferred if name in obj.__dict__]
+        if loaded and len(loaded) < len(deferred):
+            _load_deferred(obj.__class__, [obj])
+
+    data = {}
+    for name, fld, call_default in obj.__field_specs__:
+        if fld.deferred and name not in obj.__dict__:
+            continue
+        val = getattr(obj, name, _NO_VAL)
+        if val is _NO_VAL:
+            val = _default_val(fld, call_default)
+        data[name] = val
+    return data
+
+
+def _to_data(self):
+    return dumps(_data_dict(self))
 
-    data = dict([(fld.name, getval(fld)) for fld in self.__fields__])
 
-    return json.dumps(data)
+def _to_dict(self):
+    return _data_dict(self)
 
 
 def _from_data(cls, data):
-    data_dict = json.loads(data)
-    return cls(**data_dict)
+    return _from_dict(cls, loads(data))
 
 
-def _index_names(cls):
+def _from_dict(cls, data_dict):
+    obj = cls(**data_dict)
+    _unload_deferred(obj, data_dict)
+    return obj
+
+
+class _DeferredField(object):
+    """Class attribute standing in for a deferred Field.
+
+    Like _LazyField, we're only called when the instance doesn't have a value
+    for the field: we read the values of all the deferred fields for the
+    instance from the database and return the one asked for. Instances
+    loaded by the same query (see _share_deferred) are read along with it.
+    """
+
+    def __init__(self, fld):
+        """Stand in for the Field fld."""
+        self.field = fld
+
+    def __get__(self, obj, cls=None):
+        """Return the Field for the class, or read the value."""
+        if obj is None:
+            return self.field
+        group = obj.__dict__.get(_DEFERRED_GROUP_NAME, None) or [obj]
+        _load_deferred(obj.__class__, group)
+        return obj.__dict__[self.field.name]
+
+
+def _unload_deferred(obj, data_dict):
+    # The constructor set defaults for deferred fields that weren't in the
+    # data (because they're stored separately): remove them so that they're
+    # read when used
+    for name in obj.__deferred_fields__:
+        if name not in data_dict:
+            obj.__dict__.pop(name, None)
+
+
+def _load_deferred(cls, objs):
+    # Read the deferred fields that the objects don't have with a single
+    # find_deferred call. Objects without an id haven't been saved, so they
+    # just get the default values.
+    missing = [
+        obj for obj in objs
+        if any(name not in obj.__dict__ for name in cls.__deferred_fields__)
+    ]
+    ids = [obj.get_id() for obj in missing if obj.get_id()]
+    found = get_mapping(cls).find_deferred(cls, ids) if ids else {}
+
+    for obj in missing:
+        values = found.get(obj.get_id(), None) or {}
+        for name, fld, call_default in cls.__field_specs__:
+            if fld.deferred and name not in obj.__dict__:
+                if name in values:
+                    obj.__dict__[name] = values[name]
+                else:
+                    obj.__dict__[name] = _default_val(fld, call_default)
+
+
+def _load_deferred_many(cls, objs):
+    _load_deferred(cls, [obj for obj in objs if obj is not None])
+
+
+# Where instances keep the list of instances loaded by the same query
+_DEFERRED_GROUP_NAME = '_deferred_group'
+
+
+def _share_deferred(cls, obj, group):
+    # Loading the deferred fields of one instance in group reads them for
+    # all of them, so iterating over find_all results doesn't mean one
+    # find_deferred call per instance
+    obj.__dict__[_DEFERRED_GROUP_NAME] = group
+
+
+def _deferred_fields(cls):
+    return list(cls.__deferred_fields__)
+
+
+# Where lazy instances keep their JSON until it's decoded
+_LAZY_DATA_NAME = '_lazy_data'
+
+
+class _LazyField(object):
+    """Class attribute standing in for a Field in a lazy DBObject class.
+
+    Decoded instances have their field values in __dict__, which takes
+    precedence over us. So we're only called for an instance still holding
+    its JSON: we decode it (all fields at once) and return the value. On the
+    class itself we return the Field, so the class looks the same as before.
+    """
+
+    def __init__(self, fld):
+        """Stand in for the Field fld."""
+        self.field = fld
+
+    def __get__(self, obj, cls=None):
+        """Return the Field for the class, or decode the instance."""
+        if obj is None:
+            return self.field
+        _lazy_decode(obj)
+        try:
+            return obj.__dict__[self.field.name]
+        except KeyError:
+            raise AttributeError(self.field.name)
+
+
+def _lazy_decode(obj):
+    # Decode the JSON for a lazy instance (if it hasn't been). Fields set
+    # since the instance was loaded keep their new values.
+    data = obj.__dict__.pop(_LAZY_DATA_NAME, None)
+    if data is None:
+        return
+    data_dict = loads(data)
+    for name, _, _ in obj.__field_specs__:
+        if name in obj.__dict__:
+            data_dict[name] = obj.__dict__[name]
+    _auto_init(obj, **data_dict)
+    _unload_deferred(obj, data_dict)
+
+
+def _lazy_from_data(cls, data):
+    # The instance just keeps data until a field is used: the constructor
+    # (and so setup) runs then
+    obj = cls.__new__(cls)
+    obj.__dict__[_LAZY_DATA_NAME] = data
+    return obj
+
+
+def _find_index_names(cls):
     def is_index(name):
         attr = getattr(cls, name, None)
         return getattr(attr, 'is_index', False)
@@ -146,6 +363,35 @@ def _index_names(cls):
     return [name for name in dir(cls) if is_index(name)]
 
 
+def _index_names(cls):
+    # Index names are found when the class is decorated (this is called on
+    # every save). A class derived from a DBObject class without being
+    # decorated itself could have its own indexes, so we look for those.
+    names = cls.__dict__.get('__index_names__', None)
+    if names is None:
+        names = _find_index_names(cls)
+    return list(names)
+
+
+def _find_index_types(cls):
+    return dict(
+        (name, getattr(getattr(cls, name), 'index_type', str))
+        for name in _index_names(cls)
+    )
+
+
+def _index_types(cls):
+    # As for _index_names
+    types = cls.__dict__.get('__index_types__', None)
+    if types is None:
+        types = _find_index_types(cls)
+    return dict(types)
+
+
+def _composite_indexes(cls):
+    return list(cls.__composite_indexes__)
+
+
 def _indexes(self):
     def get_val(name):
         attr = getattr(self, name, None)
@@ -158,20 +404,61 @@ def _indexes(self):
     ])
 
 
+def _delta_data(obj):
+    # Record the diff being saved and return the data to save. We work with
+    # the data dictionary so that the object is only serialized once (the
+    # result is handed on to the actual save)
+    if not obj.get_id():
+        obj.set_id(uuid())
+
+    pre_changes = _orig_values(obj)
+    curr_data = _data_dict(obj)
+
+    # Deferred fields are stored separately, so they aren't versioned
+    diffed = curr_data
+    deferred = obj.__deferred_fields__
+    if deferred:
+        diffed = dict(
+            (name, val) for name, val in curr_data.items()
+            if name not in deferred
+        )
+        if pre_changes:
+            pre_changes = dict(
+                (name, val) for name, val in pre_changes.items()
+                if name not in deferred
+            )
+    diff = record_diff(pre_changes, diffed) if pre_changes else None
+
+    # A diff with nothing but volatile changes isn't a new version
+    if diff and all(stanza[0][:1] in _VOLATILE_PATHS for stanza in diff):
+        diff = None
+
+    # Need to save changes?
+    if diff:
+        ver_hist = obj.get_version_hist()
+        ver_hist = append_diff_hist(diff, ver_hist)
+        setattr(obj, '_version_hist', ver_hist)
+        curr_data['_version_hist'] = ver_hist
+
+    return encode_data(obj.__class__, curr_data)
+
+
 def _delta_save(save_method):
     def wrapper(self):
-        # Get the diff's being saved
-        pre_changes = orig_version(self)
-        curr_data = self.to_data()
-        diff = record_diff(pre_changes, curr_data) if pre_changes else None
+        if is_readonly(self):
+            return save_method(self)  # Raises without touching the object
+        return save_method(self, _delta_data(self))
 
-        # Need to save changes?
-        if diff:
-            ver_hist = self.get_version_hist()
-            ver_hist = append_diff_hist(diff, ver_hist)
-            setattr(self, '_version_hist', ver_hist)
+    return wrapper
 
-        return save_method(self)
+
+def _delta_save_many(save_many_method):
+    def wrapper(cls, objs):
+        objs = list(objs)
+        if any(is_readonly(obj) for obj in objs):
+            return save_many_method(cls, objs)  # As above
+        data_list = [_delta_data(obj) for obj in objs]
+        return save_many_method(cls, objs, data_list)
 
     return wrapper
 
@@ -185,8 +472,111 @@ def _get_version_hist(self):
         raise ValueError("Unknown versioning type")
 
 
-def DBObject(table_name, versioning=VersioningTypes.NONE):
-    """Classes annotated with DBObject gain persistence methods."""
+# Fields that DBObject adds to every class
+_AUTO_FIELDS = ('id', '_create_date', '_last_update', '_version_hist')
+
+
+def _slotted_class(cls, field_names):
+    """Return a copy of cls that uses __slots__ for the fields.
+
+    The Field class attributes are removed (a slot can't share its name with a
+    class attribute), and we add a slot for the original version that gludb
+    stores on loaded objects. Slots the class already declares are kept, and
+    slots that a base class already has aren't repeated. The copy keeps the
+    class's __qualname__, and methods that use zero-argument super() (or
+    __class__) refer to the copy.
+    """
+    namespace = dict(cls.__dict__)
+    own_slots = namespace.pop('__slots__', ())
+    if isinstance(own_slots, str):
+        own_slots = (own_slots,)
+    # The class's own slot descriptors are recreated by the new class
+    for name in list(field_names) + list(own_slots):
+        namespace.pop(name, None)
+    namespace.pop('__dict__', None)
+    namespace.pop('__weakref__', None)
+
+    inherited = set()
+    for base in cls.__mro__[1:]:
+        base_slots = base.__dict__.get('__slots__', ())
+        if isinstance(base_slots, str):
+            base_slots = (base_slots,)
+        inherited.update(base_slots)
+
+    wanted = set(field_names) | set(own_slots)
+    wanted.add(Storable.ORIG_VER_FIELD_NAME)
+    namespace['__slots__'] = tuple(sorted(wanted - inherited))
+
+    new_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    if hasattr(cls, '__qualname__'):
+        new_cls.__qualname__ = cls.__qualname__
+    _update_class_cells(new_cls, cls)
+    return new_cls
+
+
+def _update_class_cells(new_cls, old_cls):
+    # Functions using super() or __class__ in a class body get a closure cell
+    # holding the class: point the cells for old_cls at new_cls (like
+    # dataclasses does for slots=True). Python 2 has no such cells
+    for member in new_cls.__dict__.values():
+        if isinstance(member, (classmethod, staticmethod)):
+            funcs = [member.__func__]
+        elif isinstance(member, property):
+            funcs = [member.fget, member.fset, member.fdel]
+        else:
+            funcs = [member]
+
+        for func in funcs:
+            code = getattr(func, '__code__', None)
+            if code is None or '__class__' not in code.co_freevars:
+                continue
+            cell = func.__closure__[code.co_freevars.index('__class__')]
+            if cell.cell_contents is old_cls:
+                cell.cell_contents = new_cls
+
+
+def DBObject(table_name, versioning=VersioningTypes.NONE,
+             composite_indexes=None, slots=False, lazy=False,
+             serializer=None, compression=None):
+    """Classes annotated with DBObject gain persistence methods.
+
+    composite_indexes is an optional list of tuples of index names: backends
+    that support it create a database index over each group of indexes.
+
+    If slots is True, the class returned is a copy of the class using
+    __slots__ for the fields (including the ones we add), so instances don't
+    have a __dict__. Note that this means instances can only have the
+    attributes in __slots__ (so setup can only set fields or attributes you
+    list in the class's own __slots__).
+
+    If lazy is True, from_data (and so every load from the database) keeps
+    the JSON and only decodes it when a field is first used. The constructor
+    and setup run at that point. A lazy class can't also use slots. Note that
+    from_dict (used by backends that store documents, like MongoDB) isn't
+    lazy, since the document has already been decoded.
+
+    Fields declared with Field(deferred=True) aren't stored with the rest of
+    the data: backends keep them separately (see gludb.data.split_deferred),
+    and loaded instances read them from the database the first time one is
+    used (along with the other instances loaded by the same query). The
+    class method load_deferred reads them for any list of instances at once.
+    Deferred fields aren't included in version history, and they can't be
+    used with slots.
+
+    serializer is the name of the format (from gludb.serializers) for
+    backends that store data as an opaque value, e.g. 'msgpack'. The default
+    is JSON.
+
+    compression compresses the data stored by those same backends: it's a
+    gludb.serializers.Compression or just the name of the method ('zlib' or
+    'lzma'). The default is no compression.
+    """
+    if slots and lazy:
+        raise ValueError('A DBObject class can use slots or lazy, not both')
+    get_serializer(serializer)  # Unknown (or uninstalled) formats fail here
+    if compression is not None and not isinstance(compression, Compression):
+        compression = Compression(compression)
+
     def wrapped(cls):
         field_names = set()
         all_fields = []
@@ -198,6 +588,16 @@ def DBObject(table_name, versioning=VersioningTypes.NONE):
                 all_fields.append(fld)
                 field_names.add(name)
 
+        # Slotted base classes don't have their Field class attributes, so
+        # we use their field lists
+        for base in cls.__mro__[1:]:
+            if '__slots__' not in base.__dict__:
+                continue
+            for fld in base.__dict__.get('__fields__', []):
+                if fld.name not in field_names | set(_AUTO_FIELDS):
+                    all_fields.append(fld)
+                    field_names.add(fld.name)
+
         def add_missing_field(name, default='', insert_pos=None):
             if name not in field_names:
                 fld = Field(default=default)
@@ -213,10 +613,39 @@ def DBObject(table_name, versioning=VersioningTypes.NONE):
         if versioning == VersioningTypes.DELTA_HISTORY:
             add_missing_field('_version_hist', default=list)
 
+        if slots:
+            cls = _slotted_class(cls, [fld.name for fld in all_fields])
+        deferred = tuple(fld.name for fld in all_fields if fld.deferred)
+        if slots and deferred:
+            raise ValueError('A slots=True class can\'t have deferred fields')
+        for fld in all_fields:
+            if fld.deferred:
+                setattr(cls, fld.name, _DeferredField(fld))
+            elif lazy:
+                setattr(cls, fld.name, _LazyField(fld))
+
+        composites = [tuple(names) for names in composite_indexes or []]
+        index_names = _find_index_names(cls)
+        for names in composites:
+            if len(names) < 2 or not set(index_names).issuperset(names):
+                raise ValueError(
+                    'Composite index %s must be two or more index names' % (
+                        repr(names),
+                    )
+                )
+
         # Things we count on as part of our processing
         cls.__table_name__ = table_name
         cls.__versioning__ = versioning
         cls.__fields__ = all_fields
+        cls.__composite_indexes__ = composites
+        # Worked out once here instead of on every call
+        cls.__field_specs__ = _field_specs(all_fields)
+        cls.__index_names__ = tuple(index_names)
+        cls.__index_types__ = _find_index_types(cls)
+        cls.__deferred_fields__ = deferred
+        cls.__serializer__ = serializer
+        cls.__compression__ = compression
 
         # Give them a ctor for free - but make sure we aren't clobbering one
         if not ctor_overridable(cls):
@@ -224,18 +653,28 @@ def DBObject(table_name, versioning=VersioningTypes.NONE):
                 'Classes with user-supplied __init__ should not be decorated '
                 'with DBObject. Use the setup method'
             )
-        cls.__init__ = _auto_init
+        cls.__init__ = _make_init(cls)
 
         # Duck-type the class for our data methods
         cls.get_table_name = classmethod(_get_table_name)
         cls.get_id = _get_id
         cls.set_id = _set_id
         cls.to_data = _to_data
-        cls.from_data = classmethod(_from_data)
+        cls.from_data = classmethod(_lazy_from_data if lazy else _from_data)
+        cls.to_dict = _to_dict
+        cls.from_dict = classmethod(_from_dict)
         cls.index_names = classmethod(_index_names)
         cls.indexes = _indexes
+        cls.index_types = classmethod(_index_types)
+        cls.composite_indexes = classmethod(_composite_indexes)
+        cls.deferred_fields = classmethod(_deferred_fields)
+        cls.share_deferred = classmethod(_share_deferred)
+        cls.volatile_fields = classmethod(_volatile_fields)
+        cls.serializer = classmethod(_serializer)
+        cls.compression = classmethod(_compression)
         # Bonus methods they get for using gludb.simple
         cls.get_version_hist = _get_version_hist
+        cls.load_deferred = classmethod(_load_deferred_many)
 
         # Register with our abc since we actually implement all necessary
         # functionality
@@ -247,13 +686,21 @@ def DBObject(table_name, versioning=VersioningTypes.NONE):
 
         if versioning == VersioningTypes.DELTA_HISTORY:
             cls.save = _delta_save(cls.save)
+            cls.save_many = classmethod(
+                _delta_save_many(cls.save_many.__func__)
+            )
+            if hasattr(cls, 'asave'):
+                cls.asave = _delta_save(cls.asave)
+                cls.asave_many = classmethod(
+                    _delta_save_many(cls.asave_many.__func__)
+                )
 
         return cls
 
     return wrapped
 
 
-def Index(func):
+def Index(func=None, type=str):
     """Decorator to mark function as index.
 
     Marks instance methods of a DBObject-decorated class as being used for
@@ -262,6 +709,18 @@ def Index(func):
 
     Note that callables are call recursively so in theory you can return
     a function which will be called to get the index value.
+
+    Index values are stored as strings unless you give a type (one of
+    gludb.query.INDEX_TYPES) with @Index(type=int) etc. Typed indexes are
+    stored natively where the backend can, so they compare and sort as
+    numbers or timestamps.
     """
+    if func is None:
+        return lambda func: Index(func, type=type)
+
+    if type not in INDEX_TYPES:
+        raise ValueError('Unsupported index type %s' % repr(type))
+
     func.is_index = True
+    func.index_type = type
     return func
@@ -31,3 +31,40 @@ def parse_now_field(s):
         dt = datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S')
 
     return dt
+
+
+def chunked(items, size):
+    """Yield successive lists of at most size items from the given iterable"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pick_fields(values, fields):
+    """Return a dict with only the given keys from the dict values. Keys that
+    values doesn't have are None in the result"""
+    return dict((name, values.get(name, None)) for name in fields)
+
+
+def group_by_class(objs, data_list=None):
+    """Return a list of (class, pairs) for the given objects. Each pair is an
+    (instance, data) tuple where data comes from the parallel list data_list
+    (or is None if data_list isn't given). Classes appear in the order they
+    are first seen, as do the pairs for each"""
+    if data_list is None:
+        data_list = [None] * len(objs)
+
+    groups = []
+    by_class = dict()
+    for obj, data in zip(objs, data_list):
+        cls = obj.__class__
+        if cls not in by_class:
+            by_class[cls] = []
+            groups.append((cls, by_class[cls]))
+        by_class[cls].append((obj, data))
+    return groups
@@ -3,12 +3,14 @@
 GLUDB versioning implementation
 """
 
-import json
 import datetime
 
-import json_delta  # External dependency
-
 from .utils import now_field
+from .serializers import dumps, loads
+
+# Note that we import our external dependency json_delta in the functions that
+# use it: most programs importing gludb never compute a diff, so they don't
+# need to pay for the import
 
 
 # Yes, this could be an enum, but we're supporting Python 2.7
@@ -29,7 +31,7 @@ def _isstr(s):
 # If any parameter is a string, parse it as JSON
 def _norm_json_params(*args):
     return tuple([
-        json.loads(param) if _isstr(param) else param
+        loads(param) if _isstr(param) else param
         for param in args
     ])
 
@@ -39,6 +41,7 @@ def record_diff(old, new):
     into the `old` record. The parameters must be structures compatible with
     json.dumps *or* strings compatible with json.loads. Note that by design,
     `old == record_patch(new, record_diff(old, new))`"""
+    import json_delta
     old, new = _norm_json_params(old, new)
     return json_delta.diff(new, old, verbose=False)
 
@@ -48,6 +51,7 @@ def record_patch(rec, diff):
     changes in `diff` to the record `rec`. The parameters must be structures
     compatible with json.dumps *or* strings compatible with json.loads. Note
     that by design, `old == record_patch(new, record_diff(old, new))`"""
+    import json_delta
     rec, diff = _norm_json_params(rec, diff)
     return json_delta.patch(rec, diff, in_place=False)
 
@@ -73,9 +77,9 @@ def parse_diff_hist(curr_obj, diff_hist):
     the diff was taken"""
     curr_obj, diff_hist = _norm_json_params(curr_obj, diff_hist)
 
-    yield (json.dumps(curr_obj), None)
+    yield (dumps(curr_obj), None)
 
     last_obj = curr_obj
     for one in reversed(diff_hist):
         last_obj = record_patch(last_obj, one['diff'])
-        yield json.dumps(last_obj), one['diff_date']
+        yield dumps(last_obj), one['diff_date']
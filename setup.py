@@ -65,6 +65,8 @@ setup(
         'mongodb': ['pymongo'],
         'postgresql': ['psycopg2'],
         'backups': ['boto'],
+        'fast': ['orjson'],
+        'msgpack': ['msgpack>=0.6.1'],
     },
 
     package_data={},
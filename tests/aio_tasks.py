@@ -0,0 +1,36 @@
+"""Coroutines for aio_tests (async syntax needs Python 3.5+)."""
+
+import asyncio
+
+from gludb.session import Session, current_session
+
+
+async def _session_task(started, saved):
+    with Session():
+        started.set()
+        await saved.wait()
+        raise ValueError('discard the session')
+
+
+async def _save_task(obj, started, saved):
+    await started.wait()
+    try:
+        session = current_session()
+        await obj.asave()
+        return session
+    finally:
+        saved.set()
+
+
+async def save_beside_session(obj):
+    """Save obj in one task while another task has a session that fails.
+
+    Returns the results of both tasks: the session task's exception, and the
+    current session seen by the task saving obj.
+    """
+    started, saved = asyncio.Event(), asyncio.Event()
+    return await asyncio.gather(
+        _session_task(started, saved),
+        _save_task(obj, started, saved),
+        return_exceptions=True
+    )
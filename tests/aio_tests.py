@@ -0,0 +1,194 @@
+"""Testing for the awaitable persistence methods in gludb.aio."""
+
+# pylama:ignore=D101,D102
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import gludb.config
+
+from gludb.data import orig_version
+from gludb.session import Session
+from gludb.simple import DBObject, Field
+from gludb.versioning import VersioningTypes
+
+from index_tests import IndexedData
+
+from utils import compare_data_objects
+
+HAS_ASYNC = sys.version_info >= (3, 5)
+
+if HAS_ASYNC:
+    import asyncio
+    import gludb.aio
+    import aio_tasks
+
+
+@DBObject(table_name='AsyncTest')
+class AsyncData(object):
+    name = Field('')
+
+
+@DBObject(
+    table_name='AsyncDeltaTest',
+    versioning=VersioningTypes.DELTA_HISTORY
+)
+class AsyncDeltaData(object):
+    name = Field('')
+
+
+class ThreadRecordingDatabase(gludb.config.Database):
+    def __init__(self, *args, **kwrds):
+        super(ThreadRecordingDatabase, self).__init__(*args, **kwrds)
+        self.threads = set()
+
+    def find_one(self, cls, id):
+        self.threads.add(threading.current_thread().name)
+        return super(ThreadRecordingDatabase, self).find_one(cls, id)
+
+
+@unittest.skipIf(not HAS_ASYNC, 'async methods need Python 3.5+')
+class AsyncTesting(unittest.TestCase):
+    SQLITE_DB = os.path.join(tempfile.gettempdir(), 'test_aio.sqlite')
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.db = ThreadRecordingDatabase('sqlite', filename=self.SQLITE_DB)
+        gludb.config.default_database(self.db)
+        self.wait(AsyncData.aensure_table())
+        self.wait(AsyncDeltaData.aensure_table())
+        self.wait(IndexedData.aensure_table())
+
+    def tearDown(self):
+        gludb.config.clear_database_config()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        os.remove(self.SQLITE_DB)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def assertObjEq(self, obj1, obj2):
+        self.assertTrue(compare_data_objects(obj1, obj2))
+
+    def test_readwrite(self):
+        a = AsyncData(name='async')
+        self.wait(a.asave())
+        self.assertTrue(a.id)
+
+        read_back = self.wait(AsyncData.afind_one(a.id))
+        self.assertObjEq(a, read_back)
+        self.assertEqual(orig_version(read_back), orig_version(a))
+        self.assertIsNone(self.wait(AsyncData.afind_one('missing')))
+
+        # The database call ran on the executor, not this thread
+        self.assertNotIn(threading.current_thread().name, self.db.threads)
+
+        self.wait(read_back.adelete())
+        self.assertEqual([], self.wait(AsyncData.afind_all()))
+
+    def test_bulk(self):
+        objs = [AsyncData(name='bulk%d' % i) for i in range(5)]
+        self.wait(AsyncData.asave_many(objs))
+
+        found = self.wait(AsyncData.afind_many([o.id for o in objs]))
+        for obj, read_back in zip(objs, found):
+            self.assertObjEq(obj, read_back)
+
+        self.wait(AsyncData.adelete_many(objs[:3]))
+        self.assertEqual(2, len(self.wait(AsyncData.afind_all())))
+
+    def test_iteration(self):
+        self.assertGreater(gludb.aio.ITER_BATCH_SIZE, 1)
+        count = gludb.aio.ITER_BATCH_SIZE * 2 + 1
+        objs = [AsyncData(name='iter%d' % i) for i in range(count)]
+        AsyncData.save_many(objs)
+
+        iterator = AsyncData.aiter_all()
+        names = []
+        while True:
+            try:
+                names.append(self.wait(iterator.__anext__()).name)
+            except StopAsyncIteration:
+                break
+        self.assertEqual(sorted(o.name for o in objs), sorted(names))
+
+    def test_by_index(self):
+        IndexedData(name='Alice', age=40).save()
+        IndexedData(name='Bob', age=40).save()
+        IndexedData(name='Carol', age=2).save()
+
+        found = self.wait(IndexedData.afind_by_index('half_age', 20))
+        self.assertEqual(['Alice', 'Bob'], sorted(o.name for o in found))
+
+    def test_counts(self):
+        IndexedData(name='Alice', age=40).save()
+        IndexedData(name='Bob', age=40).save()
+
+        self.assertEqual(2, self.wait(IndexedData.acount_all()))
+        count = self.wait(IndexedData.acount_by_index('half_age', 20))
+        self.assertEqual(2, count)
+        self.assertFalse(self.wait(IndexedData.aexists('missing')))
+
+    def test_projection(self):
+        alice = IndexedData(name='Alice', age=40)
+        alice.save()
+        IndexedData(name='Bob', age=2).save()
+
+        ids = self.wait(IndexedData.afind_ids_by_index('half_age', 20))
+        self.assertEqual([alice.id], ids)
+
+        recs = self.wait(IndexedData.afind_all(fields=['name']))
+        self.assertEqual(['Alice', 'Bob'], sorted(r.name for r in recs))
+
+    def test_where(self):
+        AsyncData(name='here').save()
+        AsyncData(name='there').save()
+
+        found = self.wait(AsyncData.afind_where(name='here'))
+        self.assertEqual(['here'], [obj.name for obj in found])
+
+    def test_versioned(self):
+        d = AsyncDeltaData(name='v1')
+        self.wait(d.asave())
+        d.name = 'v2'
+        self.wait(d.asave())
+
+        read_back = self.wait(AsyncDeltaData.afind_one(d.id))
+        self.assertEqual('v2', read_back.name)
+        self.assertEqual(1, len(read_back.get_version_hist()))
+
+    def test_session(self):
+        a = AsyncData(name='session')
+        a.save()
+        with Session():
+            first = self.wait(AsyncData.afind_one(a.id))
+            self.assertIs(first, AsyncData.find_one(a.id))
+            first.name = 'changed'
+            self.wait(first.asave())
+            self.assertEqual('session', AsyncData.find_one(a.id, True).name)
+        self.assertEqual('changed', AsyncData.find_one(a.id).name)
+
+    def test_task_sessions(self):
+        # A session in one task doesn't capture saves from another task
+        b = AsyncData(name='task B')
+        results = self.wait(aio_tasks.save_beside_session(b))
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIsNone(results[1])
+        self.assertEqual('task B', AsyncData.find_one(b.id).name)
+
+    def test_workers(self):
+        self.assertRaises(ValueError, self.db.set_async_workers, 0)
+
+        self.db.set_async_workers(1)
+        objs = [AsyncData(name='worker%d' % i) for i in range(3)]
+        AsyncData.save_many(objs)
+
+        self.db.threads.clear()
+        self.wait(asyncio.gather(*[AsyncData.afind_one(o.id) for o in objs]))
+        self.assertEqual(1, len(self.db.threads))
@@ -0,0 +1,173 @@
+"""Testing for the read-through cache in gludb.cache."""
+
+# pylama:ignore=D101,D102
+
+import unittest
+
+import gludb.config
+
+from gludb.cache import LRUCache, CachedDatabase
+from gludb.data import orig_version
+
+import simple_data_tests
+from simple_data_tests import SimpleStorage
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTesting(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual((True, 1), cache.get('a'))  # b is now LRU
+        cache.put('c', 3)
+
+        self.assertEqual((False, None), cache.get('b'))
+        self.assertEqual((True, 1), cache.get('a'))
+        self.assertEqual((True, 3), cache.get('c'))
+        self.assertEqual(
+            {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1},
+            cache.stats()
+        )
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        cache = LRUCache(ttl=10, timer=timer)
+        cache.put('a', 1)
+
+        timer.now += 9
+        self.assertEqual((True, 1), cache.get('a'))
+        timer.now += 2
+        self.assertEqual((False, None), cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_generation(self):
+        cache = LRUCache()
+        generation = cache.current_generation()
+        cache.invalidate('a')
+        cache.put('a', 'stale', generation)
+        self.assertEqual((False, None), cache.get('a'))
+
+        cache.put('a', 'fresh', cache.current_generation())
+        self.assertEqual((True, 'fresh'), cache.get('a'))
+
+    def test_bad_size(self):
+        self.assertRaises(ValueError, LRUCache, max_size=0)
+
+
+# Everything in the default storage tests should work through the cache
+class CachedStorageTesting(simple_data_tests.DefaultStorageTesting):
+    def setUp(self):
+        self.db = CachedDatabase(gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        gludb.config.default_database(self.db)
+        SimpleStorage.ensure_table()
+
+    def test_cache_hits(self):
+        s = SimpleStorage(name='cached', descrip='Hit me')
+        s.save()
+
+        first = SimpleStorage.find_one(s.id)
+        second = SimpleStorage.find_one(s.id)
+        self.assertObjEq(s, first)
+        self.assertObjEq(s, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(orig_version(first), orig_version(second))
+
+        stats = self.db.stats(SimpleStorage)
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+        # Changing a returned instance doesn't change the cache
+        first.name = 'changed'
+        self.assertEqual('cached', SimpleStorage.find_one(s.id).name)
+
+    def test_negative_caching(self):
+        self.assertIsNone(SimpleStorage.find_one('not-there'))
+        self.assertIsNone(SimpleStorage.find_one('not-there'))
+        self.assertEqual(1, self.db.stats(SimpleStorage)['hits'])
+
+        # Saving with that id replaces the cached miss
+        s = SimpleStorage(id='not-there', name='here now')
+        s.save()
+        self.assertObjEq(s, SimpleStorage.find_one('not-there'))
+
+    def test_no_negative_caching(self):
+        self.db.configure(SimpleStorage, cache_misses=False)
+        self.assertIsNone(SimpleStorage.find_one('not-there'))
+        self.assertIsNone(SimpleStorage.find_one('not-there'))
+        self.assertEqual(0, self.db.stats(SimpleStorage)['hits'])
+
+    def test_invalidation(self):
+        s = SimpleStorage(name='one')
+        s.save()
+        self.assertEqual('one', SimpleStorage.find_one(s.id).name)
+
+        s.name = 'two'
+        s.save()
+        self.assertEqual('two', SimpleStorage.find_one(s.id).name)
+
+        SimpleStorage.save_many([SimpleStorage(id=s.id, name='three')])
+        self.assertEqual('three', SimpleStorage.find_one(s.id).name)
+
+        s.delete()
+        self.assertIsNone(SimpleStorage.find_one(s.id))
+
+    def test_exists_cached(self):
+        s = SimpleStorage(name='exists')
+        s.save()
+        SimpleStorage.find_one(s.id)
+
+        self.assertTrue(SimpleStorage.exists(s.id))
+        self.assertFalse(SimpleStorage.exists('not-there'))
+        self.assertFalse(SimpleStorage.exists('not-there'))
+        self.assertEqual(2, self.db.stats(SimpleStorage)['hits'])
+
+    def test_find_many_cached(self):
+        objs = [SimpleStorage(name='many%d' % i) for i in range(4)]
+        SimpleStorage.save_many(objs)
+        ids = [o.id for o in objs]
+
+        SimpleStorage.find_one(ids[0])
+        found = SimpleStorage.find_many(ids + ['missing', ids[0]])
+        self.assertEqual(6, len(found))
+        for obj, read_back in zip(objs, found):
+            self.assertObjEq(obj, read_back)
+        self.assertIsNone(found[4])
+        self.assertObjEq(objs[0], found[5])
+        self.assertIsNot(found[0], found[5])
+
+        # All of those are now cached
+        SimpleStorage.find_many(ids + ['missing'])
+        self.assertEqual(6, self.db.stats(SimpleStorage)['hits'])
+
+    def test_disabled_class(self):
+        self.db.configure(SimpleStorage, enabled=False)
+        s = SimpleStorage(name='uncached')
+        s.save()
+        self.assertObjEq(s, SimpleStorage.find_one(s.id))
+        self.assertObjEq(s, SimpleStorage.find_one(s.id))
+        self.assertIsNone(self.db.stats(SimpleStorage))
+
+    def test_class_size(self):
+        self.db.configure(SimpleStorage, max_size=2)
+        objs = [SimpleStorage(name='size%d' % i) for i in range(3)]
+        SimpleStorage.save_many(objs)
+        for obj in objs:
+            SimpleStorage.find_one(obj.id)
+
+        stats = self.db.stats()
+        self.assertEqual(2, stats['size'])
+        self.assertEqual(1, stats['evictions'])
+
+        self.db.clear()
+        self.assertEqual(0, self.db.stats()['size'])
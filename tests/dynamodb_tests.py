@@ -4,6 +4,7 @@
 
 import gludb.config
 from gludb.data import DeleteNotSupported
+from gludb.simple import DBObject, Field, Index
 
 import simple_data_tests
 from simple_data_tests import SimpleStorage
@@ -43,3 +44,30 @@ class DynamoDBIndexReadWriteTesting(index_tests.IndexReadWriteTesting):
             IndexedData.get_table_name()
         )
         gludb.config.clear_database_config()
+
+    def test_ordering(self):
+        def ordered():
+            return IndexedData.find_all(order_by='my_name')
+        self.assertRaises(ValueError, ordered)
+
+    def test_composite_missing_gsi(self):
+        # A table created without the composite GSI still answers queries
+        @DBObject(table_name=IndexedData.get_table_name())
+        class OldIndexedData(object):
+            name = Field('')
+
+            @Index
+            def my_name(self):
+                return self.name
+
+            @Index
+            def half_age(self):
+                return 0
+
+        gludb.backends.dynamodb.delete_table(IndexedData.get_table_name())
+        OldIndexedData.ensure_table()
+
+        IndexedData(name='Bob', age=10).save()
+        IndexedData(name='Bob', age=20).save()
+        found = IndexedData.find_by_indexes({'half_age': 5, 'my_name': 'Bob'})
+        self.assertEqual([10], [obj.age for obj in found])
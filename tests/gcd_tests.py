@@ -8,6 +8,8 @@ import gludb.config
 from gludb.data import DeleteNotSupported
 
 if sys.version_info < (3, 0):
+    import gludb.backends.gcd
+
     import simple_data_tests
     from simple_data_tests import SimpleStorage
 
@@ -50,5 +52,6 @@ else:
     class VersionSpecificGCDTesting(unittest.TestCase):
         def test_no_import(self):
             def import_gcd():
-                gludb.config.default_database(gludb.config.Database('gcd'))
+                # Backends are created (and imported) on first use
+                return gludb.config.Database('gcd').backend
             self.assertRaises(ImportError, import_gcd)
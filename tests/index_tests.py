@@ -4,15 +4,22 @@ data storage (that's in simple_data_tests.py)
 
 import unittest
 import time
+import datetime
 
 import gludb.config
+import gludb.backends.sqlite
 
 from gludb.simple import DBObject, Field, Index
+from gludb.data import is_readonly, IndexTypeError
+from gludb.query import Predicate, gt, gte, lt, lte, between, one_of
 
 from utils import compare_data_objects
 
 
-@DBObject(table_name='IndexTest')
+@DBObject(
+    table_name='IndexTest',
+    composite_indexes=[('half_age', 'my_name')]
+)
 class IndexedData(object):
     name = Field('default name')
     descrip = Field()
@@ -34,6 +41,25 @@ class IndexedData(object):
         self.extra_property = 'Hello There'
 
 
+@DBObject(table_name='TypedIndexTest')
+class TypedIndexData(object):
+    name = Field('')
+    age = Field(0)
+    joined = Field('')
+
+    @Index(type=int)
+    def age_years(self):
+        return self.age
+
+    @Index(type=datetime.datetime)
+    def joined_at(self):
+        return self.joined or None
+
+    @Index
+    def my_name(self):
+        return self.name
+
+
 class IndexTesting(unittest.TestCase):
     def setUp(self):
         pass
@@ -60,6 +86,169 @@ class IndexTesting(unittest.TestCase):
 
         self.assertEquals({'my_name': 'changed', 'half_age': 1}, s.indexes())
 
+    def test_undecorated_subclass(self):
+        # Index names are found once per decorated class, but subclasses that
+        # weren't decorated can still add indexes
+        class MoreIndexes(IndexedData):
+            @Index
+            def first_letter(self):
+                return self.name[:1]
+
+        self.assertEqual(
+            ['first_letter', 'half_age', 'my_name'],
+            sorted(MoreIndexes.index_names())
+        )
+        self.assertEqual('B', MoreIndexes(name='Bob').indexes()['first_letter'])
+        self.assertEqual(['half_age', 'my_name'], IndexedData.index_names())
+
+    def test_composite_indexes(self):
+        self.assertEqual(
+            [('half_age', 'my_name')],
+            IndexedData.composite_indexes()
+        )
+
+        def bad_composite(names):
+            @DBObject(table_name='BadComposite', composite_indexes=[names])
+            class BadComposite(object):
+                name = Field('')
+
+                @Index
+                def my_name(self):
+                    return self.name
+            return BadComposite
+
+        self.assertRaises(ValueError, bad_composite, ('my_name',))
+        self.assertRaises(ValueError, bad_composite, ('my_name', 'nope'))
+
+    def test_sqlite_composite_index(self):
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.class_database(IndexedData, db)
+        try:
+            IndexedData.ensure_table()
+            cur = db.backend._conn().cursor()
+            cur.execute("select sql from sqlite_master where name = ?", (
+                'IndexTest_half_age_my_name_idx',
+            ))
+            self.assertIn('(half_age,my_name)', cur.fetchone()[0])
+        finally:
+            gludb.config.clear_database_config()
+
+    def test_multiple_indexes_fallback(self):
+        # Backends without multi-index queries: Database checks the other
+        # indexes
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.class_database(IndexedData, db)
+        try:
+            IndexedData.ensure_table()
+            db.backend.find_by_indexes = None
+            db.backend.iter_by_indexes = None
+            for name, age in [('Amy', 10), ('Bob', 10), ('Bob', 20)]:
+                IndexedData(name=name, age=age).save()
+
+            found = IndexedData.find_by_indexes(
+                {'half_age': 5, 'my_name': gte('B')}
+            )
+            self.assertEqual(['Bob'], [obj.name for obj in found])
+            found = IndexedData.find_by_indexes({'half_age': 5}, limit=1)
+            self.assertEqual(1, len(found))
+        finally:
+            gludb.config.clear_database_config()
+
+    def test_index_types(self):
+        self.assertEqual(
+            {'age_years': int, 'joined_at': datetime.datetime, 'my_name': str},
+            TypedIndexData.index_types()
+        )
+        self.assertEqual(
+            {'half_age': str, 'my_name': str},
+            IndexedData.index_types()
+        )
+
+        def bad_type():
+            @Index(type=list)
+            def names(self):
+                return []
+        self.assertRaises(ValueError, bad_type)
+
+    def test_index_type_changed(self):
+        # Tables created before an index had its type can't be used with it
+        @DBObject(table_name='TypedIndexTest')
+        class UntypedIndexData(object):
+            age = Field(0)
+
+            @Index
+            def age_years(self):
+                return self.age
+
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.class_database(UntypedIndexData, db)
+        gludb.config.class_database(TypedIndexData, db)
+        try:
+            UntypedIndexData.ensure_table()
+            self.assertRaises(IndexTypeError, TypedIndexData.ensure_table)
+        finally:
+            gludb.config.clear_database_config()
+
+        # But a table created with the types is fine
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.class_database(TypedIndexData, db)
+        try:
+            TypedIndexData.ensure_table()
+            TypedIndexData.ensure_table()
+        finally:
+            gludb.config.clear_database_config()
+
+    def test_typed_index(self):
+        db = gludb.config.Database('sqlite', filename=':memory:')
+        gludb.config.class_database(TypedIndexData, db)
+        try:
+            TypedIndexData.ensure_table()
+            for name, age in [('Amy', 9), ('Bob', 10), ('Cal', 100)]:
+                TypedIndexData(name=name, age=age).save()
+            TypedIndexData(
+                name='Dan', age=5, joined='UTC:2016-01-02T03:04:05.000000'
+            ).save()
+
+            def names(index_name, value, **kwrds):
+                found = TypedIndexData.find_by_index(index_name, value,
+                                                     **kwrds)
+                return [obj.name for obj in found]
+
+            # Numbers compare as numbers (as strings, '100' < '9')
+            self.assertEqual(['Bob', 'Cal'], sorted(names('age_years', gt(9))))
+            self.assertEqual(['Bob'], names('age_years', '10'))
+
+            ordered = TypedIndexData.find_all(order_by='age_years')
+            self.assertEqual(
+                ['Dan', 'Amy', 'Bob', 'Cal'],
+                [obj.name for obj in ordered]
+            )
+            rest = TypedIndexData.find_all(
+                order_by='age_years', after=ordered[1], limit=1
+            )
+            self.assertEqual(['Bob'], [obj.name for obj in rest])
+
+            # Timestamps take datetimes or now_field strings
+            self.assertEqual(['Dan'], names(
+                'joined_at', gte(datetime.datetime(2016, 1, 1))
+            ))
+            self.assertEqual(['Dan'], names(
+                'joined_at', 'UTC:2016-01-02T03:04:05.000000'
+            ))
+            self.assertRaises(ValueError, names, 'joined_at', 'yesterday')
+        finally:
+            gludb.config.clear_database_config()
+
+    def test_predicate(self):
+        self.assertEqual(Predicate('between', ['a', 'b']), between('a', 'b'))
+        self.assertNotEqual(gt('a'), gte('a'))
+        self.assertEqual(['x', 'y'], one_of(('x', 'y')).values)
+        self.assertRaises(ValueError, Predicate, 'like', ['a%'])
+
+        self.assertTrue(between('b', 'd').matches('c'))
+        self.assertFalse(gt(5).matches(5))
+        self.assertTrue(one_of([1, 2]).matches('2'))
+
 
 class IndexReadWriteTesting(unittest.TestCase):
     def setUp(self):
@@ -110,3 +299,146 @@ class IndexReadWriteTesting(unittest.TestCase):
         idx_recs = IndexedData.find_by_index('my_name', 'Post')
         self.assertEqual(1, len(idx_recs))
         self.assertObjEq(s2, idx_recs[0])
+
+        idx_recs = list(IndexedData.iter_by_index('my_name', 'Post'))
+        self.assertEqual(1, len(idx_recs))
+        self.assertObjEq(s2, idx_recs[0])
+
+        idx_recs = IndexedData.find_by_index('my_name', 'Post', readonly=True)
+        self.assertEqual(1, len(idx_recs))
+        self.assertObjEq(s2, idx_recs[0])
+        self.assertTrue(is_readonly(idx_recs[0]))
+
+    def test_ordering(self):
+        names = ['Eve', 'Bob', 'Dan', 'Amy', 'Cal', 'Bob']
+        for name in names:
+            IndexedData(name=name, age=10).save()
+
+        by_name = IndexedData.find_by_index('half_age', 5, order_by='my_name')
+        self.assertEqual(sorted(names), [obj.name for obj in by_name])
+
+        first = IndexedData.find_all(order_by='my_name', limit=2)
+        self.assertEqual(['Amy', 'Bob'], [obj.name for obj in first])
+
+        rest = IndexedData.find_all(order_by='my_name', after=first[-1])
+        self.assertEqual(['Bob', 'Cal', 'Dan', 'Eve'], [o.name for o in rest])
+
+        rest = IndexedData.find_by_index(
+            'half_age', 5, order_by='my_name', after=first[-1].id, limit=2
+        )
+        self.assertEqual(['Bob', 'Cal'], [obj.name for obj in rest])
+
+        by_id = IndexedData.find_all(order_by='id')
+        self.assertEqual(sorted(o.id for o in by_id), [o.id for o in by_id])
+
+    def test_null_ordering(self):
+        # None index values are NULL, which needs care when paging
+        names = ['Dan', None, 'Bob', None, 'Amy', None, 'Cal'] + [None] * 3
+        for name in names:
+            IndexedData(name=name, age=10).save()
+
+        page_size = gludb.backends.sqlite.ITER_PAGE_SIZE
+        gludb.backends.sqlite.ITER_PAGE_SIZE = 3
+        try:
+            ordered = IndexedData.find_all(order_by='my_name')
+        finally:
+            gludb.backends.sqlite.ITER_PAGE_SIZE = page_size
+        self.assertEqual(
+            [None] * 6 + ['Amy', 'Bob', 'Cal', 'Dan'],
+            [obj.name for obj in ordered]
+        )
+        nulls = [obj.id for obj in ordered[:6]]
+        self.assertEqual(sorted(nulls), nulls)
+
+        rest = IndexedData.find_all(order_by='my_name', after=ordered[2])
+        self.assertEqual(
+            [obj.id for obj in ordered[3:]],
+            [obj.id for obj in rest]
+        )
+        rest = IndexedData.find_by_index(
+            'half_age', 5, order_by='my_name', after=ordered[5], limit=2
+        )
+        self.assertEqual(['Amy', 'Bob'], [obj.name for obj in rest])
+
+    def test_predicates(self):
+        for name in ['Amy', 'Bob', 'Cal', 'Dan', 'Eve']:
+            IndexedData(name=name, age=10).save()
+
+        def names(value):
+            found = IndexedData.find_by_index('my_name', value)
+            return sorted(obj.name for obj in found)
+
+        self.assertEqual(['Dan', 'Eve'], names(gt('Cal')))
+        self.assertEqual(['Cal', 'Dan', 'Eve'], names(gte('Cal')))
+        self.assertEqual(['Amy', 'Bob'], names(lt('Cal')))
+        self.assertEqual(['Amy', 'Bob', 'Cal'], names(lte('Cal')))
+        self.assertEqual(['Bob', 'Cal', 'Dan'], names(between('Bob', 'Dan')))
+        self.assertEqual(['Amy', 'Eve'], names(one_of(['Eve', 'Amy', 'Zed'])))
+        self.assertEqual([], names(one_of([])))
+
+        found = list(IndexedData.iter_by_index('my_name', gt('Bob')))
+        self.assertEqual(3, len(found))
+
+    def test_counts(self):
+        for name in ['Amy', 'Bob', 'Cal']:
+            IndexedData(name=name, age=10).save()
+        IndexedData(name='Dan', age=20).save()
+
+        self.assertEqual(4, IndexedData.count_all())
+        self.assertEqual(3, IndexedData.count_by_index('half_age', 5))
+        self.assertEqual(0, IndexedData.count_by_index('half_age', 6))
+        self.assertEqual(2, IndexedData.count_by_index('my_name', gt('Bob')))
+        self.assertEqual(
+            2,
+            IndexedData.count_by_index('my_name', one_of(['Amy', 'Dan']))
+        )
+        self.assertEqual(0, IndexedData.count_by_index('my_name', one_of([])))
+
+    def test_projection(self):
+        for name in ['Eve', 'Bob', 'Dan', 'Amy']:
+            IndexedData(name=name, age=10).save()
+        IndexedData(name='Cal', age=20).save()
+
+        ids = IndexedData.find_ids_by_index('half_age', 5)
+        objs = IndexedData.find_by_index('half_age', 5)
+        self.assertEqual(sorted(o.id for o in objs), sorted(ids))
+
+        recs = IndexedData.find_by_index('half_age', 5, fields=['name'])
+        names = sorted(r.name for r in recs)
+        self.assertEqual(['Amy', 'Bob', 'Dan', 'Eve'], names)
+
+        first = IndexedData.find_all(
+            fields=['name', 'age'], order_by='my_name', limit=2
+        )
+        self.assertEqual(['Amy', 'Bob'], [r.name for r in first])
+        self.assertEqual([10, 10], [r.age for r in first])
+
+        rest = IndexedData.find_ids_by_index(
+            'half_age', gte('0'), order_by='my_name', after=first[-1]
+        )
+        names = [IndexedData.find_one(id).name for id in rest]
+        self.assertEqual(['Cal', 'Dan', 'Eve'], names)
+
+    def test_multiple_indexes(self):
+        for name, age in [('Amy', 10), ('Bob', 10), ('Bob', 20), ('Cal', 10)]:
+            IndexedData(name=name, age=age).save()
+
+        def find(index_values, **kwrds):
+            found = IndexedData.find_by_indexes(index_values, **kwrds)
+            return sorted((obj.name, obj.age) for obj in found)
+
+        both = {'half_age': 5, 'my_name': 'Bob'}
+        self.assertEqual([('Bob', 10)], find(both))
+        self.assertEqual([], find({'half_age': 5, 'my_name': 'Dan'}))
+        self.assertEqual(
+            [('Bob', 10), ('Cal', 10)],
+            find({'half_age': 5, 'my_name': gt('Amy')})
+        )
+        self.assertEqual(
+            [('Bob', 20)],
+            find({'half_age': one_of([10, 11]), 'my_name': 'Bob'})
+        )
+        self.assertEqual(1, len(find({'half_age': 5}, limit=1)))
+        self.assertEqual(4, len(find({})))
+
+        self.assertRaises(ValueError, IndexedData.find_by_indexes, {'x': 1})
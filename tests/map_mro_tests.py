@@ -118,3 +118,24 @@ class MappedStorageTesting(unittest.TestCase):
         self.assertEquals(self.mapdb, get_mapping(Derived1))
         self.assertEquals(self.mapdb, get_mapping(Derived2))
         self.assertEquals(self.mapdb, get_mapping(Derived3))
+
+    def test_config_changes_after_lookup(self):
+        gludb.config.clear_database_config()
+        gludb.config.default_database(self.defdb)
+
+        # Look up first so that the results are cached
+        self.assertEquals(self.defdb, get_mapping(BaseClass))
+        self.assertEquals(self.defdb, get_mapping(Derived1))
+
+        gludb.config.class_database(MidA, self.mapdb)
+        self.assertEquals(self.defdb, get_mapping(BaseClass))
+        self.assertEquals(self.mapdb, get_mapping(Derived1))
+        self.assertEquals(self.mapdb, get_mapping(Derived2))
+        self.assertEquals(self.defdb, get_mapping(MidB))
+
+        gludb.config.default_database(self.mapdb)
+        self.assertEquals(self.mapdb, get_mapping(BaseClass))
+
+        gludb.config.clear_database_config()
+        self.assertIsNone(get_mapping(Derived1, no_mapping_ok=True))
+        self.assertRaises(ValueError, get_mapping, Derived1)
@@ -5,6 +5,7 @@
 import unittest
 
 import gludb.config
+import gludb.backends.mongodb
 
 import simple_data_tests
 from simple_data_tests import SimpleStorage
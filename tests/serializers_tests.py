@@ -0,0 +1,327 @@
+"""Testing for gludb.serializers and binary stored data."""
+
+# pylama:ignore=D101,D102
+
+import os
+import sys
+import json
+import math
+import uuid
+import subprocess
+import tempfile
+import unittest
+
+import gludb.config
+import gludb.serializers
+
+from gludb.data import orig_version, _prepare_save
+from gludb.simple import DBObject, Field
+from gludb.serializers import (
+    dumps,
+    loads,
+    use_json_codec,
+    json_codec,
+    json_codecs,
+    get_serializer,
+    register_serializer,
+    encode_data,
+    encode_payload,
+    strip_encoding,
+    payload_text,
+    payload_values,
+    MsgpackSerializer,
+    Compression,
+    compression_stats,
+    reset_compression_stats,
+)
+
+from utils import compare_data_objects
+
+try:
+    import msgpack  # NOQA
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+try:
+    import lzma  # NOQA
+    HAS_LZMA = True
+except ImportError:
+    HAS_LZMA = False
+
+
+@DBObject(table_name='SerializedTest')
+class JSONData(object):
+    name = Field('')
+    tags = Field(list)
+    extra = Field(dict)
+
+
+class SerializerTesting(unittest.TestCase):
+    def setUp(self):
+        self.codec = json_codec()
+
+    def tearDown(self):
+        use_json_codec(self.codec)
+
+    def test_codecs(self):
+        value = {'name': u'caf\xe9', 'n': [1, 2.5, None, True], 'd': {}}
+        for name in json_codecs():
+            use_json_codec(name)
+            self.assertEqual(name, json_codec())
+            self.assertEqual(value, loads(dumps(value)))
+            self.assertEqual(value, json.loads(dumps(value)))
+
+        use_json_codec('json')
+        self.assertEqual(json.dumps(value), dumps(value))
+        self.assertRaises(ValueError, use_json_codec, 'nope')
+
+        # Non-string keys and values JSON can't hold work like they always
+        # have, whatever the codec
+        self.assertEqual({'1': 'one'}, loads(dumps({1: 'one'})))
+        self.assertEqual(2 ** 70, loads(dumps(2 ** 70)))
+        self.assertRaises(TypeError, dumps, {'bad': object()})
+
+    def test_default_codec(self):
+        # orjson is only used if you ask for it
+        self.assertEqual('json', json_codec())
+        value = {'id': uuid.uuid4()}
+        self.assertRaises(TypeError, dumps, value)
+
+        # ... and it's only imported then
+        root = os.path.dirname(os.path.dirname(gludb.__file__))
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, gludb.simple; print("orjson" in sys.modules)'
+        ], cwd=root)
+        self.assertEqual(b'False', output.strip())
+
+    def test_non_finite(self):
+        value = {'n': float('nan'), 'i': [float('inf'), -float('inf')]}
+        for name in json_codecs():
+            use_json_codec(name)
+            text = dumps(value)
+            self.assertNotIn('null', text)
+            read_back = loads(text)
+            self.assertTrue(math.isnan(read_back['n']))
+            self.assertEqual(value['i'], read_back['i'])
+
+    def test_json_payloads(self):
+        data = JSONData(name='plain').to_data()
+        self.assertIs(data, encode_payload(JSONData, data))
+        self.assertEqual(data, payload_text(data))
+        self.assertEqual(data, payload_text(data.encode('utf-8')))
+        self.assertEqual(loads(data), payload_values(data))
+        self.assertRaises(ValueError, payload_text, b'\xff\xfe')
+
+    def test_registry(self):
+        self.assertRaises(ValueError, get_serializer, 'nope')
+        self.assertRaises(ValueError, DBObject, 'Bad', serializer='nope')
+
+        class NoTag(MsgpackSerializer):
+            name = 'notag'
+            tag = b'{'
+
+        class SameTag(MsgpackSerializer):
+            name = 'sametag'
+
+        self.assertRaises(ValueError, register_serializer, NoTag)
+        self.assertRaises(ValueError, register_serializer, SameTag)
+
+
+class CompressionTesting(unittest.TestCase):
+    SQLITE_DB = os.path.join(tempfile.gettempdir(), 'test_compression.sqlite')
+
+    def setUp(self):
+        @DBObject(
+            table_name='SerializedTest',
+            compression=Compression('zlib', min_size=300)
+        )
+        class CompressedData(object):
+            name = Field('')
+            tags = Field(list)
+            extra = Field(dict)
+
+        self.CompressedData = CompressedData
+        gludb.config.default_database(gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        JSONData.ensure_table()
+        reset_compression_stats()
+
+    def tearDown(self):
+        gludb.config.clear_database_config()
+        os.remove(self.SQLITE_DB)
+
+    def test_payloads(self):
+        small = self.CompressedData(name='small').to_data()
+        self.assertEqual(small, encode_payload(self.CompressedData, small))
+
+        data = self.CompressedData(name='big', tags=['tag'] * 100).to_data()
+        payload = encode_payload(self.CompressedData, data)
+        self.assertTrue(isinstance(payload, bytearray))
+        self.assertEqual(b'\x02', payload[:1])
+        self.assertLess(len(payload), len(data))
+        self.assertEqual(data, payload_text(payload))
+        self.assertEqual(loads(data), payload_values(bytes(payload)))
+
+        stats = compression_stats()['zlib']
+        self.assertEqual(1, stats['compressed'])
+        self.assertEqual(2, stats['decompressed'])
+        self.assertEqual(len(data), stats['raw_bytes'])
+        self.assertEqual(len(payload), stats['stored_bytes'])
+        self.assertGreater(stats['ratio'], 1.0)
+        self.assertGreaterEqual(stats['compress_seconds'], 0.0)
+
+        # Payloads that don't get smaller are stored as they are
+        tiny = Compression('zlib', min_size=0)
+        self.assertIsNone(tiny.compress('{}'))
+        self.assertEqual(1, compression_stats()['zlib']['skipped'])
+
+        reset_compression_stats()
+        self.assertEqual({}, compression_stats())
+
+    @unittest.skipIf(not HAS_LZMA, 'lzma needs Python 3.3+')
+    def test_lzma(self):
+        data = JSONData(name='big', tags=['tag'] * 100).to_data()
+        payload = Compression('lzma').compress(data.encode('utf-8') * 10)
+        self.assertEqual(b'\x03', payload[:1])
+        self.assertEqual(data * 10, payload_text(payload))
+
+    def test_settings(self):
+        self.assertRaises(ValueError, Compression, 'nope')
+        self.assertRaises(ValueError, DBObject, 'Bad', compression='nope')
+
+        @DBObject(table_name='NamedCompression', compression='zlib')
+        class NamedCompression(object):
+            name = Field('')
+        self.assertEqual('zlib', NamedCompression.compression().method)
+        self.assertIsNone(JSONData.compression())
+
+    def test_storage(self):
+        big = self.CompressedData(name='big', tags=['tag'] * 100)
+        big.save()
+        small = self.CompressedData(name='small')
+        small.save()
+        JSONData(name='plain', tags=['tag'] * 100).save()
+
+        read_back = self.CompressedData.find_one(big.id)
+        self.assertTrue(compare_data_objects(big, read_back))
+        self.assertEqual(['tag'] * 100, JSONData.find_one(big.id).tags)
+        self.assertEqual(
+            ['big', 'plain', 'small'],
+            sorted(o.name for o in self.CompressedData.find_all())
+        )
+
+        # SQLite can't read compressed values, so we check rows in Python
+        found = self.CompressedData.find_where(name='big')
+        self.assertEqual([big.id], [o.id for o in found])
+        recs = self.CompressedData.find_all(fields=['name'])
+        self.assertEqual(
+            ['big', 'plain', 'small'],
+            sorted(rec.name for rec in recs)
+        )
+
+    @unittest.skipIf(not HAS_MSGPACK, 'msgpack is not installed')
+    def test_msgpack(self):
+        @DBObject(
+            table_name='SerializedTest',
+            serializer='msgpack',
+            compression=Compression(min_size=0)
+        )
+        class PackedData(object):
+            name = Field('')
+            tags = Field(list)
+
+        obj = PackedData(name='both', tags=['tag'] * 100)
+        payload = encode_payload(PackedData, obj.to_data())
+        self.assertEqual(b'\x02', payload[:1])
+        self.assertEqual(obj.tags, payload_values(payload)['tags'])
+
+        obj.save()
+        self.assertEqual(obj.tags, PackedData.find_one(obj.id).tags)
+
+
+@unittest.skipIf(not HAS_MSGPACK, 'msgpack is not installed')
+class MsgpackTesting(unittest.TestCase):
+    SQLITE_DB = os.path.join(tempfile.gettempdir(), 'test_serializers.sqlite')
+
+    def setUp(self):
+        # Same table as JSONData, so we can read the same rows in both formats
+        @DBObject(table_name='SerializedTest', serializer='msgpack')
+        class PackedData(object):
+            name = Field('')
+            tags = Field(list)
+            extra = Field(dict)
+
+        self.PackedData = PackedData
+        gludb.config.default_database(gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        JSONData.ensure_table()
+
+    def tearDown(self):
+        gludb.config.clear_database_config()
+        os.remove(self.SQLITE_DB)
+
+    def test_payloads(self):
+        obj = self.PackedData(name='packed', tags=[1, 2], extra={'a': None})
+        data = obj.to_data()
+
+        payload = encode_payload(self.PackedData, data)
+        self.assertEqual(b'\x01', payload[:1])
+        self.assertEqual(loads(data), loads(payload_text(payload)))
+        self.assertEqual(loads(data), payload_values(bytearray(payload)))
+
+    def test_encode_once(self):
+        obj = self.PackedData(name='packed', tags=['x'], extra={1: 'one'})
+        values = obj.to_dict()
+        data = encode_data(self.PackedData, values)
+        self.assertEqual(dumps(values), data)
+
+        # The payload was made from values, not by decoding the JSON again
+        payload = encode_payload(self.PackedData, data)
+        self.assertEqual(data.encoded, bytes(payload))
+        self.assertEqual(values, payload_values(payload))
+        self.assertIs(str, type(strip_encoding(data)))
+        self.assertIs(str, type(encode_data(JSONData, values)))
+
+        # Stored payloads are loaded from the dictionary, and the original
+        # version is only decoded when it's needed
+        obj.save()
+        self.assertIs(str, type(orig_version(obj)))
+        read_back = self.PackedData.find_one(obj.id)
+        self.assertEqual({1: 'one'}, read_back.extra)
+        self.assertEqual({}, _prepare_save(read_back)[1])
+        self.assertEqual(
+            loads(orig_version(obj)),
+            loads(orig_version(read_back))
+        )
+
+    def test_storage(self):
+        obj = self.PackedData(name='packed', tags=['x'], extra={'k': 1})
+        obj.save()
+        JSONData(name='plain').save()
+
+        read_back = self.PackedData.find_one(obj.id)
+        self.assertTrue(compare_data_objects(obj, read_back))
+        self.assertEqual(
+            loads(orig_version(obj)),
+            loads(orig_version(read_back))
+        )
+
+        # JSON rows load in the binary format's class and vice versa
+        names = sorted(o.name for o in self.PackedData.find_all())
+        self.assertEqual(['packed', 'plain'], names)
+        self.assertEqual(['x'], JSONData.find_one(obj.id).tags)
+
+        # Fields can't be read by SQLite, but queries still work
+        found = self.PackedData.find_where(name='packed')
+        self.assertEqual([obj.id], [o.id for o in found])
+        recs = self.PackedData.find_all(fields=['tags'])
+        self.assertEqual(
+            [[], ['x']],
+            sorted(rec.tags or [] for rec in recs)
+        )
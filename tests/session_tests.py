@@ -0,0 +1,198 @@
+"""Testing for gludb.session identity maps and deferred saves."""
+
+# pylama:ignore=D101,D102
+
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+import gludb.config
+
+from gludb.session import Session, current_session
+from gludb.data import orig_version
+from gludb.simple import DBObject, Field
+from gludb.versioning import VersioningTypes
+
+from utils import compare_data_objects
+
+
+@DBObject(table_name='SessionTest')
+class SessionData(object):
+    name = Field('')
+
+
+@DBObject(
+    table_name='SessionDeltaTest',
+    versioning=VersioningTypes.DELTA_HISTORY
+)
+class SessionDeltaData(object):
+    name = Field('')
+
+
+class CountingDatabase(gludb.config.Database):
+    def __init__(self, *args, **kwrds):
+        super(CountingDatabase, self).__init__(*args, **kwrds)
+        self.calls = []
+
+    def find_one(self, cls, id):
+        self.calls.append('find_one')
+        return super(CountingDatabase, self).find_one(cls, id)
+
+    def find_many(self, cls, ids):
+        self.calls.append('find_many')
+        return super(CountingDatabase, self).find_many(cls, ids)
+
+    def save(self, obj, data=None):
+        self.calls.append('save')
+        return super(CountingDatabase, self).save(obj, data)
+
+    def save_many(self, objs, data_list=None):
+        self.calls.append('save_many')
+        return super(CountingDatabase, self).save_many(objs, data_list)
+
+
+class SessionTesting(unittest.TestCase):
+    SQLITE_DB = os.path.join(tempfile.gettempdir(), 'test_session.sqlite')
+
+    def setUp(self):
+        self.db = CountingDatabase('sqlite', filename=self.SQLITE_DB)
+        gludb.config.default_database(self.db)
+        SessionData.ensure_table()
+        SessionDeltaData.ensure_table()
+
+    def tearDown(self):
+        gludb.config.clear_database_config()
+        os.remove(self.SQLITE_DB)
+
+    def assertObjEq(self, obj1, obj2):
+        self.assertTrue(compare_data_objects(obj1, obj2))
+
+    def test_identity_map(self):
+        s = SessionData(name='identity')
+        s.save()
+        del self.db.calls[:]
+
+        with Session():
+            first = SessionData.find_one(s.id)
+            second = SessionData.find_one(s.id)
+            self.assertIs(first, second)
+            self.assertIs(first, SessionData.find_all()[0])
+            self.assertIs(first, SessionData.find_many([s.id])[0])
+            self.assertIsNot(first, SessionData.find_one(s.id, readonly=True))
+        # Only the first find_one and the read-only find_one are database calls
+        self.assertEqual(['find_one', 'find_one'], self.db.calls)
+
+        # Sessions don't outlive their with block
+        self.assertIsNone(current_session())
+        self.assertIsNot(first, SessionData.find_one(s.id))
+
+    def test_find_many(self):
+        objs = [SessionData(name='many%d' % i) for i in range(3)]
+        SessionData.save_many(objs)
+
+        with Session():
+            first = SessionData.find_one(objs[0].id)
+            found = SessionData.find_many([o.id for o in objs] + ['missing'])
+            self.assertIs(first, found[0])
+            self.assertIsNone(found[3])
+            for obj, read_back in zip(objs, found):
+                self.assertObjEq(obj, read_back)
+
+            # Repeated ids are all the session's instance
+            found = SessionData.find_many([objs[1].id, objs[1].id])
+            self.assertIs(found[0], found[1])
+
+    def test_deferred_saves(self):
+        with Session():
+            objs = [SessionData(name='deferred%d' % i) for i in range(3)]
+            for obj in objs:
+                obj.save()
+            SessionData.save_many([SessionData(name='bulk')])
+            objs[0].name = 'changed'
+            objs[0].save()
+            self.assertEqual([], self.db.calls)
+
+            # New objects are in the session even before they're written
+            self.assertIs(objs[1], SessionData.find_one(objs[1].id))
+            self.assertEqual([], self.db.calls)
+
+        self.assertEqual(['save_many'], self.db.calls)
+        self.assertEqual(4, len(SessionData.find_all()))
+        self.assertEqual('changed', SessionData.find_one(objs[0].id).name)
+
+    def test_flush(self):
+        with Session() as session:
+            s = SessionData(name='flushed')
+            s.save()
+            self.assertEqual(0, len(SessionData.find_all()))
+            session.flush()
+            self.assertEqual(1, len(SessionData.find_all()))
+        self.assertEqual(['save_many'], self.db.calls)
+
+    def test_exception_discards(self):
+        def failed_session():
+            with Session():
+                SessionData(name='never saved').save()
+                raise ValueError('oops')
+        self.assertRaises(ValueError, failed_session)
+        self.assertEqual(0, len(SessionData.find_all()))
+
+    def test_exception_restores_orig(self):
+        s = SessionData(name='a')
+        s.save()
+
+        def failed_session():
+            with Session():
+                s.name = 'b'
+                s.save()
+                raise ValueError('oops')
+        self.assertRaises(ValueError, failed_session)
+        self.assertEqual('a', json.loads(orig_version(s))['name'])
+
+        # Saving again after the failed session still writes the change
+        s.save()
+        self.assertEqual('b', SessionData.find_one(s.id).name)
+
+    def test_delete(self):
+        s = SessionData(name='deleted')
+        s.save()
+        with Session():
+            loaded = SessionData.find_one(s.id)
+            loaded.save()
+            loaded.delete()
+            self.assertIsNone(SessionData.find_one(s.id))
+        self.assertIsNone(SessionData.find_one(s.id))
+
+    def test_versioning(self):
+        with Session():
+            s = SessionDeltaData(name='v1')
+            s.save()
+            s.name = 'v2'
+            s.save()
+            self.assertEqual('v2', json.loads(orig_version(s))['name'])
+
+        read_back = SessionDeltaData.find_one(s.id)
+        self.assertEqual('v2', read_back.name)
+        self.assertEqual(1, len(read_back._version_hist))
+
+    def test_nested_sessions(self):
+        with Session() as outer:
+            with Session() as inner:
+                self.assertIs(inner, current_session())
+                SessionData(name='inner').save()
+            self.assertIs(outer, current_session())
+            self.assertEqual(1, len(SessionData.find_all()))
+
+    def test_per_thread(self):
+        seen = []
+
+        def other_thread():
+            seen.append(current_session())
+
+        with Session():
+            t = threading.Thread(target=other_thread)
+            t.start()
+            t.join()
+        self.assertEqual([None], seen)
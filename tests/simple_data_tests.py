@@ -11,6 +11,7 @@ DefaultStorageTesting to include the same test.
 
 import os
 import sys
+import json
 import unittest
 import datetime
 import time
@@ -20,8 +21,9 @@ import tempfile
 import gludb.config
 
 from gludb.versioning import VersioningTypes
-from gludb.data import orig_version
+from gludb.data import orig_version, is_readonly, ReadOnlyError
 from gludb.simple import DBObject, Field
+from gludb.query import gt, gte, lt, between, one_of
 from gludb.utils import parse_now_field
 
 from utils import compare_data_objects
@@ -35,6 +37,25 @@ class SimpleStorage(object):
     extra_data = Field(dict)
 
 
+@DBObject(table_name='SlottedStorageTest', slots=True)
+class SlottedStorage(object):
+    name = Field('default name')
+    age = Field(42)
+
+
+@DBObject(table_name='LazyStorageTest', lazy=True)
+class LazyStorage(object):
+    name = Field('default name')
+    age = Field(42)
+
+
+@DBObject(table_name='DeferredStorageTest')
+class DeferredStorage(object):
+    name = Field('default name')
+    body = Field('', deferred=True)
+    notes = Field(list, deferred=True)
+
+
 # Same tests as DefaultStorageTesting but with differnt setUp/tearDown
 class MissingMapTesting(unittest.TestCase):
     def setUp(self):
@@ -87,6 +108,32 @@ class DefaultStorageTesting(unittest.TestCase):
     def test_missing(self):
         self.assertIsNone(SimpleStorage.find_one('not there'))
 
+    def test_find_reads_list(self):
+        # find_* read the whole result with the database's find methods
+        # (instead of streaming it with the iter methods)
+        s = SimpleStorage(name='Listed')
+        s.save()
+
+        db = gludb.config.get_mapping(SimpleStorage)
+
+        def not_streamed(*args, **kwrds):
+            raise AssertionError('find_* used an iter_* method')
+        db.iter_all = not_streamed
+        db.iter_by_index = not_streamed
+        try:
+            self.assertEqual([s.id], [o.id for o in SimpleStorage.find_all()])
+            self.assertEqual(
+                [s.id],
+                [o.id for o in SimpleStorage.find_by_index('id', s.id)]
+            )
+            self.assertEqual(
+                [s.id],
+                [o.id for o in SimpleStorage.find_all(order_by='id', limit=1)]
+            )
+        finally:
+            del db.iter_all
+            del db.iter_by_index
+
     def test_table_has_prefix(self):
         self.assertEqual(
             SimpleStorage.get_table_name(),
@@ -232,6 +279,265 @@ class DefaultStorageTesting(unittest.TestCase):
         self.assertEquals(1, len(all_recs))
         self.assertEquals(s2.get_id(), all_recs[0].get_id())
 
+    def test_orig_version_is_stored(self):
+        s = SimpleStorage(name='Stored', descrip='As saved')
+        s.save()
+
+        # What we read back is exactly what was saved: loading doesn't
+        # re-serialize (which would also bump _last_update)
+        for read_back in [SimpleStorage.find_one(s.id)] + SimpleStorage.find_all():
+            self.assertEqual(s._last_update, read_back._last_update)
+            self.assertEqual(
+                json.loads(orig_version(s)),
+                json.loads(orig_version(read_back))
+            )
+
+    def test_readonly(self):
+        s = SimpleStorage(name='ReadOnly', descrip='Reporting')
+        s.save()
+
+        found = [
+            SimpleStorage.find_one(s.id, readonly=True),
+            SimpleStorage.find_all(readonly=True)[0],
+            SimpleStorage.find_many([s.id], readonly=True)[0],
+            next(SimpleStorage.iter_all(readonly=True)),
+        ]
+
+        for read_back in found:
+            self.assertObjEq(s, read_back)
+            self.assertTrue(is_readonly(read_back))
+            self.assertIsNone(orig_version(read_back))
+            self.assertRaises(ReadOnlyError, read_back.save)
+            self.assertRaises(ReadOnlyError, read_back.delete)
+            self.assertRaises(
+                ReadOnlyError,
+                SimpleStorage.save_many,
+                [read_back]
+            )
+
+        # Nothing was written by the failed saves
+        self.assertEqual(
+            json.loads(orig_version(s)),
+            json.loads(orig_version(SimpleStorage.find_one(s.id)))
+        )
+        self.assertFalse(is_readonly(SimpleStorage.find_one(s.id)))
+
+    def test_bulk_readwrite(self):
+        objs = [
+            SimpleStorage(name='Bulk-%d' % (num,), age=num)
+            for num in range(10)
+        ]
+        SimpleStorage.save_many(objs)
+
+        for obj in objs:
+            self.assertTrue(len(obj.id) > 0)
+            self.assertObjEq(obj, SimpleStorage.from_data(orig_version(obj)))
+            self.assertReadable(obj)
+
+        ids = [obj.id for obj in reversed(objs)]
+        ids.insert(3, 'not there')
+        found = SimpleStorage.find_many(ids)
+
+        self.assertEqual(len(ids), len(found))
+        self.assertIsNone(found[3])
+        del found[3]
+        for obj, read_back in zip(reversed(objs), found):
+            self.assertObjEq(obj, read_back)
+            self.assertIsNotNone(orig_version(read_back))
+
+        self.assertEqual([], SimpleStorage.find_many([]))
+
+        # A repeated id gets its own instance in each position
+        first, repeat = SimpleStorage.find_many([objs[0].id, objs[0].id])
+        self.assertObjEq(objs[0], first)
+        self.assertObjEq(objs[0], repeat)
+        self.assertIsNot(first, repeat)
+        self.assertEqual(orig_version(first), orig_version(repeat))
+
+    def test_iter_all(self):
+        objs = [
+            SimpleStorage(id='key%d' % (num,), name='Iter-%d' % (num,))
+            for num in range(5)
+        ]
+        SimpleStorage.save_many(objs)
+
+        found = SimpleStorage.iter_all()
+        self.assertFalse(isinstance(found, list))
+
+        # Saving while iterating shouldn't disturb the iteration
+        seen = []
+        for obj in found:
+            self.assertIsNotNone(orig_version(obj))
+            obj.descrip = 'seen'
+            obj.save()
+            seen.append(obj.id)
+
+        self.assertEquals(sorted(o.id for o in objs), sorted(seen))
+        for obj in SimpleStorage.find_all():
+            self.assertEquals('seen', obj.descrip)
+
+    def test_delete_many(self):
+        objs = [
+            SimpleStorage(id='key%d' % (num,), name='Del-%d' % (num,))
+            for num in range(5)
+        ]
+        SimpleStorage.save_many(objs)
+        self.assertEquals(5, len(SimpleStorage.find_all()))
+
+        SimpleStorage.delete_many(objs[1:4])
+
+        all_ids = sorted([obj.id for obj in SimpleStorage.find_all()])
+        self.assertEquals(['key0', 'key4'], all_ids)
+
+    def test_paging(self):
+        objs = [SimpleStorage(name='Page-%d' % (num,)) for num in range(7)]
+        SimpleStorage.save_many(objs)
+
+        self.assertEquals([], SimpleStorage.find_all(limit=0))
+        self.assertEquals(3, len(SimpleStorage.find_all(limit=3)))
+        self.assertRaises(ValueError, SimpleStorage.find_all, limit=-1)
+        self.assertRaises(ValueError, SimpleStorage.find_all, order_by='name')
+
+        # Page through everything, using both objects and ids for after
+        seen = []
+        after = None
+        while True:
+            page = SimpleStorage.find_all(limit=3, after=after)
+            seen.extend(obj.id for obj in page)
+            if len(page) < 3:
+                break
+            after = page[-1] if len(seen) < 4 else page[-1].id
+        self.assertEquals(sorted(obj.id for obj in objs), sorted(seen))
+
+    def test_counts(self):
+        self.assertEquals(0, SimpleStorage.count_all())
+        self.assertFalse(SimpleStorage.exists('key0'))
+
+        objs = [
+            SimpleStorage(id='key%d' % (num,), name='Count-%d' % (num,))
+            for num in range(4)
+        ]
+        SimpleStorage.save_many(objs)
+
+        self.assertEquals(4, SimpleStorage.count_all())
+        self.assertTrue(SimpleStorage.exists('key0'))
+        self.assertFalse(SimpleStorage.exists('key4'))
+
+    def test_fields(self):
+        s = SimpleStorage(name='Partial', descrip='Big', extra_data={'a': 1})
+        s.save()
+
+        found = SimpleStorage.find_all(fields=['name', 'extra_data', 'nope'])
+        self.assertEquals(1, len(found))
+        rec = found[0]
+        self.assertEquals(s.id, rec.id)
+        self.assertEquals(s.id, rec.get_id())
+        self.assertEquals('Partial', rec.name)
+        self.assertEquals({'a': 1}, rec.extra_data)
+        self.assertIsNone(rec.nope)
+        self.assertRaises(AttributeError, getattr, rec, 'descrip')
+        self.assertRaises(ReadOnlyError, rec.save)
+        self.assertRaises(ReadOnlyError, rec.delete)
+
+        ids_only = list(SimpleStorage.iter_all(fields=[]))
+        self.assertEquals([{'id': s.id}], [r.to_dict() for r in ids_only])
+
+    def test_find_where(self):
+        SimpleStorage(name='A', age=10).save()
+        SimpleStorage(name='A', age=42).save()
+        SimpleStorage(name='B', age=50, extra_data={'x': 1}).save()
+
+        def where(*args, **kwrds):
+            found = SimpleStorage.find_where(*args, **kwrds)
+            return sorted((obj.name, obj.age) for obj in found)
+
+        self.assertEquals([('A', 10), ('A', 42)], where(name='A'))
+        self.assertEquals([('A', 42)], where(name='A', age=gt(40)))
+        self.assertEquals([('A', 42), ('B', 50)], where({'age': gte(42)}))
+        self.assertEquals([('B', 50)], where(age=between(43, 60)))
+        self.assertEquals([('A', 10)], where(age=one_of([10, 11])))
+        self.assertEquals([], where(age='42'))  # JSON types have to match
+        self.assertEquals(3, len(where(not_a_field=None)))
+        self.assertEquals(1, len(where(name='A', limit=1)))
+
+        found = SimpleStorage.iter_where(name='B')
+        self.assertFalse(isinstance(found, list))
+        self.assertEquals({'x': 1}, next(found).extra_data)
+
+    def test_find_where_types(self):
+        # Fields only match operands of the same JSON type
+        SimpleStorage(name='num', age=40).save()
+        SimpleStorage(name='one', age=1).save()
+        SimpleStorage(name='str', age='abc').save()
+        SimpleStorage(name='bool', age=True).save()
+        SimpleStorage(name='list', age=[50]).save()
+
+        def where(*args, **kwrds):
+            found = SimpleStorage.find_where(*args, **kwrds)
+            return sorted(obj.name for obj in found)
+
+        self.assertEquals(['num'], where(age=gt(30)))
+        self.assertEquals(['num', 'one'], where(age=gte(1)))
+        self.assertEquals(['num'], where(age=between(2, 100)))
+        self.assertEquals(['str'], where(age=gt('a')))
+        self.assertEquals(['str'], where(age=lt('b')))
+        self.assertEquals(['bool'], where(age=True))
+        self.assertEquals(['one'], where(age=1))
+        self.assertEquals(['bool', 'one'], where(age=one_of([1, True])))
+        self.assertEquals(['one'], where(age=one_of([1])))
+        self.assertEquals(['bool'], where(age=one_of([True, 'x'])))
+        self.assertEquals(['str'], where(age=one_of([False, 'abc'])))
+
+    def test_find_where_containers(self):
+        # List and dict operands only match equal values, not supersets
+        SimpleStorage(name='list', age=[50], extra_data={'a': 1}).save()
+        SimpleStorage(
+            name='longer', age=[50, 60], extra_data={'a': 1, 'b': 2}
+        ).save()
+        SimpleStorage(name='num', age=50, extra_data={}).save()
+
+        def where(*args, **kwrds):
+            found = SimpleStorage.find_where(*args, **kwrds)
+            return sorted(obj.name for obj in found)
+
+        self.assertEquals(['list'], where(age=[50]))
+        self.assertEquals(['list'], where(extra_data={'a': 1}))
+        self.assertEquals(['num'], where(extra_data={}))
+        self.assertEquals(['list', 'num'], where(age=one_of([[50], 50])))
+        self.assertEquals(['longer'], where(name='longer', age=[50, 60]))
+        self.assertEquals(
+            ['list'], [o.name for o in SimpleStorage.find_where(
+                limit=1, age=one_of([[50], [1]]), extra_data={'a': 1}
+            )]
+        )
+
+    def test_unchanged_not_saved(self):
+        s = SimpleStorage(name='Unchanged', extra_data={'a': 1})
+        s.save()
+        stored = SimpleStorage.find_one(s.id)
+        last_update = stored._last_update
+
+        # Only the automatic _last_update changes, so nothing is written
+        stored.save()
+        SimpleStorage.save_many([stored])
+        read_back = SimpleStorage.find_one(s.id)
+        self.assertEquals(last_update, read_back._last_update)
+
+    def test_changed_fields_saved(self):
+        s = SimpleStorage(name='Partial', descrip='Before', extra_data={})
+        s.save()
+
+        stored = SimpleStorage.find_one(s.id)
+        stored.descrip = 'After'
+        stored.extra_data['a'] = 1
+        stored.save()
+
+        read_back = SimpleStorage.find_one(s.id)
+        self.assertObjEq(stored, read_back)
+        self.assertEquals('Partial', read_back.name)
+        self.assertEquals({'a': 1}, read_back.extra_data)
+        self.assertNotEquals(s._last_update, read_back._last_update)
+
 
 # Same tests as DefaultStorageTesting but with differnt setUp/tearDown
 class SpecificStorageTesting(DefaultStorageTesting):
@@ -248,6 +554,154 @@ class SpecificStorageTesting(DefaultStorageTesting):
         gludb.config.clear_database_config()
         os.remove(self.SQLITE_DB)
 
+    def test_fields_without_json(self):
+        # Older SQLite builds don't have the JSON functions
+        gludb.config.get_mapping(SimpleStorage).backend.json_functions = False
+        self.test_fields()
+
+    def test_find_where_without_json(self):
+        gludb.config.get_mapping(SimpleStorage).backend.json_functions = False
+        self.test_find_where()
+
+    def test_find_where_fallback(self):
+        # Backends without iter_where get a client-side filter
+        gludb.config.get_mapping(SimpleStorage).backend.iter_where = None
+        self.test_find_where()
+
+    def test_find_where_types_without_json(self):
+        gludb.config.get_mapping(SimpleStorage).backend.json_functions = False
+        self.test_find_where_types()
+
+    def test_find_where_types_fallback(self):
+        gludb.config.get_mapping(SimpleStorage).backend.iter_where = None
+        self.test_find_where_types()
+
+    def test_find_where_containers_fallback(self):
+        gludb.config.get_mapping(SimpleStorage).backend.iter_where = None
+        self.test_find_where_containers()
+
+    def test_slots(self):
+        gludb.config.class_database(SlottedStorage, gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        SlottedStorage.ensure_table()
+
+        s = SlottedStorage(name='slotted')
+        s.save()
+        self.assertEqual('slotted', json.loads(orig_version(s))['name'])
+
+        read_back = SlottedStorage.find_one(s.id)
+        self.assertObjEq(s, read_back)
+        self.assertEqual(orig_version(s), orig_version(read_back))
+
+        read_back.age = 7
+        read_back.save()
+        self.assertEqual(7, SlottedStorage.find_one(s.id).age)
+        self.assertTrue(is_readonly(SlottedStorage.find_one(s.id, True)))
+
+    def test_lazy(self):
+        gludb.config.class_database(LazyStorage, gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        LazyStorage.ensure_table()
+        LazyStorage(name='lazy', age=1).save()
+        LazyStorage(name='lazier', age=2).save()
+
+        found = LazyStorage.find_all()
+        self.assertTrue(all('_lazy_data' in obj.__dict__ for obj in found))
+        self.assertEqual(['lazier', 'lazy'], sorted(o.name for o in found))
+
+        found[0].age = 10
+        found[0].save()
+        self.assertEqual(10, LazyStorage.find_one(found[0].id).age)
+        self.assertEqual(
+            [found[0].id],
+            [obj.id for obj in LazyStorage.find_by_index('id', found[0].id)]
+        )
+
+    def test_deferred(self):
+        gludb.config.class_database(DeferredStorage, gludb.config.Database(
+            'sqlite',
+            filename=self.SQLITE_DB
+        ))
+        DeferredStorage.ensure_table()
+        first = DeferredStorage(name='first', body='x' * 1000, notes=[1])
+        first.save()
+        DeferredStorage(name='second', body='short').save()
+
+        # Deferred values aren't read until they're used
+        found = DeferredStorage.find_all()
+        self.assertEqual(2, len(found))
+        for obj in found:
+            self.assertNotIn('body', obj.__dict__)
+            self.assertNotIn('notes', obj.__dict__)
+        by_name = dict((obj.name, obj) for obj in found)
+        self.assertEqual('x' * 1000, by_name['first'].body)
+        self.assertEqual([1], by_name['first'].notes)
+
+        DeferredStorage.load_deferred(found)
+        self.assertEqual('short', by_name['second'].body)
+        self.assertEqual([], by_name['second'].notes)
+
+        # Saving without reading the deferred fields keeps them
+        read_back = DeferredStorage.find_one(first.id)
+        read_back.name = 'renamed'
+        read_back.save()
+        read_back = DeferredStorage.find_one(first.id)
+        self.assertEqual('renamed', read_back.name)
+        self.assertEqual('x' * 1000, read_back.body)
+
+        # Changing one deferred field keeps the other
+        read_back = DeferredStorage.find_one(first.id)
+        read_back.body = 'changed'
+        read_back.save()
+        read_back = DeferredStorage.find_one(first.id)
+        self.assertEqual('changed', read_back.body)
+        self.assertEqual([1], read_back.notes)
+
+    def test_deferred_query_group(self):
+        db = gludb.config.Database('sqlite', filename=self.SQLITE_DB)
+        gludb.config.class_database(DeferredStorage, db)
+        DeferredStorage.ensure_table()
+        DeferredStorage.save_many([
+            DeferredStorage(name='n%d' % i, body='body %d' % i)
+            for i in range(5)
+        ])
+
+        calls = []
+        find_deferred = db.backend.find_deferred
+
+        def counted(cls, ids):
+            calls.append(sorted(ids))
+            return find_deferred(cls, ids)
+        db.backend.find_deferred = counted
+
+        # Using a deferred field reads them for every object from the query
+        found = DeferredStorage.find_all()
+        bodies = sorted(obj.body for obj in found)
+        self.assertEqual(['body %d' % i for i in range(5)], bodies)
+        self.assertEqual([sorted(obj.id for obj in found)], calls)
+
+        # Iterators group the objects they yield
+        del calls[:]
+        orig_size = gludb.data.DEFERRED_GROUP_SIZE
+        gludb.data.DEFERRED_GROUP_SIZE = 2
+        try:
+            for obj in DeferredStorage.iter_all():
+                self.assertEqual('body ' + obj.name[1:], obj.body)
+        finally:
+            gludb.data.DEFERRED_GROUP_SIZE = orig_size
+        self.assertEqual([2, 2, 1], [len(ids) for ids in calls])
+
+        # Objects keep their values when they're saved and read back
+        DeferredStorage.save_many(found)
+        self.assertEqual(
+            ['body %d' % i for i in range(5)],
+            sorted(obj.body for obj in DeferredStorage.find_all())
+        )
+
 
 # Same tests as DefaultStorageTesting but with differnt setUp/tearDown
 class PrefixedStorageTesting(DefaultStorageTesting):
@@ -4,10 +4,19 @@ data storage (that's in simple_data_tests.py).
 
 # pylama:ignore=D400,D101,D102,D205
 
+import sys
+import json
 import unittest
 
-from gludb.simple import DBObject, Field
-from gludb.data import Storable
+from gludb.simple import DBObject, Field, _delta_data
+from gludb.data import (
+    Storable,
+    from_stored_values,
+    object_values,
+    orig_version,
+    _prepare_save,
+    _StoredVersion,
+)
 from gludb.versioning import VersioningTypes
 
 from utils import compare_data_objects
@@ -27,6 +36,40 @@ class ComplexData(object):
     complex_data = Field(dict)
 
 
+@DBObject(table_name='SlottedTest', slots=True)
+class SlottedData(object):
+    __slots__ = ('scratch',)
+    name = Field('default name')
+    tags = Field(list)
+
+    def setup(self, *args, **kwrds):
+        self.scratch = 'set up'
+
+
+@DBObject(
+    table_name='SlottedChildTest',
+    versioning=VersioningTypes.DELTA_HISTORY,
+    slots=True
+)
+class SlottedChild(SlottedData):
+    age = Field(42)
+
+
+@DBObject(table_name='DeferredTest')
+class DeferredData(object):
+    name = Field('default name')
+    body = Field('', deferred=True)
+
+
+@DBObject(table_name='LazyTest', lazy=True)
+class LazyData(object):
+    name = Field('default name')
+    big = Field(list)
+
+    def setup(self, *args, **kwrds):
+        self.setup_calls = getattr(self, 'setup_calls', 0) + 1
+
+
 class BasicAbstractionTesting(unittest.TestCase):
     def setUp(self):
         pass
@@ -68,6 +111,166 @@ class BasicAbstractionTesting(unittest.TestCase):
         self.assertEquals('abc', s2.descrip)
         self.assertEquals(101, s2.age)
 
+    def test_generated_init(self):
+        self.assertTrue(SimpleData.__init__._clobber_ok)
+        self.assertIsNot(SimpleData.__init__, ComplexData.__init__)
+        self.assertIn('SimpleData', SimpleData.__init__.__code__.co_filename)
+
+        @DBObject(table_name='InitChildTest')
+        class InitChild(ComplexData):
+            tags = Field(list)
+
+            def setup(self, *args, **kwrds):
+                self.setup_args = (args, kwrds)
+
+        self.assertTrue(InitChild.__init__._clobber_ok)
+        c1 = InitChild('x', name='Bob')
+        c2 = InitChild()
+        self.assertEqual('Bob', c1.name)
+        self.assertEqual('', c2.name)
+        self.assertEqual((('x',), {'name': 'Bob'}), c1.setup_args)
+        self.assertIsNot(c1.tags, c2.tags)
+        self.assertIsNot(c1.complex_data, c2.complex_data)
+
+        with self.assertRaises(TypeError):
+            @DBObject(table_name='InitOverrideTest')
+            class InitOverride(object):
+                name = Field('')
+
+                def __init__(self):
+                    pass
+
+    @unittest.skipIf(sys.version_info < (3, 0), 'super() needs Python 3')
+    def test_slots_super(self):
+        @DBObject(table_name='SlottedSuperTest', slots=True)
+        class SlottedSuper(SlottedData):
+            calls = Field(0)
+
+            def setup(self, *args, **kwrds):
+                super().setup(*args, **kwrds)
+                self.calls += 1
+
+            @classmethod
+            def kind(cls):
+                return __class__.__name__
+
+        s = SlottedSuper(name='Bob')
+        self.assertFalse(hasattr(s, '__dict__'))
+        self.assertEqual(('set up', 1), (s.scratch, s.calls))
+        self.assertEqual('SlottedSuper', SlottedSuper.kind())
+        self.assertTrue(
+            SlottedSuper.__qualname__.endswith('<locals>.SlottedSuper')
+        )
+
+        s2 = SlottedSuper.from_data(s.to_data())
+        self.assertEqual(('Bob', 'set up', 2), (s2.name, s2.scratch, s2.calls))
+
+    def test_slots(self):
+        s = SlottedData(name='Bob')
+        self.assertFalse(hasattr(s, '__dict__'))
+        self.assertTrue(isinstance(s, Storable))
+        self.assertEqual(('Bob', [], 'set up'), (s.name, s.tags, s.scratch))
+        self.assertIsNot(s.tags, SlottedData().tags)
+
+        def set_unknown():
+            s.unknown = 1
+        self.assertRaises(AttributeError, set_unknown)
+
+        s2 = SlottedData.from_data(s.to_data())
+        self.assertObjEq(s, s2)
+
+        # Slotted subclasses keep the parent's fields
+        c = SlottedChild(name='Alice', age=7)
+        self.assertFalse(hasattr(c, '__dict__'))
+        self.assertEqual(('Alice', 7, 'set up'), (c.name, c.age, c.scratch))
+        self.assertEqual([], c.get_version_hist())
+        self.assertEqual(
+            ['_create_date', '_last_update', '_version_hist', 'age', 'id',
+             'name', 'tags'],
+            sorted(fld.name for fld in SlottedChild.__fields__)
+        )
+
+    def test_lazy(self):
+        self.assertTrue(isinstance(LazyData.name, Field))
+        data = LazyData(name='Bob', big=list(range(10))).to_data()
+
+        lazy = LazyData.from_data(data)
+        self.assertEqual({'_lazy_data': data}, lazy.__dict__)
+        self.assertEqual('Bob', lazy.name)
+        self.assertEqual(1, lazy.setup_calls)
+        self.assertNotIn('_lazy_data', lazy.__dict__)
+        self.assertEqual(list(range(10)), json.loads(lazy.to_data())['big'])
+
+        # Fields set before decoding are kept
+        lazy = LazyData.from_data(data)
+        lazy.name = 'Alice'
+        self.assertEqual(list(range(10)), lazy.big)
+        self.assertEqual('Alice', lazy.name)
+
+        self.assertRaises(ValueError, DBObject, 'Both', slots=True, lazy=True)
+
+    def test_dicts(self):
+        c = ComplexData(id='dict', name='Bob', complex_data={'a': [1, 2]})
+        data = json.loads(c.to_data())
+        values = c.to_dict()
+        self.assertEqual(sorted(data), sorted(values))
+        self.assertEqual(data['complex_data'], values['complex_data'])
+        self.assertIs(c.complex_data, values['complex_data'])
+        self.assertObjEq(c, ComplexData.from_dict(values))
+        self.assertEqual(data, object_values(c, json.dumps(data)))
+
+        # Instances from stored dictionaries get an original version made
+        # before setup runs
+        stored = {'name': 'Bob', 'big': [1]}
+        lazy = from_stored_values(LazyData, dict(stored))
+        self.assertEqual(1, lazy.setup_calls)
+        self.assertEqual(stored, json.loads(orig_version(lazy)))
+
+        # Saving only encodes the data once, and change detection uses the
+        # dictionary it was encoded from
+        read_back = from_stored_values(ComplexData, values)
+        self.assertEqual({}, _prepare_save(read_back)[1])
+        # ... and the original version wasn't encoded to find that out
+        orig = getattr(read_back, Storable.ORIG_VER_FIELD_NAME)
+        self.assertIsInstance(orig, _StoredVersion)
+        read_back.complex_data['a'].append(3)
+        data, changes = _prepare_save(read_back)
+        self.assertEqual({'a': [1, 2, 3]}, changes['complex_data'])
+        self.assertEqual([1, 2, 3], json.loads(data)['complex_data']['a'])
+
+        missing = DeferredData.from_dict({'name': 'Alice'})
+        self.assertNotIn('body', missing.__dict__)
+
+        # Versioning diffs against the original dictionary too
+        child = from_stored_values(SlottedChild, {'id': 'c', 'name': 'old'})
+        child.name = 'new'
+        hist = json.loads(_delta_data(child))['_version_hist']
+        self.assertEqual(1, len(hist))
+        self.assertEqual('old', json.loads(orig_version(child))['name'])
+
+    def test_deferred(self):
+        self.assertTrue(isinstance(DeferredData.body, Field))
+        self.assertEqual(['body'], DeferredData.deferred_fields())
+
+        d = DeferredData(name='Bob', body='long text')
+        data = d.to_data()
+        self.assertEqual('long text', json.loads(data)['body'])
+        self.assertEqual('long text', DeferredData.from_data(data).body)
+
+        # Without the field in the data (and no id to read it with) we get
+        # the default
+        missing = DeferredData.from_data(json.dumps({'name': 'Alice'}))
+        self.assertNotIn('body', missing.__dict__)
+        self.assertNotIn('body', json.loads(missing.to_data()))
+        self.assertEqual('', missing.body)
+        self.assertEqual('', json.loads(missing.to_data())['body'])
+
+        def slotted():
+            @DBObject(table_name='SlottedDeferred', slots=True)
+            class SlottedDeferred(object):
+                body = Field('', deferred=True)
+        self.assertRaises(ValueError, slotted)
+
     def test_prop_sets(self):
         s = SimpleData(name='Bob', descrip='abc', age=101)
         s.name = 'Alice'
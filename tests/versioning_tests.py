@@ -178,6 +178,36 @@ class VersionSavedTesting(unittest.TestCase):
         self.assertEquals("first new name", obj_hist_dct[1]['name'])
         self.assertEquals("default name", obj_hist_dct[2]['name'])
 
+    def test_unchanged_no_version(self):
+        d = VersionedData(name='unchanged')
+        d.save()
+        d.save()
+        VersionedData.save_many([d])
+        self.assertEquals([], d.get_version_hist())
+
+        d.name = 'changed'
+        d.save()
+        d.save()
+        read_back = VersionedData.find_one(d.id)
+        self.assertEquals(1, len(read_back.get_version_hist()))
+
+    def test_versions_saved_many(self):
+        objs = [VersionedData(name='bulk %d' % (num,)) for num in range(3)]
+        VersionedData.save_many(objs)
+
+        for obj in objs:
+            obj.name = 'changed ' + obj.name
+        VersionedData.save_many(objs)
+
+        for obj in VersionedData.find_many([obj.id for obj in objs]):
+            obj_hist = list(parse_diff_hist(
+                obj.to_data(),
+                obj.get_version_hist()
+            ))
+            self.assertEquals(2, len(obj_hist))
+            names = [json.loads(o)['name'] for o, _ in obj_hist]
+            self.assertEquals(['changed ' + names[1], names[1]], names)
+
 
 class VersionTypesTesting(unittest.TestCase):
     def setUp(self):